@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks of receive/modify/send loops, against a replaying driver and the simulated one.
+"""
+from pydivert.simulator import SimulatedLibrary
+from pydivert.windivert import WinDivert, Handle
+
+from workload import packet_mix, ReplayLibrary
+
+__author__ = 'fabio'
+
+
+def benchmarks():
+    """
+    Return the (name, function) of each benchmark, see bench_packets
+    """
+    mix = packet_mix()
+    handle = Handle(WinDivert(library=ReplayLibrary(mix))).open()
+    simulator = SimulatedLibrary(recv_timeout=0)
+    simulated = Handle(WinDivert(library=simulator), filter="tcp or udp").open()
+
+    def recv_send():
+        for _ in range(len(mix)):
+            handle.send(handle.recv())
+        return len(mix)
+
+    def receive_modify_send():
+        for _ in range(len(mix)):
+            packet = handle.receive()
+            packet.dst_port = 8080
+            handle.send(packet)
+        return len(mix)
+
+    def batch_modify_send():
+        for _ in range(len(mix) // 64):
+            packets = handle.receive_many(64)
+            for packet in packets:
+                packet.dst_port = 8080
+            handle.send_many(packets)
+        return len(mix) // 64 * 64
+
+    def simulated_loop():
+        count = 0
+        for start in range(0, len(mix), 64):
+            for raw, meta in mix[start:start + 64]:
+                simulator.inject(raw, meta.direction, meta.iface)
+            packets = simulated.receive_many(64)
+            for packet in packets:
+                packet.dst_port = 8080
+            simulated.send_many(packets)
+            count += len(packets)
+        simulator.delivered.clear()
+        return count
+
+    return [("recv/send", recv_send),
+            ("receive/modify/send", receive_modify_send),
+            ("receive_many/modify/send_many", batch_modify_send),
+            ("simulated driver: inject/receive_many/send_many", simulated_loop)]
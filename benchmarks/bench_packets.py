@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks of parsing, reading and modifying packets.
+"""
+from pydivert import checksum
+from pydivert.filters import Filter
+from pydivert.flows import FlowTable
+from pydivert.parser import parse_packet
+
+from workload import packet_mix
+
+__author__ = 'fabio'
+
+
+def benchmarks():
+    """
+    Return the (name, function) of each benchmark. A function processes the whole mix once and returns the
+    number of packets processed.
+    """
+    mix = packet_mix()
+    parsed = [parse_packet(raw, meta) for raw, meta in mix]
+    buffers = [bytearray(raw) for raw, meta in mix]
+    compiled = Filter("outbound and (tcp.DstPort == 80 or tcp.DstPort == 443) or udp.DstPort == 53")
+
+    def parse():
+        for raw, meta in mix:
+            parse_packet(raw, meta)
+        return len(mix)
+
+    def raw():
+        for packet in parsed:
+            packet.raw
+        return len(parsed)
+
+    def header_raw():
+        for packet in parsed:
+            packet.headers[0].raw
+        return len(parsed)
+
+    def get_fields():
+        for packet in parsed:
+            packet.src_addr, packet.dst_addr, packet.src_port, packet.dst_port
+        return len(parsed)
+
+    def get_binary_fields():
+        for packet in parsed:
+            packet.src_addr_int, packet.dst_addr_int, packet.flow_key
+        return len(parsed)
+
+    def set_fields():
+        for packet in parsed:
+            packet.dst_port = 8080
+            packet.src_addr = packet.src_addr
+        return len(parsed)
+
+    def refresh_checksums():
+        for packet in parsed:
+            packet.dst_port = 8080
+            packet.refresh_checksums()
+            packet.dst_port = 80
+            packet.refresh_checksums()
+        return 2 * len(parsed)
+
+    def calc_checksums():
+        for buffer in buffers:
+            checksum.update_checksums(buffer)
+        return len(buffers)
+
+    def match_filter():
+        match = compiled.match
+        for raw, meta in mix:
+            match(raw, meta)
+        return len(mix)
+
+    def track_flows():
+        table = FlowTable()
+        update = table.update
+        for raw, meta in mix:
+            update(raw, 0)
+        return len(mix)
+
+    return [("parse_packet", parse),
+            ("CapturedPacket.raw", raw),
+            ("HeaderWrapper.raw", header_raw),
+            ("get src_addr/dst_addr/src_port/dst_port", get_fields),
+            ("get src_addr_int/dst_addr_int/flow_key", get_binary_fields),
+            ("set dst_port/src_addr", set_fields),
+            ("refresh_checksums (incremental)", refresh_checksums),
+            ("checksum.update_checksums", calc_checksums),
+            ("Filter.match", match_filter),
+            ("FlowTable.update", track_flows)]
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs the benchmarks of the packet hot paths, reporting the time per packet.
+
+    python benchmarks/run.py                          # run them all
+    python benchmarks/run.py parse checksum           # only the ones whose name contains a word
+    python benchmarks/run.py --save baseline.json     # store the results
+    python benchmarks/run.py --compare baseline.json  # compare with results stored on the same machine
+
+Each benchmark processes a fixed mix of synthetic packets (see workload.py); the best of several
+repetitions is kept, as the least disturbed by the rest of the system.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_driver
+import bench_packets
+
+__author__ = 'fabio'
+
+SUITES = (bench_packets, bench_driver)
+
+
+def measure(function, repeat, min_time):
+    """
+    Return the best time per packet, in nanoseconds, of function
+    """
+    # Calibrate the number of loops so that each repetition lasts at least min_time
+    loops, elapsed = 1, 0
+    while True:
+        elapsed = timeit.timeit(function, number=loops)
+        if elapsed >= min_time:
+            break
+        loops *= 2
+    packets = function() * loops
+    best = min(timeit.repeat(function, number=loops, repeat=repeat))
+    return best / packets * 1e9
+
+
+def run(words=(), repeat=5, min_time=0.2):
+    results = {}
+    for suite in SUITES:
+        for name, function in suite.benchmarks():
+            if words and not any(word.lower() in name.lower() for word in words):
+                continue
+            results[name] = measure(function, repeat, min_time)
+            print("{:<50} {:>10.0f} ns/packet".format(name, results[name]))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the ratio of each result to the baseline, return the names of the regressions
+    """
+    regressions = []
+    print("\n{:<50} {:>10} {:>10} {:>8}".format("compared to " + baseline["python"], "baseline", "now", "ratio"))
+    for name, value in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print("{:<50} {:>10} {:>10.0f}".format(name, "-", value))
+            continue
+        ratio = value / before
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  slower"
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = "  faster"
+        print("{:<50} {:>10.0f} {:>10.0f} {:>7.2f}x{}".format(name, before, value, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pydivert benchmarks")
+    parser.add_argument("words", nargs="*", help="run only the benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions of each benchmark (default 5)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum duration of a repetition in seconds (default 0.2)")
+    parser.add_argument("--save", metavar="FILE", help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slow down reported as a regression (default 0.1)")
+    args = parser.parse_args()
+
+    results = run(args.words, args.repeat, args.min_time)
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump({"python": "{} {}".format(platform.python_implementation(), platform.python_version()),
+                       "platform": platform.platform(), "unit": "ns/packet",
+                       "results": dict((name, round(value, 1)) for name, value in results.items())},
+                      output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
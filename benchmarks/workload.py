@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Synthetic traffic for the benchmarks, the same at each run.
+"""
+import ctypes
+import random
+
+from pydivert.enum import Direction
+from pydivert.models import CapturedMetadata
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv6_tcp_packet, with_checksums
+
+__author__ = 'fabio'
+
+# (share of the packets, builder) of the mix
+MIX = ((60, ipv4_tcp_packet), (25, ipv4_udp_packet), (15, ipv6_tcp_packet))
+
+PAYLOAD_SIZES = (0, 0, 64, 512, 1400)
+
+
+def packet_mix(count=1000, seed=0):
+    """
+    Return count (raw_packet, meta) pairs, with valid checksums: TCP/UDP over IPv4 and TCP over IPv6,
+    with payloads from none to a full MTU
+    """
+    generator = random.Random(seed)
+    builders = [builder for share, builder in MIX for _ in range(share)]
+    packets = []
+    for _ in range(count):
+        builder = generator.choice(builders)
+        kwargs = dict(src_port=generator.randint(1024, 65535), dst_port=generator.choice((53, 80, 443)),
+                      payload=b"x" * generator.choice(PAYLOAD_SIZES))
+        if builder is ipv6_tcp_packet and len(kwargs["payload"]) > 1400:
+            kwargs["payload"] = kwargs["payload"][:1400]
+        meta = CapturedMetadata((generator.randint(1, 4), 0), generator.choice((Direction.OUTBOUND,
+                                                                                 Direction.INBOUND)))
+        packets.append((with_checksums(builder(**kwargs)), meta))
+    return packets
+
+
+class ReplayLibrary(object):
+    """
+    A driver replaying the given packets over and over and discarding the ones sent: unlike the simulator,
+    it costs close to nothing, so that benchmarks measure the binding only
+    """
+
+    def __init__(self, packets):
+        self.packets = packets
+        self.cursor = 0
+
+    def GetLastError(self):
+        return 0
+
+    def DivertOpen(self, filter, layer, priority, flags):
+        return 1
+
+    def DivertClose(self, handle):
+        return 1
+
+    def DivertRecv(self, handle, packet, packet_len, address, recv_len):
+        raw, meta = self.packets[self.cursor]
+        self.cursor = (self.cursor + 1) % len(self.packets)
+        ctypes.memmove(packet, raw, len(raw))
+        address._obj.IfIdx, address._obj.SubIfIdx = meta.iface
+        address._obj.Direction = meta.direction
+        recv_len._obj.value = len(raw)
+        return 1
+
+    def DivertRecvTimeout(self, handle, packet, packet_len, address, recv_len, timeout):
+        # Packets are always there: never waits
+        return self.DivertRecv(handle, packet, packet_len, address, recv_len)
+
+    def DivertSend(self, handle, packet, packet_len, address, send_len):
+        send_len._obj.value = packet_len
+        return 1
+
+    def DivertHelperCalcChecksums(self, packet, packet_len, flags):
+        return 0
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+asyncio support (python 3.5+).
+
+DivertRecv() and DivertSend() are blocking calls, so AsyncHandle runs them on two background threads:
+a receiver draining the handle (see Handle.recv_many) into a bounded asyncio queue, and a sender
+injecting queued packets in batches (see Handle.send_many). When the application does not keep up,
+the receiver stops taking packets from the driver, which queues (and eventually drops) them as
+configured by the QUEUE_LEN/QUEUE_TIME parameters.
+
+    async with AsyncHandle(Handle(filter="outbound and tcp.DstPort == 80")) as handle:
+        async for packet in handle:
+            packet.dst_port = 8080
+            await handle.send(packet)
+"""
+import asyncio
+import queue
+import threading
+
+from pydivert.windivert import BATCH_SIZE, PACKET_BUFFER_SIZE
+
+__author__ = 'fabio'
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:
+    # python < 3.7, where it is the running loop when called from a coroutine
+    _running_loop = asyncio.get_event_loop
+
+
+class AsyncHandle(object):
+    """
+    Asynchronous access to an Handle.
+
+    About max_pending received packets (rounded to whole batches, plus the ones being handed over) wait
+    for the application at most: the receiver thread stops receiving when they are reached. The same
+    bound applies to the packets waiting to be sent, send() waits for room.
+    batch_size and batch_timeout are given to Handle.recv_many(). A batch whose batch_timeout (in seconds)
+    has not expired yet waits for further packets: the default of 0 hands over the packets already queued
+    in the driver as soon as the first one is received.
+    Packets are parsed into CapturedPacket objects, unless raw is true: (raw_packet, meta) pairs are
+    returned then, raw_packet being bytes.
+    Errors returned by send_many() are passed to on_send_error(item, error), or just counted in
+    send_errors.
+    """
+
+    def __init__(self, handle, max_pending=1024, batch_size=BATCH_SIZE, batch_timeout=0, raw=False,
+                 bufsize=PACKET_BUFFER_SIZE, on_send_error=None):
+        self.handle = handle
+        self.max_pending = max_pending
+        self.batch_size = min(batch_size, max_pending)
+        self.batch_timeout = batch_timeout
+        self.raw = raw
+        self.bufsize = bufsize
+        self.on_send_error = on_send_error
+        self.send_errors = 0
+        self._loop = None
+        self._received = None
+        self._pending = []
+        self._cursor = 0
+        self._outgoing = queue.Queue(max_pending)
+        self._threads = []
+        self._closing = False
+        self._ended = False
+        self._error = None
+
+    async def open(self):
+        """
+        Opens the handle, unless already opened, and starts the background threads
+        """
+        self._loop = _running_loop()
+        self._received = asyncio.Queue(max(1, self.max_pending // self.batch_size))
+        if not self.handle.is_opened:
+            self.handle.open()
+        self._threads = [threading.Thread(target=self._receive, name="pydivert-recv"),
+                         threading.Thread(target=self._send, name="pydivert-send")]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def _receive(self):
+        if self.raw:
+            convert = lambda record: (bytes(record[0]), record[1])
+        else:
+            convert = self.handle.driver.parse_packet
+        error = None
+        while not self._closing:
+            try:
+                # Views over the ring buffers are overwritten by the next call: copy them
+                batch = [convert(record) for record in
+                         self.handle.recv_many(self.batch_size, self.bufsize, self.batch_timeout)]
+            except Exception as e:
+                error = e
+                break
+            if self._closing:
+                break
+            try:
+                asyncio.run_coroutine_threadsafe(self._received.put(batch), self._loop).result()
+            except Exception as e:
+                # The loop is gone
+                error = e
+                break
+        try:
+            self._loop.call_soon_threadsafe(self._end, None if self._closing else error)
+        except RuntimeError:
+            # Loop closed
+            pass
+
+    def _end(self, error):
+        self._ended = True
+        self._error = error
+        if self._received.empty():
+            # Wake up a waiting consumer
+            self._received.put_nowait(None)
+
+    def _send(self):
+        outgoing = self._outgoing
+        while True:
+            items = [outgoing.get()]
+            while items[-1] is not None and len(items) < self.batch_size:
+                try:
+                    items.append(outgoing.get_nowait())
+                except queue.Empty:
+                    break
+            stop = items[-1] is None
+            packets = items[:-1] if stop else items
+            try:
+                results = self.handle.send_many(packets) if packets else []
+            except Exception as error:
+                results = [error] * len(packets)
+            for item, result in zip(packets, results):
+                if isinstance(result, Exception):
+                    self.send_errors += 1
+                    if self.on_send_error is not None:
+                        self.on_send_error(item, result)
+            for _ in items:
+                outgoing.task_done()
+            if stop:
+                break
+
+    async def recv(self):
+        """
+        Return the next received packet. Raise EOFError once the handle has been closed, or the error that
+        stopped the receiver.
+        """
+        while self._cursor >= len(self._pending):
+            if self._ended and self._received.empty():
+                if self._error is not None:
+                    raise self._error
+                raise EOFError("Handle closed")
+            batch = await self._received.get()
+            if batch is not None:
+                self._pending, self._cursor = batch, 0
+        packet = self._pending[self._cursor]
+        self._cursor += 1
+        return packet
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except EOFError:
+            raise StopAsyncIteration
+
+    async def send(self, *args):
+        """
+        Queues a packet (an high level one or a (raw_packet, meta) pair, as for Handle.send) to be sent,
+        waiting if max_pending packets are already queued
+        """
+        item = args[0] if len(args) == 1 else args
+        try:
+            self._outgoing.put_nowait(item)
+        except queue.Full:
+            await self._loop.run_in_executor(None, self._outgoing.put, item)
+
+    async def drain(self):
+        """
+        Waits until all the queued packets have been sent
+        """
+        await self._loop.run_in_executor(None, self._outgoing.join)
+
+    async def close(self):
+        """
+        Sends the packets still queued, stops the background threads and closes the handle.
+        Packets received but not consumed yet are lost.
+        """
+        if self._closing:
+            return
+        self._closing = True
+        await self.drain()
+        self._outgoing.put(None)
+        if self.handle.is_opened:
+            self.handle.close()
+        # Make room for a receiver waiting to hand over a batch
+        while not self._received.empty():
+            self._received.get_nowait()
+        for thread in self._threads:
+            await self._loop.run_in_executor(None, thread.join)
+        self._pending, self._cursor = [], 0
+        if not self._ended:
+            self._end(None)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
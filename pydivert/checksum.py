@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Internet checksum helpers.
+
+A pure python equivalent of DivertHelperCalcChecksums, honoring the HelperOption flags, plus the
+incremental update used for modified headers. All the values handled here are 16 bit words in
+host order, as read with struct "!H".
+
+Words are summed in bulk: the buffer is read as a single big integer, whose value modulo 0xFFFF
+is the one's complement sum of its 16 bit words (since 2**16 == 1 mod 0xFFFF). When NumPy is
+available it is used for large buffers.
+"""
+import struct
+
+from pydivert.enum import HelperOption
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'fabio'
+
+# Below this size NumPy call overhead is bigger than the time it saves
+NUMPY_THRESHOLD = 16384
+
+_word = struct.Struct("!H")
+_header = struct.Struct("!BB")
+
+# IPv6 extension headers preceding the upper-layer header: hop-by-hop, routing and destination options,
+# fragment, authentication header
+IPV6_OPTIONS = (0, 43, 60)
+IPPROTO_FRAGMENT = 44
+IPPROTO_AH = 51
+
+# Checksum offset relative to the transport header, by protocol number
+_checksum_offsets = {1: 2, 6: 16, 17: 6, 58: 2}
+_checksum_flags = {1: HelperOption.NO_ICMP_CHECKSUM,
+                   6: HelperOption.NO_TCP_CHECKSUM,
+                   17: HelperOption.NO_UDP_CHECKSUM,
+                   58: HelperOption.NO_ICMPV6_CHECKSUM}
+
+
+def fold(value):
+    """
+    Fold the carries of a one's complement sum into 16 bits
+    """
+    while value >> 16:
+        value = (value & 0xFFFF) + (value >> 16)
+    return value
+
+
+def _sum_words(data):
+    value = int.from_bytes(data, "big")
+    if len(data) % 2:
+        # Pad with a zero byte
+        value <<= 8
+    total = value % 0xFFFF
+    # Both 0x0000 and 0xFFFF are zero: the sum is 0x0000 only if every word is zero
+    return 0xFFFF if not total and value else total
+
+
+def ones_complement_sum(data):
+    """
+    Return the 16 bit one's complement sum of the words in data (any buffer)
+    """
+    if numpy is not None and len(data) >= NUMPY_THRESHOLD:
+        words = numpy.frombuffer(data, dtype=">u2", count=len(data) // 2)
+        total = int(words.sum(dtype=numpy.uint64))
+        if len(data) % 2:
+            total += bytearray(memoryview(data)[-1:])[0] << 8
+        return fold(total)
+    return _sum_words(data)
+
+
+def internet_checksum(data, initial=0):
+    """
+    Return the internet checksum (RFC 1071) of data. initial is a partial sum to start from,
+    e.g. the sum of a pseudo header.
+    """
+    return ~fold(initial + ones_complement_sum(data)) & 0xFFFF
+
+
+def incremental_update(checksum, old_words, new_words):
+    """
+    Update a checksum after some of the words it covers changed from old_words to new_words,
+    as described by RFC 1624 (eqn. 3): HC' = ~(~HC + ~m + m')
+    """
+    total = ~checksum & 0xFFFF
+    for old, new in zip(old_words, new_words):
+        total += (~old & 0xFFFF) + new
+    return ~fold(total) & 0xFFFF
+
+
+def upper_layer(raw_packet, packet_len):
+    """
+    Skip the extension headers of an IPv6 packet. Return (protocol, offset, fragment): the upper-layer protocol,
+    where its header starts, and the offset/flags word of the fragment header (offset << 3 | more fragments),
+    0 if there is none. Past the first fragment of a datagram, the upper-layer header is not in the packet.
+    """
+    protocol = _header.unpack_from(raw_packet, 6)[0]
+    offset, fragment = 40, 0
+    while offset + 8 <= packet_len:
+        if protocol in IPV6_OPTIONS:
+            protocol, length = _header.unpack_from(raw_packet, offset)
+            offset += (length + 1) * 8
+        elif protocol == IPPROTO_FRAGMENT:
+            protocol = _header.unpack_from(raw_packet, offset)[0]
+            fragment = _word.unpack_from(raw_packet, offset + 2)[0] & 0xFFF9
+            offset += 8
+        elif protocol == IPPROTO_AH:
+            protocol, length = _header.unpack_from(raw_packet, offset)
+            offset += (length + 2) * 4
+        else:
+            break
+    return protocol, offset, fragment
+
+
+def update_checksums(buffer, flags=0):
+    """
+    (Re)calculates in place any IPv4/ICMP/ICMPv6/TCP/UDP checksum present in the packet held by buffer,
+    which must be writable (e.g. a bytearray or the view returned by CapturedPacket.writable_raw()).
+    Individual checksum calculations may be disabled via the HelperOption flags.
+    Transport checksums of fragments are left untouched, since they cover the whole datagram.
+
+    The return value is the number of checksums calculated.
+    """
+    view = memoryview(buffer)
+    packet_len = len(view)
+    if packet_len < 20:
+        return 0
+    version = _word.unpack_from(view, 0)[0] >> 12
+    count = 0
+    if version == 4:
+        ip_len = (_word.unpack_from(view, 0)[0] >> 8 & 0x0F) * 4
+        if ip_len < 20 or ip_len > packet_len:
+            return 0
+        if not flags & HelperOption.NO_IP_CHECKSUM:
+            _word.pack_into(view, 10, 0)
+            _word.pack_into(view, 10, internet_checksum(view[:ip_len]))
+            count += 1
+        protocol = _word.unpack_from(view, 8)[0] & 0xFF
+        if _word.unpack_from(view, 6)[0] & 0x3FFF:
+            # Fragment (either MF set or non zero offset)
+            return count
+        # Pseudo header: addresses, protocol and transport length
+        pseudo = ones_complement_sum(view[12:20]) + protocol + packet_len - ip_len
+    elif version == 6 and packet_len >= 40:
+        protocol, ip_len, fragment = upper_layer(view, packet_len)
+        if fragment or ip_len > packet_len:
+            return count
+        length = packet_len - ip_len
+        pseudo = ones_complement_sum(view[8:40]) + (length >> 16) + (length & 0xFFFF) + protocol
+    else:
+        return 0
+
+    offset = _checksum_offsets.get(protocol)
+    if offset is None or flags & _checksum_flags[protocol] or packet_len < ip_len + offset + 2:
+        return count
+    if (version, protocol) in ((4, 58), (6, 1)):
+        return count
+    checksum_offset = ip_len + offset
+    _word.pack_into(view, checksum_offset, 0)
+    checksum = internet_checksum(view[ip_len:], 0 if protocol == 1 else pseudo)
+    if protocol == 17 and not checksum:
+        checksum = 0xFFFF
+    _word.pack_into(view, checksum_offset, checksum)
+    return count + 1
+
+
+def calc_checksums(packet, flags=0):
+    """
+    Return a copy of the packet (any buffer) with its checksums (re)calculated, see update_checksums().
+    """
+    buffer = bytearray(packet)
+    update_checksums(buffer, flags)
+    return buffer
+
+
+def update_checksums_many(buffers, flags=0):
+    """
+    (Re)calculates in place the checksums of several packets, see update_checksums().
+    The return value is the list of the number of checksums calculated for each packet.
+    """
+    return [update_checksums(buffer, flags) for buffer in buffers]
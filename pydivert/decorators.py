@@ -23,16 +23,33 @@ __author__ = 'fabio'
 SUCCESS_RETCODES = (0, 997)
 
 
+def winerror(code):
+    """
+    Return the exception for a windows error code. Out of Windows, where ctypes.WinError is not
+    available (e.g. with a simulated driver), an OSError carrying the code is built instead.
+    """
+    if hasattr(ctypes, "WinError"):
+        return ctypes.WinError(code=code)
+    error = OSError(code, "Windows error {}".format(code))
+    error.winerror = code
+    return error
+
+
 def winerror_on_retcode(funct):
     """
-    This decorator throws WinError whenever the return code of last executed command is not 0 or 997
+    This decorator throws WinError whenever the return code of last executed command is not 0 or 997.
+    The decorated method's instance must provide the last error code through get_last_error().
+    Errors are counted in the statistics of the instance, if it has some enabled.
     """
 
     def wrapper(instance, *args, **kwargs):
         result = funct(instance, *args, **kwargs)
-        retcode = ctypes.GetLastError()
+        retcode = instance.get_last_error()
         if retcode not in SUCCESS_RETCODES:
-            raise ctypes.WinError(code=retcode)
+            stats = getattr(instance, "stats", None)
+            if stats is not None:
+                stats.count("errors")
+            raise winerror(retcode)
         return result
 
     return wrapper
@@ -28,11 +28,23 @@ Flag = enum(SNIFF=1, DROP=2)
 #Divert parameters.
 Param = enum(QUEUE_LEN=0,  # Packet queue length 1<default 512 <8192
              QUEUE_TIME=1,  # Packet queue time 32 < default 256 < 1024
-             MAX=1)
+             MAX=1)  # The highest parameter, as WINDIVERT_PARAM_MAX in windivert.h
+
+#Divert parameters (minimum, default, maximum), the time in milliseconds.
+PARAM_BOUNDS = {Param.QUEUE_LEN: (1, 512, 8192),
+                Param.QUEUE_TIME: (32, 256, 1024)}
 
 #Direction outbound/inbound
 Direction = enum(OUTBOUND=0, INBOUND=1)
 
+#TCP connection states, as tracked by pydivert.flows
+TcpState = enum(SYN_SENT=1,  # SYN seen from the client
+                SYN_RECEIVED=2,  # SYN/ACK seen from the server
+                ESTABLISHED=3,  # handshake completed, or connection picked up in the middle
+                FIN_WAIT=4,  # FIN seen from one side
+                TIME_WAIT=5,  # FIN seen from both sides
+                CLOSED=6)  # RST seen
+
 #Checksums
 HelperOption = enum(NO_IP_CHECKSUM=1,
                     NO_ICMP_CHECKSUM=2,
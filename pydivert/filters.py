@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The WinDivert filter language, in python.
+
+Filters are parsed into a tree of tuples:
+
+    ("const", True|False)
+    ("test", field, operator, value)     e.g. ("test", "tcp.dstport", "==", 80)
+    ("not", node)
+    ("and", (node, node, ...))
+    ("or", (node, node, ...))
+
+and compiled into a chain of closures reading the fields straight from the packet buffer.
+As the driver does, a test on a field of a layer the packet has not (e.g. tcp.DstPort on an
+UDP packet) is false. Field names and keywords are case insensitive.
+"""
+import operator
+import re
+import socket
+import struct
+
+from pydivert.enum import Direction
+from pydivert.models import DivertIpHeader, DivertIpv6Header, DivertIcmpHeader, DivertIcmpv6Header
+from pydivert.models import DivertTcpHeader, DivertUdpHeader, CapturedPacket
+from pydivert.parser import parse_layout
+from pydivert.winutils import packed_to_string, string_to_packed
+
+__author__ = 'fabio'
+
+OPERATORS = {"==": operator.eq,
+             "!=": operator.ne,
+             "<": operator.lt,
+             ">": operator.gt,
+             "<=": operator.le,
+             ">=": operator.ge}
+
+_layers = {DivertIpHeader: "ip",
+           DivertIpv6Header: "ipv6",
+           DivertIcmpHeader: "icmp",
+           DivertIcmpv6Header: "icmpv6",
+           DivertTcpHeader: "tcp",
+           DivertUdpHeader: "udp"}
+
+_tokens = re.compile(r"\s*(?:(==|!=|<=|>=|&&|\|\||[=<>!()])|([A-Za-z0-9_.:]+))")
+
+
+class FilterSyntaxError(ValueError):
+    """
+    Raised for filters that are not valid WinDivert filters
+    """
+
+    def __init__(self, message, text, position):
+        ValueError.__init__(self, "{} at position {}: {}".format(message, position, text))
+        self.text = text
+        self.position = position
+
+
+def locate_layers(raw_packet, layout=None):
+    """
+    Return a dictionary mapping the name of each layer found in the packet (ip, ipv6, icmp, icmpv6, tcp, udp)
+    to its offset. The payload offset is mapped to "payload".
+    """
+    if layout is None:
+        layout = parse_layout(raw_packet)
+    offsets = {"payload": 0}
+    for clazz, offset, length in layout:
+        offsets[_layers[clazz]] = offset
+        offsets["payload"] = offset + length
+    return offsets
+
+
+def _header_field(layer, fmt, offset, shift=0, mask=None):
+    unpack_from = struct.Struct("!" + fmt).unpack_from
+
+    def get(raw_packet, meta, offsets):
+        base = offsets.get(layer)
+        if base is None:
+            return None
+        value = unpack_from(raw_packet, base + offset)[0] >> shift
+        return value if mask is None else value & mask
+
+    return get
+
+
+def _ipv6_address_field(offset):
+    def get(raw_packet, meta, offsets):
+        base = offsets.get("ipv6")
+        if base is None:
+            return None
+        high, low = struct.unpack_from("!QQ", raw_packet, base + offset)
+        return high << 64 | low
+
+    return get
+
+
+def _payload_length_field(layer):
+    def get(raw_packet, meta, offsets):
+        if layer not in offsets:
+            return None
+        return len(raw_packet) - offsets["payload"]
+
+    return get
+
+
+def _layer_field(layer):
+    def get(raw_packet, meta, offsets):
+        return 1 if layer in offsets else 0
+
+    return get
+
+
+def _direction_field(direction):
+    def get(raw_packet, meta, offsets):
+        if meta is None:
+            return None
+        return 1 if meta.direction == direction else 0
+
+    return get
+
+
+def _iface_field(index):
+    def get(raw_packet, meta, offsets):
+        if meta is None:
+            return None
+        return meta.iface[index]
+
+    return get
+
+
+_fields = {"inbound": _direction_field(Direction.INBOUND),
+           "outbound": _direction_field(Direction.OUTBOUND),
+           "ifIdx": _iface_field(0),
+           "subIfIdx": _iface_field(1),
+           "ip": _layer_field("ip"),
+           "ipv6": _layer_field("ipv6"),
+           "icmp": _layer_field("icmp"),
+           "icmpv6": _layer_field("icmpv6"),
+           "tcp": _layer_field("tcp"),
+           "udp": _layer_field("udp"),
+           "ip.HdrLength": _header_field("ip", "B", 0, 0, 0x0F),
+           "ip.TOS": _header_field("ip", "B", 1),
+           "ip.Length": _header_field("ip", "H", 2),
+           "ip.Id": _header_field("ip", "H", 4),
+           "ip.DF": _header_field("ip", "H", 6, 14, 1),
+           "ip.MF": _header_field("ip", "H", 6, 13, 1),
+           "ip.FragOff": _header_field("ip", "H", 6, 0, 0x1FFF),
+           "ip.TTL": _header_field("ip", "B", 8),
+           "ip.Protocol": _header_field("ip", "B", 9),
+           "ip.Checksum": _header_field("ip", "H", 10),
+           "ip.SrcAddr": _header_field("ip", "I", 12),
+           "ip.DstAddr": _header_field("ip", "I", 16),
+           "ipv6.TrafficClass": _header_field("ipv6", "I", 0, 20, 0xFF),
+           "ipv6.FlowLabel": _header_field("ipv6", "I", 0, 0, 0xFFFFF),
+           "ipv6.Length": _header_field("ipv6", "H", 4),
+           "ipv6.NextHdr": _header_field("ipv6", "B", 6),
+           "ipv6.HopLimit": _header_field("ipv6", "B", 7),
+           "ipv6.SrcAddr": _ipv6_address_field(8),
+           "ipv6.DstAddr": _ipv6_address_field(24),
+           "icmp.Type": _header_field("icmp", "B", 0),
+           "icmp.Code": _header_field("icmp", "B", 1),
+           "icmp.Checksum": _header_field("icmp", "H", 2),
+           "icmp.Body": _header_field("icmp", "I", 4),
+           "icmpv6.Type": _header_field("icmpv6", "B", 0),
+           "icmpv6.Code": _header_field("icmpv6", "B", 1),
+           "icmpv6.Checksum": _header_field("icmpv6", "H", 2),
+           "icmpv6.Body": _header_field("icmpv6", "I", 4),
+           "tcp.SrcPort": _header_field("tcp", "H", 0),
+           "tcp.DstPort": _header_field("tcp", "H", 2),
+           "tcp.SeqNum": _header_field("tcp", "I", 4),
+           "tcp.AckNum": _header_field("tcp", "I", 8),
+           "tcp.HdrLength": _header_field("tcp", "B", 12, 4),
+           "tcp.Urg": _header_field("tcp", "B", 13, 5, 1),
+           "tcp.Ack": _header_field("tcp", "B", 13, 4, 1),
+           "tcp.Psh": _header_field("tcp", "B", 13, 3, 1),
+           "tcp.Rst": _header_field("tcp", "B", 13, 2, 1),
+           "tcp.Syn": _header_field("tcp", "B", 13, 1, 1),
+           "tcp.Fin": _header_field("tcp", "B", 13, 0, 1),
+           "tcp.Window": _header_field("tcp", "H", 14),
+           "tcp.Checksum": _header_field("tcp", "H", 16),
+           "tcp.UrgPtr": _header_field("tcp", "H", 18),
+           "tcp.PayloadLength": _payload_length_field("tcp"),
+           "udp.SrcPort": _header_field("udp", "H", 0),
+           "udp.DstPort": _header_field("udp", "H", 2),
+           "udp.Length": _header_field("udp", "H", 4),
+           "udp.Checksum": _header_field("udp", "H", 6),
+           "udp.PayloadLength": _payload_length_field("udp")}
+
+# Field readers and names as written in the WinDivert documentation, by lowercase name
+FIELDS = dict((name.lower(), get) for name, get in _fields.items())
+FIELD_NAMES = dict((name.lower(), name) for name in _fields)
+
+
+def parse_value(token):
+    """
+    Return the integer value of a literal: a decimal or hexadecimal number, an IPv4 or an IPv6 address.
+    Raise ValueError if the token is not a literal.
+    """
+    if ":" in token:
+        high, low = struct.unpack("!QQ", string_to_packed(socket.AF_INET6, token))
+        return high << 64 | low
+    if token.count(".") == 3:
+        return struct.unpack("!I", string_to_packed(socket.AF_INET, token))[0]
+    if token[:2].lower() == "0x":
+        return int(token[2:], 16)
+    if token.isdigit():
+        return int(token)
+    raise ValueError("Not a literal: {}".format(token))
+
+
+class _Parser(object):
+    """
+    Recursive descent parser of the filter grammar:
+
+        expr  := and (("or" | "||") and)*
+        and   := unary (("and" | "&&") unary)*
+        unary := ("not" | "!") unary | "(" expr ")" | "true" | "false" | field [op value]
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = _tokens.match(text, position)
+            if not match:
+                position += len(text[position:]) - len(text[position:].lstrip())
+                raise FilterSyntaxError("Unexpected character", self.text, position)
+            symbol, word = match.groups()
+            self.tokens.append((symbol or word.lower(), match.start(match.lastindex)))
+            position = match.end()
+        self.tokens.append((None, len(text)))
+        self.index = 0
+
+    def peek(self):
+        return self.tokens[self.index][0]
+
+    def next(self):
+        token, position = self.tokens[self.index]
+        self.index += 1
+        return token, position
+
+    def error(self, message):
+        raise FilterSyntaxError(message, self.text, self.tokens[self.index][1])
+
+    def parse(self):
+        if self.peek() is None:
+            self.error("Empty filter")
+        node = self.expr()
+        if self.peek() is not None:
+            self.error("Unexpected token {!r}".format(self.peek()))
+        return node
+
+    def expr(self):
+        nodes = [self.conjunction()]
+        while self.peek() in ("or", "||"):
+            self.next()
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else ("or", tuple(nodes))
+
+    def conjunction(self):
+        nodes = [self.unary()]
+        while self.peek() in ("and", "&&"):
+            self.next()
+            nodes.append(self.unary())
+        return nodes[0] if len(nodes) == 1 else ("and", tuple(nodes))
+
+    def unary(self):
+        token = self.peek()
+        if token in ("not", "!"):
+            self.next()
+            return "not", self.unary()
+        if token == "(":
+            self.next()
+            node = self.expr()
+            if self.peek() != ")":
+                self.error("Missing closing parenthesis")
+            self.next()
+            return node
+        if token in ("true", "false"):
+            self.next()
+            return "const", token == "true"
+        return self.test()
+
+    def test(self):
+        field = self.peek()
+        if field not in FIELDS:
+            self.error("Unknown field {!r}".format(field) if field else "Unexpected end of filter")
+        self.next()
+        op = self.peek()
+        if op not in OPERATORS and op != "=":
+            # A field alone is true when not zero
+            return "test", field, "!=", 0
+        self.next()
+        token = self.peek()
+        try:
+            value = parse_value(token or "")
+        except (ValueError, socket.error):
+            self.error("Expected a value, got {!r}".format(token) if token else "Unexpected end of filter")
+        self.next()
+        return "test", field, "==" if op == "=" else op, value
+
+
+def parse(text):
+    """
+    Parse a filter string into a tree (see the module documentation), or raise FilterSyntaxError
+    """
+    if isinstance(text, bytes):
+        text = text.decode("UTF-8")
+    return _Parser(text).parse()
+
+
+def format_value(field, value):
+    """
+    Return the literal for the value of a field: addresses are written as such, anything else in decimal
+    """
+    if field in ("ip.srcaddr", "ip.dstaddr"):
+        return packed_to_string(socket.AF_INET, struct.pack("!I", value))
+    if field in ("ipv6.srcaddr", "ipv6.dstaddr"):
+        return packed_to_string(socket.AF_INET6, struct.pack("!QQ", value >> 64, value & 0xFFFFFFFFFFFFFFFF))
+    return str(value)
+
+
+def to_string(node):
+    """
+    Return the filter string for a tree, the reverse of parse()
+    """
+    kind = node[0]
+    if kind == "const":
+        return "true" if node[1] else "false"
+    if kind == "test":
+        field, op, value = node[1:]
+        if op == "!=" and value == 0:
+            return FIELD_NAMES[field]
+        return "{} {} {}".format(FIELD_NAMES[field], op, format_value(field, value))
+    if kind == "not":
+        child = node[1]
+        text = to_string(child)
+        return "not ({})".format(text) if child[0] in ("and", "or") else "not {}".format(text)
+    texts = []
+    for child in node[1]:
+        text = to_string(child)
+        # Explicit, whatever the precedence of "and" over "or"
+        texts.append("({})".format(text) if child[0] in ("and", "or") else text)
+    return " {} ".format(kind).join(texts)
+
+
+def _compile(node):
+    """
+    Return a function(raw_packet, meta, offsets) evaluating the tree
+    """
+    kind = node[0]
+    if kind == "const":
+        value = node[1]
+        return lambda raw_packet, meta, offsets: value
+    if kind == "test":
+        get, compare, value = FIELDS[node[1]], OPERATORS[node[2]], node[3]
+
+        def test(raw_packet, meta, offsets):
+            field = get(raw_packet, meta, offsets)
+            return field is not None and compare(field, value)
+
+        return test
+    if kind == "not":
+        test = _compile(node[1])
+        return lambda raw_packet, meta, offsets: not test(raw_packet, meta, offsets)
+    tests = [_compile(child) for child in node[1]]
+    test = tests[0]
+    for other in tests[1:]:
+        test = _chain(kind, test, other)
+    return test
+
+
+def _chain(kind, first, second):
+    if kind == "and":
+        return lambda raw_packet, meta, offsets: first(raw_packet, meta, offsets) and second(raw_packet, meta, offsets)
+    return lambda raw_packet, meta, offsets: first(raw_packet, meta, offsets) or second(raw_packet, meta, offsets)
+
+
+class Filter(object):
+    """
+    A compiled filter, matching raw packets or high level ones.
+    Creating it raises FilterSyntaxError if the filter is not valid.
+    """
+
+    def __init__(self, text):
+        if isinstance(text, bytes):
+            text = text.decode("UTF-8")
+        self.text = text
+        self.tree = parse(text)
+        self._test = _compile(self.tree)
+
+    def match(self, raw_packet, meta=None):
+        """
+        Tell if a raw packet matches. Tests on direction and interfaces are false without meta.
+        """
+        return self._test(raw_packet, meta, locate_layers(raw_packet))
+
+    def match_packet(self, packet):
+        """
+        Tell if an high level packet matches, without parsing it again
+        """
+        raw = packet.raw_view()
+        return self._test(raw, packet.meta, locate_layers(raw, packet._layout))
+
+    def __call__(self, packet, meta=None):
+        if isinstance(packet, CapturedPacket):
+            return self.match_packet(packet)
+        return self.match(packet, meta)
+
+    def select(self, packets):
+        """
+        Yield the packets (high level ones or (raw_packet, meta) pairs) matching the filter
+        """
+        for packet in packets:
+            if isinstance(packet, CapturedPacket):
+                if self.match_packet(packet):
+                    yield packet
+            elif self.match(*packet):
+                yield packet
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "Filter({!r})".format(self.text)
+
+
+def compile_filter(text):
+    """
+    Return the compiled Filter for a filter string, or raise FilterSyntaxError
+    """
+    return Filter(text)
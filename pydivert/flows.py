@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Connection tracking over diverted packets.
+
+A FlowTable groups the packets of each flow, whatever their direction, tracks the state of TCP connections
+and counts the packets and bytes sent by each side:
+
+    flows = FlowTable(max_flows=1000000)
+    while True:
+        for packet in handle.receive_many():
+            flow = flows.update(packet.raw)
+            if flow is not None and flow.state == TcpState.ESTABLISHED:
+                ...
+
+Flows are keyed by a 5-tuple of integers read straight from the raw packets: nothing is parsed or formatted
+per packet. Idle flows expire after a timeout depending on their state (see TIMEOUTS), found with a timing
+wheel, and the least recently seen flows are evicted beyond max_flows.
+"""
+from collections import OrderedDict
+import heapq
+import socket
+import struct
+import time
+
+from pydivert.checksum import upper_layer
+from pydivert.enum import TcpState
+from pydivert.winutils import packed_to_string
+
+__author__ = 'fabio'
+
+_byte = struct.Struct("!B")
+_word = struct.Struct("!H")
+_ports = struct.Struct("!HH")
+_ipv4 = struct.Struct("!I")
+_ipv6 = struct.Struct("!QQ")
+
+# IPv4 addresses are mapped into the IPv6 space (::ffff:a.b.c.d), so that they never clash with IPv6 ones
+_IPV4_MAPPED = 0xFFFF << 32
+
+TCP_FIN, TCP_SYN, TCP_RST, TCP_ACK = 0x01, 0x02, 0x04, 0x10
+
+# Idle timeouts in seconds by TCP state, None being the one of the other protocols
+TIMEOUTS = {TcpState.SYN_SENT: 30,
+            TcpState.SYN_RECEIVED: 30,
+            TcpState.ESTABLISHED: 3600,
+            TcpState.FIN_WAIT: 120,
+            TcpState.TIME_WAIT: 60,
+            TcpState.CLOSED: 10,
+            None: 60}
+
+
+def _endpoints(raw_packet, fragment_ports=True):
+    """
+    Return (protocol, src_addr, src_port, dst_addr, dst_port, transport_offset) of a raw packet, None if it
+    is not IP. Ports are 0 unless the packet carries a TCP or UDP header. If fragment_ports is false, they are
+    0 for the first fragment of a datagram too, so that all its fragments have the same endpoints.
+    """
+    length = len(raw_packet)
+    first = _byte.unpack_from(raw_packet)[0] if length else 0
+    if first >> 4 == 4 and length >= 20:
+        protocol = _byte.unpack_from(raw_packet, 9)[0]
+        src_addr = _IPV4_MAPPED | _ipv4.unpack_from(raw_packet, 12)[0]
+        dst_addr = _IPV4_MAPPED | _ipv4.unpack_from(raw_packet, 16)[0]
+        transport = (first & 0x0F) * 4
+        if _word.unpack_from(raw_packet, 6)[0] & (0x1FFF if fragment_ports else 0x3FFF):
+            # Not the first fragment: no transport header
+            return protocol, src_addr, 0, dst_addr, 0, transport
+    elif first >> 4 == 6 and length >= 40:
+        protocol, transport, fragment = upper_layer(raw_packet, length)
+        high, low = _ipv6.unpack_from(raw_packet, 8)
+        src_addr = high << 64 | low
+        high, low = _ipv6.unpack_from(raw_packet, 24)
+        dst_addr = high << 64 | low
+        if fragment & (0xFFF8 if fragment_ports else 0xFFF9):
+            return protocol, src_addr, 0, dst_addr, 0, transport
+    else:
+        return None
+    if protocol in (6, 17) and length >= transport + 4:
+        src_port, dst_port = _ports.unpack_from(raw_packet, transport)
+        return protocol, src_addr, src_port, dst_addr, dst_port, transport
+    return protocol, src_addr, 0, dst_addr, 0, transport
+
+
+def flow_key(raw_packet):
+    """
+    Return the key of the flow of a raw packet, the same for both directions:
+    (protocol, addr, port, other_addr, other_port), the lowest endpoint first. None if the packet is not IP.
+    """
+    endpoints = _endpoints(raw_packet)
+    if endpoints is None:
+        return None
+    protocol, src_addr, src_port, dst_addr, dst_port, _ = endpoints
+    if src_addr < dst_addr or src_addr == dst_addr and src_port <= dst_port:
+        return protocol, src_addr, src_port, dst_addr, dst_port
+    return protocol, dst_addr, dst_port, src_addr, src_port
+
+
+def address_to_string(address):
+    """
+    Return the string form of an address of a flow key
+    """
+    if address >> 32 == 0xFFFF:
+        return packed_to_string(socket.AF_INET, _ipv4.pack(address & 0xFFFFFFFF))
+    return packed_to_string(socket.AF_INET6, _ipv6.pack(address >> 64, address & 0xFFFFFFFFFFFFFFFF))
+
+
+class Flow(object):
+    """
+    A tracked flow. The client is the side which has sent the first packet, or the SYN of a TCP connection.
+    state is one of TcpState for TCP, None otherwise. data is free for the application to use.
+    """
+    __slots__ = ("key", "protocol", "client_addr", "client_port", "server_addr", "server_port", "state",
+                 "first_seen", "last_seen", "client_packets", "client_bytes", "server_packets", "server_bytes",
+                 "data", "_deadline", "_tick", "_fins")
+
+    def __init__(self, key, protocol, client_addr, client_port, server_addr, server_port, state, now):
+        self.key = key
+        self.protocol = protocol
+        self.client_addr, self.client_port = client_addr, client_port
+        self.server_addr, self.server_port = server_addr, server_port
+        self.state = state
+        self.first_seen = self.last_seen = now
+        self.client_packets = self.client_bytes = self.server_packets = self.server_bytes = 0
+        self.data = None
+        self._deadline = now
+        self._tick = None
+        self._fins = 0
+
+    @property
+    def packets(self):
+        return self.client_packets + self.server_packets
+
+    @property
+    def bytes(self):
+        return self.client_bytes + self.server_bytes
+
+    @property
+    def client(self):
+        """
+        The (address, port) of the client, the address as a string
+        """
+        return address_to_string(self.client_addr), self.client_port
+
+    @property
+    def server(self):
+        """
+        The (address, port) of the server, the address as a string
+        """
+        return address_to_string(self.server_addr), self.server_port
+
+    def __repr__(self):
+        return "Flow(protocol={}, client={}, server={}, state={}, packets={}, bytes={})".format(
+            self.protocol, self.client, self.server, self.state, self.packets, self.bytes)
+
+
+class FlowTable(object):
+    """
+    Tracks the flows of the packets given to update().
+
+    A flow expires once it has been idle for the timeout of its state: timeouts overrides some of TIMEOUTS.
+    Expired flows are found, every resolution seconds at most, on the next update() or expire() call.
+    Beyond max_flows, the least recently seen flow is evicted. on_expire(flow) is called for both, and for the
+    closed flows replaced by a new connection reusing their endpoints.
+    Times come from clock() unless given explicitly.
+    """
+
+    def __init__(self, max_flows=1000000, timeouts=None, resolution=1.0, clock=time.time, on_expire=None):
+        self.max_flows = max_flows
+        self.timeouts = dict(TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.resolution = resolution
+        self.clock = clock
+        self.on_expire = on_expire
+        self.counters = {"created": 0, "expired": 0, "evicted": 0}
+        self._flows = OrderedDict()
+        self._touch = self._flows.move_to_end
+        # The timing wheel: flows by the tick they are due at, and an heap of these ticks.
+        # A flow is only in the wheel once, unless its entries are stale: of a flow since removed or rescheduled
+        self._wheel = {}
+        self._ticks = []
+        self._stale = 0
+        self._next_expiry = float("inf")
+
+    def __len__(self):
+        return len(self._flows)
+
+    def __contains__(self, key):
+        return key in self._flows
+
+    def __iter__(self):
+        """
+        Iterates over the flows, from the least recently seen
+        """
+        return iter(list(self._flows.values()))
+
+    def get(self, key, default=None):
+        return self._flows.get(key, default)
+
+    def update(self, raw_packet, now=None):
+        """
+        Accounts a packet (raw or a CapturedPacket) to its flow, creating it if needed, and return the flow.
+        None is returned for packets which are not IP.
+        """
+        if hasattr(raw_packet, "raw_view"):
+            raw_packet = raw_packet.raw_view()
+        endpoints = _endpoints(raw_packet)
+        if endpoints is None:
+            return None
+        if now is None:
+            now = self.clock()
+        if now >= self._next_expiry:
+            self.expire(now)
+
+        protocol, src_addr, src_port, dst_addr, dst_port, transport = endpoints
+        if src_addr < dst_addr or src_addr == dst_addr and src_port <= dst_port:
+            key = protocol, src_addr, src_port, dst_addr, dst_port
+        else:
+            key = protocol, dst_addr, dst_port, src_addr, src_port
+        flags = 0
+        if protocol == 6 and src_port | dst_port and len(raw_packet) >= transport + 14:
+            flags = _byte.unpack_from(raw_packet, transport + 13)[0]
+
+        flow = self._flows.get(key)
+        if flow is not None and flags & (TCP_SYN | TCP_ACK) == TCP_SYN and flow.state in (TcpState.TIME_WAIT,
+                                                                                           TcpState.CLOSED):
+            # A new connection reusing the endpoints of a closed one
+            self._discard(flow)
+            self._stale += 1
+            if self.on_expire is not None:
+                self.on_expire(flow)
+            flow = None
+        if flow is None:
+            if len(self._flows) >= self.max_flows:
+                self._evict()
+            if flags & (TCP_SYN | TCP_ACK) == TCP_SYN | TCP_ACK:
+                # The reply to a SYN we have not seen: the destination is the client
+                flow = Flow(key, protocol, dst_addr, dst_port, src_addr, src_port, TcpState.SYN_SENT, now)
+            elif protocol == 6 and src_port | dst_port:
+                flow = Flow(key, protocol, src_addr, src_port, dst_addr, dst_port,
+                            TcpState.SYN_SENT if flags & TCP_SYN else TcpState.ESTABLISHED, now)
+            else:
+                flow = Flow(key, protocol, src_addr, src_port, dst_addr, dst_port, None, now)
+            self._flows[key] = flow
+            self.counters["created"] += 1
+        else:
+            self._touch(key)
+
+        from_client = src_port == flow.client_port and src_addr == flow.client_addr
+        if from_client:
+            flow.client_packets += 1
+            flow.client_bytes += len(raw_packet)
+        else:
+            flow.server_packets += 1
+            flow.server_bytes += len(raw_packet)
+        flow.last_seen = now
+        if flow.state is not None:
+            self._track(flow, flags, from_client)
+
+        flow._deadline = now + self.timeouts[flow.state]
+        tick = int(flow._deadline / self.resolution) + 1
+        if flow._tick is None:
+            self._schedule(flow, tick)
+        elif tick < flow._tick:
+            # The timeout has shortened with the state
+            self._stale += 1
+            self._schedule(flow, tick)
+        return flow
+
+    @staticmethod
+    def _track(flow, flags, from_client):
+        """
+        Updates the state of a TCP flow with the flags of one of its packets
+        """
+        state = flow.state
+        if flags & TCP_RST:
+            flow.state = TcpState.CLOSED
+        elif state == TcpState.CLOSED:
+            return
+        elif flags & TCP_SYN:
+            if flags & TCP_ACK and not from_client and state == TcpState.SYN_SENT:
+                flow.state = TcpState.SYN_RECEIVED
+        elif flags & TCP_FIN:
+            flow._fins |= 1 if from_client else 2
+            flow.state = TcpState.TIME_WAIT if flow._fins == 3 else TcpState.FIN_WAIT
+        elif flags & TCP_ACK and from_client and state == TcpState.SYN_RECEIVED:
+            flow.state = TcpState.ESTABLISHED
+
+    def expire(self, now=None):
+        """
+        Removes the flows idle for longer than their timeout and return them
+        """
+        if now is None:
+            now = self.clock()
+        current = int(now / self.resolution)
+        expired = []
+        ticks, wheel = self._ticks, self._wheel
+        while ticks and ticks[0] <= current:
+            tick = heapq.heappop(ticks)
+            for flow in wheel.pop(tick):
+                if flow._tick != tick:
+                    self._stale -= 1
+                elif flow._deadline <= now:
+                    self._discard(flow)
+                    expired.append(flow)
+                else:
+                    # Seen since it has been scheduled
+                    self._schedule(flow, int(flow._deadline / self.resolution) + 1)
+        self._next_expiry = ticks[0] * self.resolution if ticks else float("inf")
+        self.counters["expired"] += len(expired)
+        if self.on_expire is not None:
+            for flow in expired:
+                self.on_expire(flow)
+        self._compact()
+        return expired
+
+    def _schedule(self, flow, tick):
+        flow._tick = tick
+        flows = self._wheel.get(tick)
+        if flows is None:
+            self._wheel[tick] = flows = []
+            heapq.heappush(self._ticks, tick)
+            self._next_expiry = self._ticks[0] * self.resolution
+        flows.append(flow)
+
+    def _discard(self, flow):
+        del self._flows[flow.key]
+        flow._tick = None
+
+    def _evict(self):
+        key, flow = self._flows.popitem(last=False)
+        flow._tick = None
+        self._stale += 1
+        self.counters["evicted"] += 1
+        if self.on_expire is not None:
+            self.on_expire(flow)
+        self._compact()
+
+    def _compact(self):
+        """
+        Rebuilds the wheel once it holds more stale entries than flows, so that its size stays bounded
+        """
+        if self._stale <= len(self._flows) + 1024:
+            return
+        self._wheel, self._ticks, self._stale = {}, [], 0
+        self._next_expiry = float("inf")
+        for flow in self._flows.values():
+            self._schedule(flow, flow._tick)
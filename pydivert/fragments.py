@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+IPv4 and IPv6 fragmentation and reassembly.
+
+A Defragmenter is fed diverted packets and holds the fragments of each datagram until all of them have arrived,
+so that handlers only see whole datagrams. fragment_packet() does the opposite before sending, splitting the
+packets which have grown beyond the MTU:
+
+    defragmenter = Defragmenter()
+    while True:
+        for packet in handle.receive_many():
+            packet = defragmenter.feed(packet)
+            if packet is not None:
+                ...  # modify the datagram
+                handle.send_many(fragment_packet(packet, mtu=1500))
+
+Incomplete datagrams are dropped after a timeout, and the oldest ones beyond max_datagrams or max_bytes.
+"""
+import bisect
+from collections import OrderedDict
+import itertools
+import random
+import struct
+import time
+
+from pydivert.checksum import internet_checksum, IPV6_OPTIONS, IPPROTO_FRAGMENT
+from pydivert.models import CapturedPacket
+from pydivert.parser import parse_packet
+
+__author__ = 'fabio'
+
+_byte = struct.Struct("!B")
+_word = struct.Struct("!H")
+# Next header, reserved, fragment offset and flags, identification
+_ipv6_fragment = struct.Struct("!BBHI")
+
+IPV4_MORE_FRAGMENTS = 0x2000
+IPV4_DONT_FRAGMENT = 0x4000
+IPV4_OFFSET_MASK = 0x1FFF
+IPV6_MORE_FRAGMENTS = 0x0001
+IPV6_OFFSET_MASK = 0xFFF8
+
+MAX_DATAGRAM_LEN = 65535
+
+# Identifications of the IPv6 fragments built here
+_identifications = itertools.count(random.getrandbits(32))
+
+
+def _ipv6_unfragmentable(raw_packet, length):
+    """
+    Return the length of the part of an IPv6 packet repeated in each fragment (the header, the hop-by-hop options
+    and the extension headers up to the routing header) and the offset of the next header field pointing past it
+    """
+    protocol = _byte.unpack_from(raw_packet, 6)[0]
+    offset = end = 40
+    next_header = 6
+    while protocol in IPV6_OPTIONS and offset + 8 <= length:
+        position, current = offset, protocol
+        protocol = _byte.unpack_from(raw_packet, offset)[0]
+        offset += (_byte.unpack_from(raw_packet, offset + 1)[0] + 1) * 8
+        if current != 60:
+            # Destination options are only unfragmentable before a routing header
+            end, next_header = offset, position
+    return end, next_header
+
+
+def _fragment_info(raw_packet):
+    """
+    Return (key, offset, more fragments, header length, data end) for a fragment, None for anything else.
+    For IPv6, the header length includes the fragment header.
+    """
+    length = len(raw_packet)
+    if length < 20:
+        return None
+    version = _byte.unpack_from(raw_packet)[0] >> 4
+    if version == 4:
+        header_len = (_byte.unpack_from(raw_packet)[0] & 0x0F) * 4
+        flags = _word.unpack_from(raw_packet, 6)[0]
+        if not flags & (IPV4_MORE_FRAGMENTS | IPV4_OFFSET_MASK) or header_len < 20:
+            return None
+        key = (4, bytes(raw_packet[12:20]), _word.unpack_from(raw_packet, 4)[0], _byte.unpack_from(raw_packet, 9)[0])
+        end = min(_word.unpack_from(raw_packet, 2)[0], length)
+        return key, (flags & IPV4_OFFSET_MASK) * 8, flags & IPV4_MORE_FRAGMENTS, header_len, end
+    if version == 6 and length >= 48:
+        header_len, next_header = _ipv6_unfragmentable(raw_packet, length)
+        if header_len + 8 > length or _byte.unpack_from(raw_packet, next_header)[0] != IPPROTO_FRAGMENT:
+            return None
+        _, _, flags, identification = _ipv6_fragment.unpack_from(raw_packet, header_len)
+        key = (6, bytes(raw_packet[8:40]), identification)
+        end = min(_word.unpack_from(raw_packet, 4)[0] + 40, length)
+        return key, flags & IPV6_OFFSET_MASK, flags & IPV6_MORE_FRAGMENTS, header_len + 8, end
+    return None
+
+
+class _Datagram(object):
+    """
+    The fragments of a datagram received so far, sorted by offset
+    """
+    __slots__ = ("header", "offsets", "fragments", "size", "total", "deadline")
+
+    def __init__(self, deadline):
+        # The headers of the first fragment
+        self.header = None
+        self.offsets = []
+        self.fragments = []
+        self.size = 0
+        # The length of the data, known once the last fragment is received
+        self.total = None
+        self.deadline = deadline
+
+
+class Defragmenter(object):
+    """
+    Reassembles the IPv4 and IPv6 datagrams of the fragments given to feed().
+
+    At most max_datagrams datagrams and max_bytes of fragment data are held, the oldest datagrams being dropped
+    beyond. Datagrams not complete timeout seconds after their first fragment was received are dropped as well.
+    Overlapping fragments drop the whole datagram (RFC 5722).
+    """
+
+    def __init__(self, max_datagrams=1024, max_bytes=4 * 1024 * 1024, timeout=30.0, clock=time.time):
+        self.max_datagrams = max_datagrams
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.clock = clock
+        self.datagrams = OrderedDict()
+        self.buffered = 0
+        # Datagrams reassembled, dropped on timeout, dropped for lack of room, dropped as malformed
+        self.counters = {"reassembled": 0, "expired": 0, "evicted": 0, "malformed": 0}
+
+    def __len__(self):
+        return len(self.datagrams)
+
+    def feed(self, packet, now=None):
+        """
+        Accounts a packet (a CapturedPacket or a raw packet). Return it as it is if it is not a fragment, the
+        reassembled datagram if it was the last missing fragment, None otherwise. The datagram is a CapturedPacket
+        holding the metadata of the last fragment if a CapturedPacket was given, a bytearray otherwise.
+
+        Fragments are copied, so raw packets may be reused afterwards.
+        """
+        raw = packet.raw_view() if isinstance(packet, CapturedPacket) else packet
+        info = _fragment_info(raw)
+        if info is None:
+            return packet
+        if now is None:
+            now = self.clock()
+        self.expire(now)
+        key, offset, more, header_len, end = info
+        data = bytes(raw[header_len:end])
+        size = len(data)
+        datagram = self.datagrams.get(key)
+        if datagram is None:
+            datagram = self.datagrams[key] = _Datagram(now + self.timeout)
+
+        if (more and size % 8) or offset + size + header_len > MAX_DATAGRAM_LEN or not self._add(
+                datagram, offset, more, data):
+            self._drop(key, "malformed")
+            return None
+        if offset == 0:
+            datagram.header = bytearray(raw[:header_len])
+        if datagram.size != datagram.total or datagram.header is None:
+            while self.buffered > self.max_bytes or len(self.datagrams) > self.max_datagrams:
+                self._drop(next(iter(self.datagrams)), "evicted")
+            return None
+
+        self._drop(key)
+        self.counters["reassembled"] += 1
+        result = self._reassemble(key[0], datagram)
+        if isinstance(packet, CapturedPacket):
+            return parse_packet(result, packet.meta)
+        return result
+
+    def _add(self, datagram, offset, more, data):
+        """
+        Insert a fragment, return False if it is inconsistent with the others
+        """
+        size = len(data)
+        if not more:
+            if datagram.total is not None and datagram.total != offset + size:
+                return False
+            datagram.total = offset + size
+        if datagram.total is not None and offset + size > datagram.total:
+            return False
+        index = bisect.bisect_left(datagram.offsets, offset)
+        if index < len(datagram.offsets) and datagram.offsets[index] == offset:
+            # The same fragment again
+            return len(datagram.fragments[index]) == size
+        if index and datagram.offsets[index - 1] + len(datagram.fragments[index - 1]) > offset:
+            return False
+        if index < len(datagram.offsets) and offset + size > datagram.offsets[index]:
+            return False
+        datagram.offsets.insert(index, offset)
+        datagram.fragments.insert(index, data)
+        datagram.size += size
+        self.buffered += size
+        return True
+
+    def _reassemble(self, version, datagram):
+        header = datagram.header
+        if version == 4:
+            result = header + b"".join(datagram.fragments)
+            _word.pack_into(result, 2, len(result))
+            _word.pack_into(result, 6, 0)
+            _word.pack_into(result, 10, 0)
+            _word.pack_into(result, 10, internet_checksum(memoryview(result)[:len(header)]))
+        else:
+            # Remove the fragment header, the header before it now points to the upper layer
+            header_len, next_header = _ipv6_unfragmentable(header, len(header))
+            result = header[:header_len] + b"".join(datagram.fragments)
+            result[next_header] = header[header_len]
+            _word.pack_into(result, 4, len(result) - 40)
+        return result
+
+    def _drop(self, key, reason=None):
+        datagram = self.datagrams.pop(key)
+        self.buffered -= datagram.size
+        if reason is not None:
+            self.counters[reason] += 1
+
+    def expire(self, now=None):
+        """
+        Drop the datagrams not reassembled in time. Return the number of datagrams dropped.
+        """
+        if now is None:
+            now = self.clock()
+        count = 0
+        # Datagrams are kept in the order they were started, hence of their deadlines
+        while self.datagrams:
+            key, datagram = next(iter(self.datagrams.items()))
+            if datagram.deadline > now:
+                break
+            self._drop(key, "expired")
+            count += 1
+        return count
+
+
+def fragment(raw_packet, mtu=1500):
+    """
+    Split an IPv4 or IPv6 packet into fragments of at most mtu bytes. Return the list of fragments, bytearrays,
+    or a list holding just the packet if it already fits.
+
+    IPv4 packets are split whatever their "don't fragment" flag, which is cleared: the packet being too large is
+    a local matter, usually due to changes made to it. Only the options to be copied are repeated past the first
+    fragment. IPv6 packets get a fragment header after their unfragmentable part. The checksums of the packet
+    must be up to date beforehand: transport checksums cover the whole datagram.
+    """
+    length = len(raw_packet)
+    if length <= mtu:
+        return [raw_packet]
+    version = _byte.unpack_from(raw_packet)[0] >> 4
+    if version == 4:
+        return _fragment_ipv4(raw_packet, mtu)
+    if version == 6 and length >= 40:
+        return _fragment_ipv6(raw_packet, mtu)
+    raise ValueError("Not an IPv4 or IPv6 packet")
+
+
+def _split(data_len, first, other):
+    """
+    Yield the (offset, length) of the fragments of data_len bytes, given the room in the first and later ones
+    """
+    room = first
+    offset = 0
+    while offset < data_len:
+        size = min(room // 8 * 8, data_len - offset)
+        if size <= 0:
+            raise ValueError("MTU too small to fragment the packet")
+        yield offset, size
+        offset += size
+        room = other
+
+
+def _fragment_ipv4(raw_packet, mtu):
+    header_len = (_byte.unpack_from(raw_packet)[0] & 0x0F) * 4
+    end = min(_word.unpack_from(raw_packet, 2)[0], len(raw_packet))
+    flags = _word.unpack_from(raw_packet, 6)[0]
+    base, more = (flags & IPV4_OFFSET_MASK) * 8, flags & IPV4_MORE_FRAGMENTS
+
+    # Options with the copied flag only, padded with end of options
+    options, position = bytearray(), 20
+    while position < header_len:
+        option = _byte.unpack_from(raw_packet, position)[0]
+        if option == 0:
+            break
+        if option == 1:
+            position += 1
+            continue
+        option_len = _byte.unpack_from(raw_packet, position + 1)[0] if position + 1 < header_len else 0
+        if option_len < 2:
+            break
+        if option & 0x80:
+            options += raw_packet[position:position + option_len]
+        position += option_len
+    options += b"\x00" * (-len(options) % 4)
+    first_header = bytearray(raw_packet[:header_len])
+    other_header = bytearray(raw_packet[:20]) + options
+    other_header[0] = 0x40 | len(other_header) // 4
+
+    data = memoryview(raw_packet)[header_len:end]
+    fragments = []
+    for offset, size in _split(len(data), mtu - header_len, mtu - len(other_header)):
+        result = (other_header if offset else first_header) + data[offset:offset + size]
+        last = offset + size == len(data)
+        _word.pack_into(result, 2, len(result))
+        _word.pack_into(result, 6, (base + offset) // 8 | (more if last else IPV4_MORE_FRAGMENTS))
+        _word.pack_into(result, 10, 0)
+        _word.pack_into(result, 10, internet_checksum(memoryview(result)[:len(result) - size]))
+        fragments.append(result)
+    return fragments
+
+
+def _fragment_ipv6(raw_packet, mtu):
+    length = min(_word.unpack_from(raw_packet, 4)[0] + 40, len(raw_packet))
+    header_len, next_header = _ipv6_unfragmentable(raw_packet, length)
+    protocol = _byte.unpack_from(raw_packet, next_header)[0]
+    if protocol == IPPROTO_FRAGMENT and header_len + 8 <= length:
+        # Already a fragment: split it further
+        protocol, _, flags, identification = _ipv6_fragment.unpack_from(raw_packet, header_len)
+        base, more = flags & IPV6_OFFSET_MASK, flags & IPV6_MORE_FRAGMENTS
+        start = header_len + 8
+    else:
+        identification = next(_identifications) & 0xFFFFFFFF
+        base, more = 0, 0
+        start = header_len
+
+    header = bytearray(raw_packet[:header_len])
+    header[next_header] = IPPROTO_FRAGMENT
+    data = memoryview(raw_packet)[start:length]
+    room = mtu - header_len - _ipv6_fragment.size
+    fragments = []
+    for offset, size in _split(len(data), room, room):
+        last = offset + size == len(data)
+        result = header + _ipv6_fragment.pack(protocol, 0, base + offset | (more if last else IPV6_MORE_FRAGMENTS),
+                                              identification) + data[offset:offset + size]
+        _word.pack_into(result, 4, len(result) - 40)
+        fragments.append(result)
+    return fragments
+
+
+def fragment_packet(packet, mtu=1500):
+    """
+    Update the checksums of a CapturedPacket and split it into fragments of at most mtu bytes. Return a list of
+    (raw packet, meta) pairs, to be given to Handle.send_many().
+    """
+    if not packet.refresh_checksums():
+        packet.update_checksums()
+    return [(raw, packet.meta) for raw in fragment(packet.raw, mtu)]
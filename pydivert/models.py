@@ -13,13 +13,16 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from binascii import unhexlify, hexlify
+from binascii import hexlify
 import socket
 import ctypes
+import struct
 
 from pydivert import enum
+from pydivert.checksum import incremental_update, update_checksums
 from pydivert.enum import Direction
-from pydivert.winutils import string_to_addr, addr_to_string
+from pydivert.flows import flow_key
+from pydivert.winutils import packed_to_string, string_to_packed
 
 
 __author__ = 'fabio'
@@ -245,47 +248,138 @@ headers_map = {"ipv4_hdr": DivertIpHeader,
                "icmpv6_hdr": DivertIcmpv6Header}
 
 
+class _Field(object):
+    """
+    A descriptor delegating a field of a HeaderWrapper to the wrapped header.
+    start and end delimit the 16 bit words holding the field, relative to the start of the header.
+    """
+    __slots__ = ("name", "start", "end")
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return getattr(instance._hdr, self.name)
+
+    def __set__(self, instance, value):
+        packet = instance._packet
+        if packet is None:
+            setattr(instance._hdr, self.name, value)
+            return
+        start = instance._offset + self.start
+        old = bytes(packet._buffer[start:instance._offset + self.end])
+        setattr(instance._hdr, self.name, value)
+        packet._changed(start, old)
+
+
+def _field(clazz, field):
+    """
+    Return the _Field for a (name, type[, bits]) entry of the _fields_ of a header class
+    """
+    offset = getattr(clazz, field[0]).offset
+    return _Field(field[0], offset & ~1, (offset + ctypes.sizeof(field[1]) + 1) & ~1)
+
+
+# HeaderWrapper subclasses by header class, with a _Field for each field of the header
+_wrappers = {}
+
+
+def _wrapper_class(clazz):
+    wrapper = _wrappers.get(clazz)
+    if wrapper is None:
+        attributes = dict((field[0], _field(clazz, field)) for field in getattr(clazz, "_fields_", ()))
+        attributes.update(__slots__=(), type=None)
+        for name, header_class in headers_map.items():
+            if header_class is clazz:
+                attributes["type"] = name.split("_")[0]
+        wrapper = _wrappers[clazz] = type(clazz.__name__ + "Wrapper", (HeaderWrapper,), attributes)
+    return wrapper
+
+
 class HeaderWrapper(object):
     """
     Since there's no "Options" field in the header structs, we use this wrapper
     to carry the "Options" field if available.
 
     Any field requested to an instance of this class is delegated to the original
-    header, except the "Options" one.
+    header, except the "Options" one. Instances are of a subclass generated for each header class,
+    with a descriptor for each of its fields, so no lookup happens at access time.
+
+    A wrapper may be bound to the buffer of a CapturedPacket: in that case hdr is a ctypes view
+    (from_buffer) over the wire bytes, at offset in the packet, and setting a field writes straight into
+    the packet, which updates its checksums accordingly.
     """
+    __slots__ = ("_hdr", "opts", "_view", "_packet", "_offset")
 
-    def __init__(self, hdr, opts=''):
-        self.hdr, self.opts = hdr, opts
+    def __new__(cls, hdr, opts=b'', view=None, packet=None, offset=0):
+        if cls is HeaderWrapper:
+            cls = _wrapper_class(type(hdr))
+        return super(HeaderWrapper, cls).__new__(cls)
 
-        for name, clazz in headers_map.items():
-            if isinstance(hdr, clazz):
-                self.type = name.split("_")[0]
+    def __init__(self, hdr, opts=b'', view=None, packet=None, offset=0):
+        self._hdr = hdr
+        self.opts = opts
+        self._view = view
+        self._packet = packet
+        self._offset = offset
 
-    def __getattr__(self, item):
-        if item != "hdr" and hasattr(self.hdr, item):
-            return getattr(self.hdr, item)
-        elif item == "Options":
-            return self.opts if self.opts else ''
+    @property
+    def hdr(self):
+        return self._hdr
+
+    @hdr.setter
+    def hdr(self, value):
+        if type(value) is not type(self._hdr):
+            raise TypeError("Expected a %s header, got %s" % (type(self._hdr).__name__, type(value).__name__))
+        if self._view is not None:
+            # Copy the new header over the wire bytes instead of replacing the view
+            size = ctypes.sizeof(self._hdr)
+            old = self._view[:size].tobytes()
+            ctypes.memmove(ctypes.addressof(self._hdr), ctypes.addressof(value), size)
+            if self._packet is not None:
+                self._packet._changed(self._offset, old)
         else:
-            return super(HeaderWrapper, self).__getattribute__(item)
+            self._hdr = value
 
-    def __setattr__(self, key, value):
-        if key != "hdr" and hasattr(self.hdr, key):
-            setattr(self.hdr, key, value)
-        elif key == "Options":
-            self.opts = value if value else ''
+    @property
+    def Options(self):
+        return bytes(self.opts) if self.opts else ''
+
+    @Options.setter
+    def Options(self, value):
+        if self._view is not None:
+            value = value if value else b''
+            if len(value) != len(self.opts):
+                raise ValueError("Options of a captured packet can't change length "
+                                 "(from {} to {} bytes)".format(len(self.opts), len(value)))
+            old = self.opts.tobytes()
+            self.opts[:] = value
+            if self._packet is not None:
+                self._packet._changed(self._offset + ctypes.sizeof(self._hdr), old)
         else:
-            return super(HeaderWrapper, self).__setattr__(key, value)
+            self.opts = value if value else ''
 
-    @property
-    def raw(self):
-        hexed = hexlify(self.hdr)
+    def tobytes(self):
+        """
+        Return the header as it is on the wire, options included
+        """
+        if self._view is not None:
+            return self._view.tobytes()
+        data = ctypes.string_at(ctypes.addressof(self.hdr), ctypes.sizeof(self.hdr))
         if self.opts:
-            hexed += hexlify(self.opts)
+            data += bytes(self.opts)
         hdr_len = getattr(self, "HdrLength", 0) * 4
-        if (len(hexed) / 2) < hdr_len:
-            hexed += b"00" * (hdr_len - len(hexed) / 2)
-        return hexed
+        if len(data) < hdr_len:
+            data += b"\x00" * (hdr_len - len(data))
+        return data
+
+    @property
+    def raw(self):
+        return hexlify(self._view if self._view is not None else self.tobytes())
 
     def __repr__(self):
         return self.raw.decode("UTF-8")
@@ -296,10 +390,78 @@ class HeaderWrapper(object):
                                                    hexlify(self.opts) if self.opts else '')
 
 
+_word = struct.Struct("!H")
+_ports = struct.Struct("!HH")
+_ipv4 = struct.Struct("!I")
+_ipv6 = struct.Struct("!QQ")
+
+IPV6_HEADER_LEN = 40
+
+# Where the source address is, relative to the start of each IP header, and the address size
+_address_offsets = {DivertIpHeader: (12, 4),
+                    DivertIpv6Header: (8, 16)}
+
+# Where the checksum is, relative to the start of each transport header
+_checksum_offsets = {DivertTcpHeader: 16,
+                     DivertUdpHeader: 6,
+                     DivertIcmpHeader: 2,
+                     DivertIcmpv6Header: 2}
+
+
+def _changed_words(old, new):
+    """
+    Return a list of (offset, old word, new word) for each 16 bit word differing between two short buffers
+    """
+    count = len(old) // 2
+    fmt = "!%dH" % count
+    old_words, new_words = struct.unpack_from(fmt, old), struct.unpack_from(fmt, new)
+    return [(index * 2, old_words[index], new_words[index])
+            for index in range(count) if old_words[index] != new_words[index]]
+
+
+def _append(diff, old, new):
+    diff[0].append(old)
+    diff[1].append(new)
+
+
+# Kinds of checksums, as far as their zero value is concerned
+_PLAIN, _UDP, _UDP_IPV4 = 0, 1, 2
+
+
+def _update_checksum(buffer, offset, old_words, new_words, kind=_PLAIN):
+    """
+    Incrementally update the checksum stored at offset after the words it covers changed from old_words
+    to new_words. A zero UDP checksum over IPv4 means no checksum at all and is left alone.
+    """
+    checksum = _word.unpack_from(buffer, offset)[0]
+    if kind == _UDP_IPV4 and not checksum:
+        return
+    checksum = incremental_update(checksum, old_words, new_words)
+    if kind and not checksum:
+        checksum = 0xFFFF
+    _word.pack_into(buffer, offset, checksum)
+
+
+def bind_headers(buffer, layout, packet=None):
+    """
+    Map the headers described by layout, a sequence of (header class, offset, header length),
+    as HeaderWrapper views over buffer, the one of packet if given.
+    """
+    view = memoryview(buffer)
+    headers = []
+    for clazz, offset, header_len in layout:
+        end = offset + header_len
+        headers.append(HeaderWrapper(clazz.from_buffer(buffer, offset),
+                                     view[offset + ctypes.sizeof(clazz):end],
+                                     view[offset:end], packet, offset))
+    return headers
+
+
 class CapturedMetadata(object):
     """
     Captured metadata on interface and flow direction
     """
+    __slots__ = ("iface", "direction")
 
     def __init__(self, iface, direction):
         self.iface = iface
@@ -320,111 +482,464 @@ class CapturedMetadata(object):
                                                                  "outbound" if self.direction != 1 else "inbound")
 
 
+class _Header(object):
+    """
+    A descriptor giving the header of a CapturedPacket of a given class, None if the packet has not such a header.
+    Setting it copies the given header over the one of the packet.
+    """
+    __slots__ = ("clazz", "index")
+
+    def __init__(self, clazz):
+        self.clazz = clazz
+        self.index = 0 if clazz in (DivertIpHeader, DivertIpv6Header) else 1
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        header = instance.headers[self.index]
+        if header is not None and type(header.hdr) is self.clazz:
+            return header
+
+    def __set__(self, instance, value):
+        header = instance.headers[self.index]
+        if header is None or type(header.hdr) is not self.clazz:
+            raise ValueError("The packet has no %s header" % self.clazz.__name__)
+        header.hdr = value
+
+
 class CapturedPacket(object):
     """
-    Gathers several network layers of data
+    Gathers several network layers of data.
+
+    The wire bytes are held in a single bytearray: headers are views over it, so modifying
+    a field changes the packet in place and raw is available without rebuilding anything.
+
+    Packets are decoded lazily: the headers are located on the first access to a field, and mapped as
+    HeaderWrapper views only when they are accessed as such. A packet which is only inspected through
+    its ports and addresses, or not at all, is sent as it was received, without checksum updates.
     """
+    __slots__ = ("meta", "_buffer", "_located", "_headers", "_modified", "_full_checksum", "_address_strings",
+                 "_payload_offset", "_family", "_address_offset", "_address_size", "_address_words", "_ports_offset",
+                 "_transport_checksum", "_address_checksums")
+
+    ipv4_hdr = _Header(DivertIpHeader)
+    ipv6_hdr = _Header(DivertIpv6Header)
+    tcp_hdr = _Header(DivertTcpHeader)
+    udp_hdr = _Header(DivertUdpHeader)
+    icmp_hdr = _Header(DivertIcmpHeader)
+    icmpv6_hdr = _Header(DivertIcmpv6Header)
 
     def __init__(self, headers, payload=None, raw_packet=None, meta=None):
         if len(headers) > 2:
             raise ValueError("No more than 2 headers (tcp/udp/icmp over ip) are supported")
 
-        self.payload = payload
-        self._raw_packet = raw_packet
-        self.meta = meta
-
-        self.headers = [None, None]
-        self.headers_opt = [None, None]
+        # Lay out the given headers and the payload into a brand new buffer
+        chunks, layout, offset = [], [], 0
         for header in headers:
-            if type(header.hdr) in (DivertIpHeader, DivertIpv6Header):
-                self.headers[0] = header
+            data = header.tobytes()
+            chunks.append(data)
+            layout.append((type(header.hdr), offset, len(data)))
+            offset += len(data)
+        if payload:
+            chunks.append(bytes(payload))
+        self._load(bytearray(b"".join(chunks)), layout)
+        self.meta = meta
+        # Nothing guarantees the checksums of the given headers are right
+        self._full_checksum = True
+
+    @classmethod
+    def from_buffer(cls, buffer, layout=None, meta=None):
+        """
+        Build a packet over an existing bytearray without copying it.
+        The layout is a sequence of (header class, offset, header length), everything
+        after the last header is the payload. If None, the buffer is parsed when first needed.
+        """
+        packet = cls.__new__(cls)
+        packet._load(buffer, layout)
+        packet.meta = meta
+        packet._full_checksum = False
+        return packet
+
+    def _load(self, buffer, layout):
+        self._buffer = buffer
+        self._located = None
+        self._headers = None
+        if layout is not None:
+            self._locate(layout)
+        # The (packed address, string) last formatted for each address, once one has been
+        self._address_strings = None
+        # Whether header fields changed since the checksums were last refreshed
+        self._modified = False
+
+    def _locate(self, layout=None):
+        """
+        Work out where the headers and the fields are, parsing the buffer unless the layout is given
+        """
+        if layout is None:
+            # The parser depends on this module
+            from pydivert.parser import parse_layout
+            layout = parse_layout(self._buffer)
+        self._payload_offset = layout[-1][1] + layout[-1][2] if layout else 0
+        self._family = socket.AF_INET
+        self._address_offset, self._address_size = None, 0
+        self._ports_offset = None
+        # The (offset, kind) of the transport checksum, and of the checksums covering the addresses
+        self._transport_checksum = None
+        self._address_checksums = ()
+        for clazz, offset, _ in layout:
+            if clazz in (DivertIpv6Header, DivertIcmpv6Header):
+                self._family = socket.AF_INET6
+            if clazz in _address_offsets:
+                self._address_offset, self._address_size = _address_offsets[clazz]
+                self._address_offset += offset
+                if clazz is DivertIpHeader:
+                    self._address_checksums = ((10, _PLAIN),)
             else:
-                self.headers[1] = header
+                if clazz in (DivertTcpHeader, DivertUdpHeader):
+                    self._ports_offset = offset
+                kind = _PLAIN
+                if clazz is DivertUdpHeader:
+                    kind = _UDP if self._family == socket.AF_INET6 else _UDP_IPV4
+                self._transport_checksum = (offset + _checksum_offsets[clazz], kind)
+                if clazz is not DivertIcmpHeader:
+                    # ICMP is the only one not covering a pseudo header
+                    self._address_checksums += (self._transport_checksum,)
+        self._address_words = struct.Struct("!%dH" % (self._address_size // 2))
+        self._located = layout
 
-    def _get_from_headers(self, key):
-        for header in self.headers:
-            if hasattr(header, key):
-                return header, getattr(header, key, None)
-        return None, None
+    @property
+    def _layout(self):
+        if self._located is None:
+            self._locate()
+        return self._located
 
-    def _set_in_headers(self, key, value):
-        for header in self.headers:
-            if hasattr(header, key):
-                setattr(header, key, value)
-                break
+    @property
+    def headers(self):
+        """
+        The network and transport headers, None when missing, mapped over the buffer on first access
+        """
+        if self._headers is None:
+            headers = [None, None]
+            for header in bind_headers(self._buffer, self._layout, self):
+                if type(header.hdr) in (DivertIpHeader, DivertIpv6Header):
+                    headers[0] = header
+                else:
+                    headers[1] = header
+            self._headers = headers
+        return self._headers
+
+    @property
+    def payload(self):
+        if self._located is None:
+            self._locate()
+        return memoryview(self._buffer)[self._payload_offset:].tobytes()
+
+    @payload.setter
+    def payload(self, value):
+        value = value if value else b''
+        layout = self._layout
+        buffer = self._buffer[:self._payload_offset]
+        buffer += value
+        self._load(buffer, layout)
+        self._full_checksum = True
+        self._update_lengths()
+
+    def _update_lengths(self):
+        """
+        Fix the length fields after the packet size changed
+        """
+        length = len(self._buffer)
+        ip_hdr = self.headers[0]
+        if ip_hdr is not None:
+            if type(ip_hdr.hdr) is DivertIpHeader:
+                ip_hdr.Length = socket.htons(length)
+            else:
+                ip_hdr.Length = socket.htons(length - ctypes.sizeof(DivertIpv6Header))
+        transport = self.headers[1]
+        if transport is not None and type(transport.hdr) is DivertUdpHeader:
+            transport.Length = socket.htons(length - self._layout[-1][1])
+
+    @property
+    def dirty(self):
+        """
+        True if the packet changed since its checksums were last refreshed or recalculated: header fields have
+        been set, the payload has been replaced, or the bytes of the packet have been given out by writable_raw().
+        """
+        return self._full_checksum or self._modified
+
+    def update_checksums(self, flags=0):
+        """
+        Recalculate from scratch, in place, the checksums of the packet, see pydivert.checksum.update_checksums.
+        Return the number of checksums calculated.
+        """
+        count = update_checksums(self._buffer, flags)
+        self._checksums_updated()
+        return count
+
+    def _checksums_updated(self):
+        """
+        Take note the checksums match the current packet
+        """
+        self._full_checksum = False
+        self._modified = False
+
+    def refresh_checksums(self):
+        """
+        Checksums are updated as header fields (addresses, ports, TTL, flags...) are set, for the words they
+        change only, as described by RFC 1624: the cost does not depend on the packet size and nothing is left
+        to do here. Return True if the checksums are right, False if they must be recalculated from scratch:
+        the payload or the packet layout changed, the bytes have been given out by writable_raw(), or the
+        packet has been built from standalone headers.
+        """
+        if self._full_checksum:
+            return False
+        self._modified = False
+        return True
+
+    def _changed(self, start, old):
+        """
+        Update the checksums for the words at start, whose previous content is old, just written.
+        Changes which can't be applied incrementally require a full recalculation instead, and so do checksums
+        overwritten along with other words (e.g. a whole header assigned): the value to update is lost.
+        """
+        if self._full_checksum:
+            return
+        self._modified = True
+        buffer = self._buffer
+        changed = _changed_words(old, buffer[start:start + len(old)])
+        if not changed:
+            return
+        layout = self._layout
+        ip_class, _, ip_len = layout[0]
+        if len(layout) > 1:
+            transport_class, transport_offset, _ = layout[1]
+        else:
+            transport_class, transport_offset = None, self._payload_offset
+        if len(changed) > 1:
+            checksums = [offset for offset, _ in self._address_checksums]
+            if self._transport_checksum is not None:
+                checksums.append(self._transport_checksum[0])
+            if any(offset + start in checksums for offset, _, _ in changed):
+                self._full_checksum = True
+                return
+        # Each diff is a pair (old words, new words)
+        ip_diff, pseudo_diff, segment_diff = ([], []), ([], []), ([], [])
+        for offset, old_word, new_word in changed:
+            offset += start
+            if offset < ip_len and ip_class is DivertIpHeader:
+                if offset in (0, 2) or (offset == 8 and (old_word ^ new_word) & 0x00FF):
+                    # Version/header length, total length or protocol: the transport checksum is not the same
+                    # one anymore
+                    self._full_checksum = True
+                    return
+                if offset != 10:
+                    _append(ip_diff, old_word, new_word)
+                if 12 <= offset < 20:
+                    # Source and destination addresses, options are not in the pseudo header
+                    _append(pseudo_diff, old_word, new_word)
+            elif offset < ip_len:
+                if offset == 4 or (offset == 6 and (old_word ^ new_word) & 0xFF00):
+                    # Payload length or next header
+                    self._full_checksum = True
+                    return
+                if 8 <= offset < IPV6_HEADER_LEN:
+                    # Source and destination addresses, extension headers are not covered
+                    _append(pseudo_diff, old_word, new_word)
+            elif transport_class is not None:
+                field = offset - transport_offset
+                if ((transport_class is DivertTcpHeader and field == 12 and (old_word ^ new_word) & 0xF000) or
+                        (transport_class is DivertUdpHeader and field == 4)):
+                    # TCP data offset or UDP length
+                    self._full_checksum = True
+                    return
+                if field != _checksum_offsets[transport_class]:
+                    _append(segment_diff, old_word, new_word)
+
+        if ip_diff[0]:
+            _update_checksum(buffer, 10, ip_diff[0], ip_diff[1])
+        if transport_class is not None and transport_class is not DivertIcmpHeader:
+            # ICMP is the only one not covering a pseudo header
+            segment_diff[0].extend(pseudo_diff[0])
+            segment_diff[1].extend(pseudo_diff[1])
+        if segment_diff[0]:
+            checksum_offset, kind = self._transport_checksum
+            _update_checksum(buffer, checksum_offset, segment_diff[0], segment_diff[1], kind)
 
     @property
     def address_family(self):
-        for v6hdr in ("ipv6_hdr", "icmpv6_hdr"):
-            if getattr(self, v6hdr):
-                return socket.AF_INET6
-        return socket.AF_INET
+        if self._located is None:
+            self._locate()
+        return self._family
+
+    def _get_port(self, index):
+        if self._located is None:
+            self._locate()
+        if self._ports_offset is not None:
+            port = _ports.unpack_from(self._buffer, self._ports_offset)[index]
+            if port:
+                return port
+
+    def _set_port(self, index, value):
+        if self._located is None:
+            self._locate()
+        if self._ports_offset is not None:
+            # Ports are only covered by the transport checksum: update it straight away
+            buffer, start = self._buffer, self._ports_offset + 2 * index
+            old = _word.unpack_from(buffer, start)[0]
+            _word.pack_into(buffer, start, value)
+            if not self._full_checksum:
+                self._modified = True
+                offset, kind = self._transport_checksum
+                _update_checksum(buffer, offset, (old,), (value,), kind)
 
     @property
     def src_port(self):
-        header, src_port = self._get_from_headers("SrcPort")
-        if src_port:
-            return socket.htons(src_port)
+        return self._get_port(0)
 
     @src_port.setter
     def src_port(self, value):
-        self._set_in_headers("SrcPort", socket.ntohs(value))
+        self._set_port(0, value)
 
     @property
     def dst_port(self):
-        header, dst_port = self._get_from_headers("DstPort")
-        if dst_port:
-            return socket.htons(dst_port)
+        return self._get_port(1)
 
     @dst_port.setter
     def dst_port(self, value):
-        self._set_in_headers("DstPort", socket.ntohs(value))
+        self._set_port(1, value)
+
+    def _get_address(self, index):
+        """
+        Return the string form of the source (index 0) or destination (1) address, formatting it only if it
+        changed since the last call
+        """
+        if self._located is None:
+            self._locate()
+        if self._address_offset is None:
+            return None
+        start = self._address_offset + index * self._address_size
+        packed = bytes(self._buffer[start:start + self._address_size])
+        if self._address_strings is None:
+            self._address_strings = [None, None]
+        else:
+            cached = self._address_strings[index]
+            if cached is not None and cached[0] == packed:
+                return cached[1]
+        if self._address_size == 4 and packed == b"\x00\x00\x00\x00":
+            return None
+        string = packed_to_string(self._family, packed)
+        self._address_strings[index] = (packed, string)
+        return string
+
+    def _set_address(self, index, value):
+        if self._located is None:
+            self._locate()
+        if self._address_offset is not None:
+            start = self._address_offset + index * self._address_size
+            words, buffer = self._address_words, self._buffer
+            old = words.unpack_from(buffer, start)
+            buffer[start:start + self._address_size] = string_to_packed(self._family, value)
+            if not self._full_checksum:
+                self._modified = True
+                new = words.unpack_from(buffer, start)
+                for offset, kind in self._address_checksums:
+                    _update_checksum(buffer, offset, old, new, kind)
+
+    def _get_address_int(self, index):
+        if self._located is None:
+            self._locate()
+        if self._address_offset is None:
+            return None
+        start = self._address_offset + index * self._address_size
+        if self._address_size == 4:
+            return _ipv4.unpack_from(self._buffer, start)[0]
+        high, low = _ipv6.unpack_from(self._buffer, start)
+        return high << 64 | low
 
     @property
     def src_addr(self):
-        header, src_addr = self._get_from_headers("SrcAddr")
-        if src_addr:
-            return addr_to_string(self.address_family, src_addr)
+        return self._get_address(0)
 
     @src_addr.setter
     def src_addr(self, value):
-        self._set_in_headers("SrcAddr", string_to_addr(self.address_family, value))
+        self._set_address(0, value)
 
     @property
     def dst_addr(self):
-        header, dst_addr = self._get_from_headers("DstAddr")
-        if dst_addr:
-            return addr_to_string(self.address_family, dst_addr)
+        return self._get_address(1)
 
     @dst_addr.setter
     def dst_addr(self, value):
-        self._set_in_headers("DstAddr", string_to_addr(self.address_family, value))
-
-    def __getattr__(self, item):
-        clazz = headers_map.get(item, None)
-        if clazz:
-            for header in self.headers:
-                if isinstance(header.hdr, clazz):
-                    return header
-        else:
-            return super(CapturedPacket, self).__getattribute__(item)
+        self._set_address(1, value)
 
-    def __setattr__(self, key, value):
-        clazz = headers_map.get(key, None)
-        if clazz:
-            if key in ("ipv4_hdr", "ipv6_hdr"):
-                self.headers[0].hdr = value
-            else:
-                self.headers[1].hdr = value
-        else:
-            super(CapturedPacket, self).__setattr__(key, value)
+    @property
+    def src_addr_bytes(self):
+        """
+        The packed source address, 4 or 16 bytes, as on the wire
+        """
+        if self._located is None:
+            self._locate()
+        if self._address_offset is not None:
+            start = self._address_offset
+            return bytes(self._buffer[start:start + self._address_size])
+
+    @property
+    def dst_addr_bytes(self):
+        """
+        The packed destination address, 4 or 16 bytes, as on the wire
+        """
+        if self._located is None:
+            self._locate()
+        if self._address_offset is not None:
+            start = self._address_offset + self._address_size
+            return bytes(self._buffer[start:start + self._address_size])
+
+    @property
+    def src_addr_int(self):
+        """
+        The source address as an integer, e.g. 0x0A000001 for 10.0.0.1
+        """
+        return self._get_address_int(0)
+
+    @property
+    def dst_addr_int(self):
+        """
+        The destination address as an integer
+        """
+        return self._get_address_int(1)
+
+    @property
+    def flow_key(self):
+        """
+        An hashable key of the flow of the packet, the same for both directions, see pydivert.flows.flow_key
+        """
+        return flow_key(self._buffer)
 
     @property
     def raw(self):
-        hexed = b"".join([header.raw for header in self.headers])
-        if self.payload:
-            hexed += hexlify(self.payload)
-        return unhexlify(hexed)
+        """
+        The wire bytes of the packet, a copy: see raw_view() to read them without copying
+        """
+        return bytes(self._buffer)
+
+    def raw_view(self):
+        """
+        Return a read-only view over the wire bytes of the packet, following its changes. Before python 3.8,
+        where views can't be made read-only, it is a view over a copy. See writable_raw() to change the bytes.
+        """
+        view = memoryview(self._buffer)
+        try:
+            return view.toreadonly()
+        except AttributeError:
+            return memoryview(bytes(self._buffer))
+
+    def writable_raw(self):
+        """
+        Return a writable view over the wire bytes of the packet. Since the changes made through it can't be
+        tracked, the checksums of the packet are then recalculated from scratch before it is sent.
+        """
+        self._full_checksum = True
+        return memoryview(self._buffer)
 
     def __repr__(self):
         return hexlify(self.raw)
@@ -437,7 +952,7 @@ class CapturedPacket(object):
                                                        self.dst_port))
         if self.meta:
             tokens.append(str(self.meta))
-        tokens.extend([str(hdr) for hdr in self.headers])
+        tokens.extend([str(hdr) for hdr in self.headers if hdr is not None])
         tokens.append("Payload: [{}] [HEX: {}]".format(self.payload,
                                                        hexlify(self.payload) if self.payload else ''))
         return "\n".join(tokens)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Simplification and programmatic building of filters.
+
+The driver evaluates the filter of every handle, test after test, for each packet going through
+the network stack. optimize_filter() rewrites a filter into an equivalent one with fewer tests:
+
+    * negations are pushed down to the tests (De Morgan)
+    * constants are folded, nested and/or flattened, duplicate and absorbed clauses removed
+    * comparisons on the same field are merged into the smallest set of ranges, so that
+      e.g. "tcp.DstPort == 80 or tcp.DstPort == 81 or tcp.DstPort == 82" becomes
+      "tcp.DstPort >= 80 and tcp.DstPort <= 82"
+
+As in the driver, a test on a field of a layer the packet has not is false, so a negated test is
+rewritten with the opposite operator only for fields that are always defined (direction,
+interfaces and layer presence).
+
+Filters can be built with Field, any_of() and all_of() instead of formatting strings:
+
+    ports = Field("tcp.DstPort").one_of([80, 81, 82, 443])
+    expression = Field("outbound") & ports & ~Field("ip.DstAddr").between("10.0.0.0", "10.255.255.255")
+    handle = driver.open_handle(filter=expression.optimize())
+"""
+import numbers
+
+from pydivert.filters import parse, to_string, parse_value, FIELDS
+
+__author__ = 'fabio'
+
+# Fields always defined while the driver evaluates a filter
+_total_fields = ("inbound", "outbound", "ifidx", "subifidx", "ip", "ipv6", "icmp", "icmpv6", "tcp", "udp")
+
+_directions = {"inbound": "outbound", "outbound": "inbound"}
+
+_negated = {"==": "!=", "!=": "==", "<": ">=", ">=": "<", ">": "<=", "<=": ">"}
+
+_TRUE, _FALSE = ("const", True), ("const", False)
+
+
+def count_tests(node):
+    """
+    Return the number of tests in a filter tree, that is the most the driver evaluates per packet
+    """
+    kind = node[0]
+    if kind == "test":
+        return 1
+    if kind == "not":
+        return count_tests(node[1])
+    if kind == "const":
+        return 0
+    return sum(count_tests(child) for child in node[1])
+
+
+def _intervals(op, value):
+    """
+    Return the sorted list of (low, high) intervals of the values satisfying a comparison.
+    Values are unsigned: the lowest is 0, an high bound of None means unbounded.
+    """
+    if op == "==":
+        return [(value, value)]
+    if op == "!=":
+        return ([(0, value - 1)] if value else []) + [(value + 1, None)]
+    if op == "<":
+        return [(0, value - 1)] if value else []
+    if op == "<=":
+        return [(0, value)]
+    if op == ">":
+        return [(value + 1, None)]
+    return [(value, None)]
+
+
+def _interval_key(interval):
+    return interval[0], float("inf") if interval[1] is None else interval[1]
+
+
+def _union(first, second):
+    merged = []
+    for low, high in sorted(first + second, key=_interval_key):
+        if merged and (merged[-1][1] is None or low <= merged[-1][1] + 1):
+            last_low, last_high = merged[-1]
+            merged[-1] = (last_low, None if high is None or last_high is None else max(high, last_high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def _intersection(first, second):
+    result = []
+    for low, high in first:
+        for other_low, other_high in second:
+            start = max(low, other_low)
+            if high is None:
+                end = other_high
+            elif other_high is None:
+                end = high
+            else:
+                end = min(high, other_high)
+            if end is None or start <= end:
+                result.append((start, end))
+    return _union(result, [])
+
+
+def _as_intervals(node):
+    """
+    Return (field, intervals) if the node only compares one field with constants, None otherwise
+    """
+    if node[0] == "test":
+        return node[1], _intervals(node[2], node[3])
+    if node[0] not in ("and", "or"):
+        return None
+    combine = _intersection if node[0] == "and" else _union
+    field, intervals = None, None
+    for child in node[1]:
+        found = _as_intervals(child)
+        if found is None or (field is not None and found[0] != field):
+            return None
+        field, intervals = found[0], found[1] if intervals is None else combine(intervals, found[1])
+    return field, intervals
+
+
+def _interval_terms(field, intervals):
+    """
+    Return the list of nodes, to be "or"-ed, testing that field is within the intervals
+    """
+    if intervals == [(0, None)]:
+        # Any value: true as long as the field is defined
+        return [_TRUE if field in _total_fields else ("test", field, ">=", 0)]
+    if len(intervals) == 2 and intervals[0][0] == 0 and intervals[1][1] is None \
+            and intervals[0][1] + 2 == intervals[1][0]:
+        return [("test", field, "!=", intervals[0][1] + 1)]
+    terms = []
+    for low, high in intervals:
+        if low == high:
+            terms.append(("test", field, "==", low))
+        elif high is None:
+            terms.append(("test", field, "!=", 0) if low == 1 else ("test", field, ">=", low))
+        elif low == 0:
+            terms.append(("test", field, "<=", high))
+        else:
+            terms.append(("and", (("test", field, ">=", low), ("test", field, "<=", high))))
+    return terms
+
+
+def _merge_ranges(kind, children):
+    """
+    Replace the children comparing the same field with constants with the smallest equivalent set of tests
+    """
+    groups, order = {}, []
+    for child in children:
+        found = _as_intervals(child)
+        key = found[0] if found else id(child)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append((child, found))
+    combine = _intersection if kind == "and" else _union
+    result = []
+    for key in order:
+        members = groups[key]
+        if len(members) == 1 or members[0][1] is None:
+            result.extend(child for child, found in members)
+            continue
+        intervals = members[0][1][1]
+        for child, found in members[1:]:
+            intervals = combine(intervals, found[1])
+        terms = _interval_terms(key, intervals)
+        if kind == "and":
+            if not intervals:
+                terms = [_FALSE]
+            elif len(terms) == 1:
+                terms = list(terms[0][1]) if terms[0][0] == "and" else terms
+            else:
+                terms = [("or", tuple(terms))]
+        elif not intervals:
+            terms = [_FALSE]
+        if sum(count_tests(term) for term in terms) < sum(count_tests(child) for child, found in members):
+            result.extend(terms)
+        else:
+            result.extend(child for child, found in members)
+    return result
+
+
+def _absorbed(kind, child, children):
+    """
+    Tell if child is redundant, e.g. "a and b" in "a or (a and b)"
+    """
+    inner = "or" if kind == "and" else "and"
+    if child[0] != inner:
+        return False
+    members = set(child[1])
+    for other in children:
+        if other is child:
+            continue
+        if other in members or (other[0] == inner and set(other[1]) < members):
+            return True
+    return False
+
+
+def _simplify(kind, children, merge=True):
+    flattened = []
+    for child in children:
+        flattened.extend(child[1] if child[0] == kind else (child,))
+    identity, absorbing = (_TRUE, _FALSE) if kind == "and" else (_FALSE, _TRUE)
+    unique, seen = [], set()
+    for child in flattened:
+        if child == absorbing:
+            return absorbing
+        if child != identity and child not in seen:
+            unique.append(child)
+            seen.add(child)
+    for child in unique:
+        if ("not", child) in seen:
+            # Either a or not a
+            return absorbing
+    unique = [child for child in unique if not _absorbed(kind, child, unique)]
+    if merge:
+        return _simplify(kind, _merge_ranges(kind, unique), False)
+    if not unique:
+        return identity
+    return unique[0] if len(unique) == 1 else (kind, tuple(unique))
+
+
+def simplify(node, negate=False):
+    """
+    Return an equivalent tree with fewer tests (see the module documentation).
+    If negate is true, the tree of the negated filter is returned.
+    """
+    kind = node[0]
+    if kind == "const":
+        return "const", node[1] != negate
+    if kind == "test":
+        field, op, value = node[1:]
+        if negate:
+            if field not in _total_fields:
+                return "not", node
+            op = _negated[op]
+        if field in _directions and op == "==" and value in (0, 1):
+            # Packets are either inbound or outbound
+            return "test", field if value else _directions[field], "!=", 0
+        return "test", field, op, value
+    if kind == "not":
+        return simplify(node[1], not negate)
+    if negate:
+        kind = "or" if kind == "and" else "and"
+    return _simplify(kind, [simplify(child, negate) for child in node[1]])
+
+
+class OptimizedFilter(object):
+    """
+    The result of optimize_filter(): str() returns the optimized filter, which can be given straight to an Handle.
+    tests and original_tests are the number of tests of the optimized and original filters, length and
+    original_length the length of the strings.
+    """
+
+    def __init__(self, original, tree):
+        self.original = original
+        self.tree = tree
+        self.text = to_string(tree)
+        self.original_tests = count_tests(parse(original))
+        self.tests = count_tests(tree)
+        self.original_length = len(original)
+        self.length = len(self.text)
+
+    def report(self):
+        """
+        Return a summary of the optimization
+        """
+        return "{} tests ({} before), {} characters ({} before)".format(self.tests, self.original_tests,
+                                                                        self.length, self.original_length)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "OptimizedFilter({!r})".format(self.text)
+
+
+def optimize_filter(text):
+    """
+    Return the OptimizedFilter for a filter string. Raise FilterSyntaxError for invalid filters.
+    """
+    if not hasattr(text, "encode"):
+        text = str(text)
+    elif isinstance(text, bytes):
+        text = text.decode("UTF-8")
+    return OptimizedFilter(text, simplify(parse(text)))
+
+
+class Expression(object):
+    """
+    A filter being built. Combine expressions with & (and), | (or) and ~ (not).
+    str() returns the filter as it is, optimize() the OptimizedFilter.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __and__(self, other):
+        return all_of([self, other])
+
+    def __or__(self, other):
+        return any_of([self, other])
+
+    def __invert__(self):
+        return Expression(("not", self.tree))
+
+    def optimize(self):
+        return OptimizedFilter(str(self), simplify(self.tree))
+
+    def __str__(self):
+        return to_string(self.tree)
+
+    def __repr__(self):
+        return "Expression({!r})".format(str(self))
+
+
+TRUE = Expression(_TRUE)
+FALSE = Expression(_FALSE)
+
+
+def _flatten(kind, expressions):
+    """
+    Return the trees of the expressions (or filter strings), merging the ones of the same kind
+    """
+    trees = []
+    for expression in expressions:
+        tree = expression.tree if isinstance(expression, Expression) else parse(expression)
+        trees.extend(tree[1] if tree[0] == kind else (tree,))
+    return trees
+
+
+def all_of(expressions):
+    """
+    Return the expression true when all the given ones (expressions or filter strings) are
+    """
+    trees = _flatten("and", expressions)
+    if not trees:
+        return TRUE
+    return Expression(trees[0] if len(trees) == 1 else ("and", tuple(trees)))
+
+
+def any_of(expressions):
+    """
+    Return the expression true when any of the given ones (expressions or filter strings) is
+    """
+    trees = _flatten("or", expressions)
+    if not trees:
+        return FALSE
+    return Expression(trees[0] if len(trees) == 1 else ("or", tuple(trees)))
+
+
+class Field(Expression):
+    """
+    A filter field, e.g. Field("tcp.DstPort"). Comparing it with a value (a number or an address, possibly
+    as a string) builds an expression. Alone, it is true when the field is not zero.
+    """
+
+    def __init__(self, name):
+        self.field = name.lower()
+        if self.field not in FIELDS:
+            raise ValueError("Unknown field: {}".format(name))
+        Expression.__init__(self, ("test", self.field, "!=", 0))
+
+    def _compare(self, op, value):
+        if not isinstance(value, numbers.Integral):
+            value = parse_value(str(value))
+        return Expression(("test", self.field, op, value))
+
+    def __eq__(self, value):
+        return self._compare("==", value)
+
+    def __ne__(self, value):
+        return self._compare("!=", value)
+
+    def __lt__(self, value):
+        return self._compare("<", value)
+
+    def __le__(self, value):
+        return self._compare("<=", value)
+
+    def __gt__(self, value):
+        return self._compare(">", value)
+
+    def __ge__(self, value):
+        return self._compare(">=", value)
+
+    __hash__ = object.__hash__
+
+    def one_of(self, values):
+        """
+        Return the expression true when the field equals any of the values
+        """
+        return any_of([self == value for value in values])
+
+    def between(self, low, high):
+        """
+        Return the expression true when the field is within low and high, both included
+        """
+        return all_of([self >= low, self <= high])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Native python implementation of DivertHelperParsePacket.
+
+Headers are located straight in the received buffer with struct and mapped over it as
+ctypes views, so no foreign call is needed and the parsing path is usable on platforms
+without WinDivert.dll.
+"""
+import ctypes
+import struct
+
+from pydivert.checksum import upper_layer
+from pydivert.models import DivertIpHeader, DivertIpv6Header, DivertIcmpHeader, DivertIcmpv6Header
+from pydivert.models import DivertTcpHeader, DivertUdpHeader, CapturedPacket
+
+__author__ = 'fabio'
+
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_ICMPV6 = 58
+
+IPV4_HEADER_LEN = ctypes.sizeof(DivertIpHeader)
+IPV6_HEADER_LEN = ctypes.sizeof(DivertIpv6Header)
+TCP_HEADER_LEN = ctypes.sizeof(DivertTcpHeader)
+UDP_HEADER_LEN = ctypes.sizeof(DivertUdpHeader)
+ICMP_HEADER_LEN = ctypes.sizeof(DivertIcmpHeader)
+
+_byte = struct.Struct("!B")
+_word = struct.Struct("!H")
+
+# Transport headers by (ip version, protocol number)
+_transports = {(4, IPPROTO_TCP): DivertTcpHeader,
+               (4, IPPROTO_UDP): DivertUdpHeader,
+               (4, IPPROTO_ICMP): DivertIcmpHeader,
+               (6, IPPROTO_TCP): DivertTcpHeader,
+               (6, IPPROTO_UDP): DivertUdpHeader,
+               (6, IPPROTO_ICMPV6): DivertIcmpv6Header}
+
+
+def _parse_ip(raw_packet, packet_len):
+    """
+    Decode the network layer. Return a tuple (header class, header length, version, protocol)
+    or None if the buffer does not start with a valid IPv4/IPv6 header.
+    """
+    if packet_len < 1:
+        return None
+    version = _byte.unpack_from(raw_packet, 0)[0] >> 4
+    if version == 4 and packet_len >= IPV4_HEADER_LEN:
+        header_len = (_byte.unpack_from(raw_packet, 0)[0] & 0x0F) * 4
+        if header_len < IPV4_HEADER_LEN or header_len > packet_len:
+            return None
+        protocol = _byte.unpack_from(raw_packet, 9)[0]
+        if _word.unpack_from(raw_packet, 6)[0] & 0x1FFF:
+            # Not the first fragment: there's no transport header to decode
+            protocol = None
+        return DivertIpHeader, header_len, version, protocol
+    if version == 6 and packet_len >= IPV6_HEADER_LEN:
+        # Extension headers are carried as the options of the IPv6 header
+        protocol, header_len, fragment = upper_layer(raw_packet, packet_len)
+        if header_len > packet_len:
+            return DivertIpv6Header, IPV6_HEADER_LEN, version, None
+        if fragment & 0xFFF8:
+            protocol = None
+        return DivertIpv6Header, header_len, version, protocol
+    return None
+
+
+def _parse_transport(raw_packet, packet_len, offset, version, protocol):
+    """
+    Decode the transport layer starting at offset. Return a tuple (header class, header length)
+    or None if the protocol is not supported or the header is truncated.
+    """
+    clazz = _transports.get((version, protocol), None)
+    if clazz is None or packet_len < offset + ctypes.sizeof(clazz):
+        return None
+    if clazz is DivertTcpHeader:
+        header_len = (_byte.unpack_from(raw_packet, offset + 12)[0] >> 4) * 4
+        if header_len < TCP_HEADER_LEN or offset + header_len > packet_len:
+            return None
+        return clazz, header_len
+    return clazz, ctypes.sizeof(clazz)
+
+
+def parse_layout(raw_packet):
+    """
+    Return the list of (header class, offset, header length) found in the raw packet.
+    Anything after the last header is payload.
+    """
+    packet_len = len(raw_packet)
+    layout = []
+    network = _parse_ip(raw_packet, packet_len)
+    if network:
+        clazz, offset, version, protocol = network
+        layout.append((clazz, 0, offset))
+        transport = _parse_transport(raw_packet, packet_len, offset, version, protocol)
+        if transport:
+            layout.append((transport[0], offset, transport[1]))
+    return layout
+
+
+def parse_packet(raw_packet, meta=None):
+    """
+    Parses a raw packet into a CapturedPacket, the same way DivertHelperParsePacket does:
+    an IPv4 or IPv6 header, optionally followed by a TCP, UDP, ICMP or ICMPv6 header.
+    Anything that is not a recognized header is considered payload.
+
+    Truncated or malformed headers are not an error: parsing simply stops there and
+    the rest of the buffer becomes the payload.
+
+    A bytearray is used as the packet buffer as it is, any other buffer is copied once. Headers are only
+    located when the packet is first inspected, see CapturedPacket.
+    """
+    buffer = raw_packet if isinstance(raw_packet, bytearray) else bytearray(raw_packet)
+    return CapturedPacket.from_buffer(buffer, None, meta)
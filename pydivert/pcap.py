@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Capture files (pcap and pcapng) of diverted packets.
+
+Diverted packets start with the IP header, so they are written with the LINKTYPE_RAW link type.
+Records are accumulated in memory and written in large chunks; with threaded=True the chunks are
+written by a background thread, so that a slow disk does not stall the divert loop.
+
+    with PcapngWriter("capture.pcapng") as capture:
+        while True:
+            packet = handle.receive()
+            capture.write(packet)
+            handle.send(packet)
+
+In pcapng files each interface (IfIdx, SubIfIdx) gets its own interface description block, named
+"IfIdx.SubIfIdx", and the direction of each packet is stored in the epb_flags option.
+
+PcapReader iterates the packets of a capture file, parsed as the received ones, to replay them offline:
+
+    with PcapReader("capture.pcapng") as capture:
+        for packet in capture:
+            handler(packet)
+"""
+import io
+import mmap
+import struct
+import threading
+import time
+
+import queue
+
+from pydivert.enum import Direction
+from pydivert.models import CapturedPacket, CapturedMetadata
+from pydivert.parser import parse_packet
+
+__author__ = 'fabio'
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_NSEC_MAGIC = 0xA1B23C4D
+
+# pcapng block types, options and byte order magic
+SECTION_HEADER_BLOCK = 0x0A0D0D0A
+INTERFACE_DESCRIPTION_BLOCK = 1
+SIMPLE_PACKET_BLOCK = 3
+ENHANCED_PACKET_BLOCK = 6
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPT_ENDOFOPT = 0
+IF_NAME = 2
+IF_TSRESOL = 9
+EPB_FLAGS = 2
+EPB_INBOUND = 1
+EPB_OUTBOUND = 2
+
+_pcap_header = struct.Struct("<IHHiIII")
+_pcap_record = struct.Struct("<IIII")
+_block_trailer = struct.Struct("<I")
+_section_header = struct.Struct("<IIIHHq")
+_interface_description = struct.Struct("<IIHHI")
+_enhanced_packet = struct.Struct("<IIIIIII")
+_option = struct.Struct("<HH")
+_flags_option = struct.Struct("<HHI")
+_end_of_options = _option.pack(OPT_ENDOFOPT, 0)
+_padding = (b"", b"\0\0\0", b"\0\0", b"\0")
+_magic = struct.Struct("<I")
+_byte = struct.Struct("B")
+_ethertype = struct.Struct("!H")
+_pcap_magics = (PCAP_MAGIC, PCAP_NSEC_MAGIC)
+_ip_ethertypes = (0x0800, 0x86DD)
+_vlan_ethertypes = (0x8100, 0x88A8)
+# AF_INET, then AF_INET6 on the BSDs, OS X and Linux
+_null_families = (2, 24, 28, 30, 10)
+
+
+def _record(*args):
+    """
+    Return the raw packet and the meta of a packet given as for Handle.send
+    """
+    if len(args) == 2:
+        return args
+    packet = args[0]
+    if isinstance(packet, CapturedPacket):
+        return packet.raw_view(), packet.meta
+    return packet[0], packet[1]
+
+
+def _option_bytes(code, value):
+    return _option.pack(code, len(value)) + value + _padding[len(value) % 4]
+
+
+class _CaptureWriter(object):
+    """
+    Buffering, threading and file handling shared by the writers
+    """
+
+    def __init__(self, file, snaplen=65535, buffer_size=1 << 20, threaded=False):
+        if hasattr(file, "write"):
+            self.file, self._owned = file, False
+        else:
+            self.file, self._owned = open(file, "wb"), True
+        self.snaplen = snaplen
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._chunks = []
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._queue, self._thread = None, None
+        # The exception which stopped the writer thread, raised by the following calls
+        self._error = None
+        if threaded:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._write_chunks, name="pydivert-pcap")
+            self._thread.daemon = True
+            self._thread.start()
+        self._append(self._file_header())
+
+    def _write_chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if hasattr(chunk, "set"):
+                # An event set by flush()
+                chunk.set()
+            elif self._error is None:
+                try:
+                    self.file.write(chunk)
+                except Exception as error:
+                    # Keep draining the queue, so that flush() and close() don't wait forever
+                    self._error = error
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _append(self, data):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self._flush_chunks()
+
+    def _flush_chunks(self):
+        if not self._chunks:
+            return
+        chunk = b"".join(self._chunks)
+        self._chunks, self._buffered = [], 0
+        if self._queue is not None:
+            self._queue.put(chunk)
+        else:
+            self.file.write(chunk)
+
+    def write(self, *args, **kwargs):
+        """
+        Writes a packet, given as for Handle.send: an high level packet, a (raw_packet, meta) pair or the two
+        values. The capture time may be given as timestamp (seconds since the epoch), defaults to now.
+        """
+        self._check_error()
+        raw_packet, meta = _record(*args)
+        timestamp = kwargs.get("timestamp")
+        with self._lock:
+            self._write_record(raw_packet, meta, time.time() if timestamp is None else timestamp)
+            self.count += 1
+
+    def write_many(self, packets, timestamp=None):
+        """
+        Writes several packets, each one given as for write(), with the same capture time
+        """
+        self._check_error()
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            for packet in packets:
+                raw_packet, meta = _record(packet)
+                self._write_record(raw_packet, meta, timestamp)
+                self.count += 1
+
+    def flush(self):
+        """
+        Writes the buffered records. With threaded=True, waits for them to be written.
+        """
+        with self._lock:
+            self._flush_chunks()
+        if self._queue is not None:
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait()
+            self._check_error()
+        self.file.flush()
+
+    def close(self):
+        """
+        Writes the buffered records and stops the writer thread. The file is closed if it has been opened by
+        the writer. An error met by the writer thread is raised once the file has been closed.
+        """
+        with self._lock:
+            self._flush_chunks()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue, self._thread = None, None
+        if self._owned:
+            self.file.close()
+        elif self._error is None:
+            self.file.flush()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PcapWriter(_CaptureWriter):
+    """
+    Writes packets into a pcap file, with microseconds timestamps.
+    file is a path or a binary file object. Records are buffered up to buffer_size bytes, written by a
+    background thread if threaded is true. Packets are truncated to snaplen bytes.
+    """
+
+    def _file_header(self):
+        return _pcap_header.pack(PCAP_MAGIC, 2, 4, 0, 0, self.snaplen, LINKTYPE_RAW)
+
+    def _write_record(self, raw_packet, meta, timestamp):
+        length = len(raw_packet)
+        captured = min(length, self.snaplen)
+        seconds = int(timestamp)
+        self._append(_pcap_record.pack(seconds, int((timestamp - seconds) * 1000000), captured, length))
+        self._append(bytes(raw_packet[:captured]))
+
+
+class PcapngWriter(_CaptureWriter):
+    """
+    Writes packets into a pcapng file, with microseconds timestamps, see PcapWriter.
+    Interface description blocks are written as interfaces are met: interface ids follow that order.
+    """
+
+    def __init__(self, file, snaplen=65535, buffer_size=1 << 20, threaded=False):
+        self.interfaces = {}
+        _CaptureWriter.__init__(self, file, snaplen, buffer_size, threaded)
+
+    def _file_header(self):
+        # Section length unknown (-1)
+        length = _section_header.size + _block_trailer.size
+        return _section_header.pack(SECTION_HEADER_BLOCK, length, BYTE_ORDER_MAGIC, 1, 0, -1) + \
+            _block_trailer.pack(length)
+
+    def _interface(self, iface):
+        interface_id = self.interfaces.get(iface)
+        if interface_id is None:
+            interface_id = self.interfaces[iface] = len(self.interfaces)
+            name = "unknown" if iface is None else "{}.{}".format(*iface)
+            options = _option_bytes(IF_NAME, name.encode("ascii")) + _option_bytes(IF_TSRESOL, b"\x06") + \
+                _end_of_options
+            length = _interface_description.size + len(options) + _block_trailer.size
+            self._append(_interface_description.pack(INTERFACE_DESCRIPTION_BLOCK, length, LINKTYPE_RAW, 0,
+                                                     self.snaplen) + options + _block_trailer.pack(length))
+        return interface_id
+
+    def _write_record(self, raw_packet, meta, timestamp):
+        interface_id = self._interface(None if meta is None else tuple(meta.iface))
+        length = len(raw_packet)
+        captured = min(length, self.snaplen)
+        padding = _padding[captured % 4]
+        if meta is None:
+            options = b""
+        else:
+            flags = EPB_INBOUND if meta.direction == Direction.INBOUND else EPB_OUTBOUND
+            options = _flags_option.pack(EPB_FLAGS, 4, flags) + _end_of_options
+        block_length = _enhanced_packet.size + captured + len(padding) + len(options) + _block_trailer.size
+        microseconds = int(timestamp * 1000000)
+        self._append(_enhanced_packet.pack(ENHANCED_PACKET_BLOCK, block_length, interface_id, microseconds >> 32,
+                                           microseconds & 0xFFFFFFFF, captured, length))
+        self._append(bytes(raw_packet[:captured]) + padding + options + _block_trailer.pack(block_length))
+
+
+class PcapReader(object):
+    """
+    Reads the packets of a pcap or pcapng file, as written by PcapWriter and PcapngWriter or by other tools.
+    file is a path or a binary file object. Files are memory mapped and records decoded one at a time as they
+    are iterated, so captures of any size are read in constant memory.
+
+    Link types RAW, IPV4, IPV6, ETHERNET and NULL are supported: link layer headers are stripped and frames not
+    carrying IP are skipped. The interface and direction of packets are read from pcapng files, as written
+    by PcapngWriter. meta is used for the packets which have none, e.g. all the packets of a pcap file.
+    """
+
+    def __init__(self, file, meta=None):
+        self.meta = meta
+        self._file, self._mmap = None, None
+        if not hasattr(file, "read"):
+            file = self._file = open(file, "rb")
+        try:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = memoryview(self._mmap)
+        except (AttributeError, io.UnsupportedOperation, ValueError, EnvironmentError):
+            # Not a regular file (or an empty one)
+            self._data = memoryview(file.read())
+        magic = _magic.unpack_from(self._data)[0] if len(self._data) >= _pcap_header.size else None
+        if magic == SECTION_HEADER_BLOCK:
+            self.format = "pcapng"
+        elif magic in _pcap_magics or _swapped(magic) in _pcap_magics:
+            self.format = "pcap"
+        else:
+            raise ValueError("Not a pcap nor a pcapng file")
+
+    def records(self):
+        """
+        Iterate the (raw_packet, meta, timestamp) of the packets, raw_packet being a memoryview over the file
+        starting at the IP header, valid while the reader is open
+        """
+        if self.format == "pcap":
+            return self._pcap_records()
+        return self._pcapng_records()
+
+    def _pcap_records(self):
+        data, meta = self._data, self.meta
+        magic = _magic.unpack_from(data)[0]
+        order = "<" if magic in _pcap_magics else ">"
+        if order == ">":
+            magic = _swapped(magic)
+        resolution = 1e-9 if magic == PCAP_NSEC_MAGIC else 1e-6
+        linktype = struct.unpack_from(order + "I", data, 20)[0] & 0x0FFFFFFF
+        record = struct.Struct(order + "IIII")
+        offset, end = _pcap_header.size, len(data)
+        while offset + record.size <= end:
+            seconds, fraction, captured, length = record.unpack_from(data, offset)
+            offset += record.size
+            raw_packet = _strip_link_layer(linktype, data[offset:offset + captured])
+            offset += captured
+            if raw_packet is not None:
+                yield raw_packet, meta, seconds + fraction * resolution
+
+    def _pcapng_records(self):
+        data, end, offset = self._data, len(self._data), 0
+        order, interfaces = "<", []
+        while offset + 12 <= end:
+            block_type = _magic.unpack_from(data, offset)[0]
+            if block_type == SECTION_HEADER_BLOCK:
+                # A new section, possibly with another byte order
+                order = "<" if _magic.unpack_from(data, offset + 8)[0] == BYTE_ORDER_MAGIC else ">"
+                interfaces = []
+            block_type, length = struct.unpack_from(order + "II", data, offset)
+            if length < 12 or offset + length > end:
+                break
+            body = data[offset + 8:offset + length - 4]
+            offset += length
+            if block_type == INTERFACE_DESCRIPTION_BLOCK:
+                interfaces.append(self._interface(body, order, len(interfaces)))
+            elif block_type == ENHANCED_PACKET_BLOCK:
+                interface_id, high, low, captured, _ = struct.unpack_from(order + "IIIII", body)
+                linktype, iface, resolution = interfaces[interface_id]
+                raw_packet = _strip_link_layer(linktype, body[20:20 + captured])
+                if raw_packet is None:
+                    continue
+                options = _options(body, 20 + (captured + 3) // 4 * 4, order)
+                # The direction is given by the 2 lowest bits of the flags, 0 if not available
+                flags = struct.unpack(order + "I", options[EPB_FLAGS])[0] & 3 if EPB_FLAGS in options else 0
+                meta = self.meta
+                if flags:
+                    meta = CapturedMetadata(iface, Direction.INBOUND if flags == EPB_INBOUND else Direction.OUTBOUND)
+                yield raw_packet, meta, (high << 32 | low) * resolution
+            elif block_type == SIMPLE_PACKET_BLOCK and interfaces:
+                captured = min(struct.unpack_from(order + "I", body)[0], len(body) - 4)
+                raw_packet = _strip_link_layer(interfaces[0][0], body[4:4 + captured])
+                if raw_packet is not None:
+                    yield raw_packet, self.meta, None
+
+    def _interface(self, body, order, interface_id):
+        """
+        Return the link type, (IfIdx, SubIfIdx) and timestamps resolution of an interface description block
+        """
+        linktype = struct.unpack_from(order + "H", body)[0]
+        options = _options(body, 8, order)
+        iface = (interface_id, 0)
+        indexes = options[IF_NAME].tobytes().split(b".") if IF_NAME in options else []
+        if len(indexes) == 2 and indexes[0].isdigit() and indexes[1].isdigit():
+            iface = (int(indexes[0]), int(indexes[1]))
+        resolution = 1e-6
+        if IF_TSRESOL in options:
+            value = _byte.unpack_from(options[IF_TSRESOL])[0]
+            resolution = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        return linktype, iface, resolution
+
+    def __iter__(self):
+        """
+        Iterate the packets, parsed by pydivert.parser as received ones
+        """
+        for raw_packet, meta, timestamp in self.records():
+            yield parse_packet(raw_packet, meta)
+
+    def close(self):
+        """
+        Closes the file. The mapping is released once the views returned by records() are.
+        """
+        self._data.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Views still alive: unmapped when collected
+                pass
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _options(body, offset, order):
+    """
+    Return a dictionary mapping the codes of the options of a block to their values
+    """
+    options, end = {}, len(body)
+    header = struct.Struct(order + "HH")
+    while offset + header.size <= end:
+        code, length = header.unpack_from(body, offset)
+        if code == OPT_ENDOFOPT:
+            break
+        offset += header.size
+        options.setdefault(code, body[offset:offset + length])
+        offset += (length + 3) // 4 * 4
+    return options
+
+
+def _swapped(value):
+    return None if value is None else struct.unpack(">I", struct.pack("<I", value))[0]
+
+
+def _strip_link_layer(linktype, frame):
+    """
+    Return the view of the IP packet carried by a frame, None if it does not carry IP
+    """
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return frame
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        while offset + 2 <= len(frame):
+            ethertype = _ethertype.unpack_from(frame, offset)[0]
+            if ethertype in _vlan_ethertypes:
+                offset += 4
+                continue
+            return frame[offset + 2:] if ethertype in _ip_ethertypes else None
+        return None
+    if linktype == LINKTYPE_NULL and len(frame) >= 4:
+        # The address family, in the byte order of the capturing host
+        family = _magic.unpack_from(frame)[0]
+        if family in _null_families or _swapped(family) in _null_families:
+            return frame[4:]
+    return None
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Multi-threaded divert, modify and reinject loops.
+
+A Pipeline runs receiver threads on one or more handles and hands the packets over to a pool of
+worker threads calling the application callback, then reinjects what the callback returns.
+The driver calls release the GIL, so receiving, sending and processing overlap.
+
+Packets are assigned to workers by a hash of their flow (addresses, protocol and ports, regardless of
+the direction), so the packets of a flow are processed, and reinjected, in the order they have been
+received as long as each handle has a single receiver. Fragments are hashed by addresses and protocol only,
+so that all the fragments of a datagram go to the same worker.
+
+    def redirect(packet):
+        packet.dst_port = 8080
+        return packet
+
+    with Pipeline(Handle(filter="outbound and tcp.DstPort == 80"), redirect, workers=4):
+        time.sleep(60)
+"""
+import logging
+import struct
+import threading
+import zlib
+
+import queue
+
+from pydivert.flows import _endpoints
+from pydivert.models import CapturedPacket
+from pydivert.stats import clock
+from pydivert.windivert import BATCH_SIZE, PACKET_BUFFER_SIZE
+
+__author__ = 'fabio'
+
+logger = logging.getLogger(__name__)
+
+# Receivers wait after each receive error, from ERROR_BACKOFF seconds doubling up to MAX_ERROR_BACKOFF while
+# errors follow each other, rather than spinning on an error which doesn't go away
+ERROR_BACKOFF = 0.001
+MAX_ERROR_BACKOFF = 0.5
+
+# Protocol, then the address (in two halves) and port of each endpoint
+_flow = struct.Struct("!BQQHQQH")
+_HALF = 0xFFFFFFFFFFFFFFFF
+
+
+def flow_hash(raw_packet):
+    """
+    Return an hash of the flow of a raw packet: the same for both directions and any python process.
+    Packets which are not IP are all hashed to 0, fragments by their addresses and protocol.
+    """
+    endpoints = _endpoints(raw_packet, fragment_ports=False)
+    if endpoints is None:
+        return 0
+    protocol, src_addr, src_port, dst_addr, dst_port, _ = endpoints
+    if (src_addr, src_port) > (dst_addr, dst_port):
+        src_addr, src_port, dst_addr, dst_port = dst_addr, dst_port, src_addr, src_port
+    return zlib.crc32(_flow.pack(protocol, src_addr >> 64, src_addr & _HALF, src_port,
+                                 dst_addr >> 64, dst_addr & _HALF, dst_port)) & 0xFFFFFFFF
+
+
+class Pipeline(object):
+    """
+    Processes the packets diverted to handles (an Handle or a list of them) with callback, on worker threads.
+
+    callback(packet) is given an high level packet, or a (raw_packet, meta) pair, raw_packet being a bytearray,
+    if raw is true. It returns what to reinject on the handle the packet comes from: None (the packet is dropped),
+    a packet, or a list of packets. If it raises, the packet is dropped and on_error(packet, error) is called.
+    Errors of DivertSend() are passed to on_error too, and so are the ones of DivertRecv(), with a None packet:
+    the receivers keep going until the pipeline is stopped, waiting a little longer after each consecutive error.
+    Errors raised by on_error itself are logged and don't stop the threads.
+
+    receivers threads are started for each handle. More than one makes receiving faster, but packets of the same
+    flow may then be processed out of order. Each worker queues at most max_pending packets: when it is full, the
+    receivers wait and packets are left queued in the driver.
+    batch_size and batch_timeout are given to Handle.recv_many(): with the default timeout of 0, a batch holds the
+    packets already queued in the driver when the first one is received.
+    """
+
+    def __init__(self, handles, callback, workers=4, receivers=1, max_pending=1024, batch_size=BATCH_SIZE,
+                 batch_timeout=0, raw=False, bufsize=PACKET_BUFFER_SIZE, on_error=None):
+        self.handles = list(handles) if isinstance(handles, (tuple, list)) else [handles]
+        self.callback = callback
+        self.workers = workers
+        self.receivers = receivers
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.raw = raw
+        self.bufsize = bufsize
+        self.on_error = on_error
+        self._queues = []
+        self._receivers = []
+        self._workers = []
+        self._counters = []
+        self._running = False
+        self._stopping = threading.Event()
+
+    def start(self):
+        """
+        Opens the handles, unless already opened, and starts the threads
+        """
+        if self._running:
+            return self
+        self._running = True
+        self._stopping.clear()
+        for handle in self.handles:
+            if not handle.is_opened:
+                handle.open()
+        self._queues = [queue.Queue(self.max_pending) for _ in range(self.workers)]
+        self._counters = []
+        self._workers = [self._thread(self._work, "pydivert-worker-%d" % index, self._queues[index])
+                         for index in range(self.workers)]
+        self._receivers = [self._thread(self._receive, "pydivert-recv-%d" % index, handle)
+                           for index, handle in enumerate(self.handles) for _ in range(self.receivers)]
+        return self
+
+    def _thread(self, target, name, argument):
+        counters = dict.fromkeys(("received", "processed", "sent", "dropped", "errors"), 0)
+        self._counters.append(counters)
+        thread = threading.Thread(target=target, name=name, args=(argument, counters))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @property
+    def counters(self):
+        """
+        Return the number of packets received, processed by the callback, sent, dropped by the callback and
+        of errors, all threads summed up
+        """
+        totals = dict.fromkeys(("received", "processed", "sent", "dropped", "errors"), 0)
+        for counters in self._counters:
+            for key, value in counters.items():
+                totals[key] += value
+        return totals
+
+    def _receive(self, handle, counters):
+        queues, workers = self._queues, self.workers
+        if self.raw:
+            convert = lambda record: (bytearray(record[0]), record[1])
+        else:
+            convert = handle.driver.parse_packet
+        backoff = 0
+        while self._running:
+            try:
+                records = handle.recv_many(self.batch_size, self.bufsize, self.batch_timeout)
+            except Exception as error:
+                if not self._running or not handle.is_opened:
+                    # The handle has been closed
+                    break
+                counters["errors"] += 1
+                self._report(None, error)
+                backoff = min(backoff * 2 or ERROR_BACKOFF, MAX_ERROR_BACKOFF)
+                self._stopping.wait(backoff)
+                continue
+            backoff = 0
+            counters["received"] += len(records)
+            for record in records:
+                # Views over the ring buffers are overwritten by the following calls: copy them
+                queues[flow_hash(record[0]) % workers].put((handle, convert(record)))
+
+    def _report(self, packet, error):
+        """
+        Calls on_error, if any: an error it raises is logged, it must not stop the thread calling it
+        """
+        if self.on_error is None:
+            return
+        try:
+            self.on_error(packet, error)
+        except Exception:
+            logger.exception("on_error failed to handle %r", error)
+
+    def _work(self, packets, counters):
+        callback = self.callback
+        while True:
+            items = [packets.get()]
+            while items[-1] is not None and len(items) < self.batch_size:
+                try:
+                    items.append(packets.get_nowait())
+                except queue.Empty:
+                    break
+            stop = items[-1] is None
+            if stop:
+                items.pop()
+            # Results are sent in a batch per handle, keeping their order
+            outgoing = {}
+            for handle, packet in items:
+                stats = handle.stats
+                if stats is not None:
+                    start = clock()
+                try:
+                    result = callback(packet)
+                except Exception as error:
+                    counters["errors"] += 1
+                    self._report(packet, error)
+                    continue
+                if stats is not None:
+                    stats.record("callback", clock() - start)
+                counters["processed"] += 1
+                if result is None:
+                    counters["dropped"] += 1
+                    if stats is not None:
+                        stats.count("dropped")
+                    continue
+                if isinstance(result, (CapturedPacket, tuple)):
+                    result = [result]
+                outgoing.setdefault(handle, []).extend(result)
+            for handle, results in outgoing.items():
+                self._send(handle, results, counters)
+            if stop:
+                break
+
+    def _send(self, handle, packets, counters):
+        try:
+            results = handle.send_many(packets)
+        except Exception as error:
+            results = [error] * len(packets)
+        for packet, result in zip(packets, results):
+            if isinstance(result, Exception):
+                counters["errors"] += 1
+                self._report(packet, result)
+            else:
+                counters["sent"] += 1
+
+    def stop(self):
+        """
+        Closes the handles, which stops the receivers, and waits for the workers to process the packets
+        already received. Packets processed after the handles have been closed can't be reinjected.
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._stopping.set()
+        for handle in self.handles:
+            if handle.is_opened:
+                handle.close()
+        for thread in self._receivers:
+            thread.join()
+        for packets in self._queues:
+            packets.put(None)
+        for thread in self._workers:
+            thread.join()
+        self._receivers, self._workers = [], []
+
+    def run(self):
+        """
+        Starts the pipeline and blocks until stop() is called by another thread
+        """
+        self.start()
+        for thread in self._receivers + self._workers:
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
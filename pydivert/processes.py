@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Packet processing on worker processes, for callbacks too CPU bound to share a single interpreter.
+
+The handles stay in the process creating the ProcessPipeline, which receives the packets and distributes
+them by flow hash (see pydivert.pipeline) to the worker processes. Packets are exchanged through rings of
+fixed size slots in shared memory, one from the receiver to each worker and one back: nothing is pickled,
+each packet is copied once in each direction. Workers parse the packets, call the callback and update the
+checksums of its results, which are then reinjected by the receiving process.
+
+    def inspect(packet):
+        if b"forbidden" not in packet.payload:
+            return packet
+
+    if __name__ == "__main__":
+        with ProcessPipeline(Handle(filter="tcp.DstPort == 80"), inspect, workers=8):
+            time.sleep(60)
+
+The callback is given to the worker processes, so it must be picklable (e.g. a module level function)
+when processes are spawned rather than forked.
+"""
+import ctypes
+import logging
+import multiprocessing
+import struct
+import threading
+
+from pydivert.models import CapturedPacket, CapturedMetadata
+from pydivert.parser import parse_packet
+from pydivert.pipeline import ERROR_BACKOFF, MAX_ERROR_BACKOFF, flow_hash
+from pydivert.windivert import BATCH_SIZE, PACKET_BUFFER_SIZE
+
+__author__ = 'fabio'
+
+logger = logging.getLogger(__name__)
+
+# length, interface index, sub interface index, direction, handle index
+_slot_header = struct.Struct("=IIIBH")
+_END = 0xFFFFFFFF
+
+
+class SharedRing(object):
+    """
+    A ring of slots in shared memory, each holding a packet of at most slot_size bytes with its metadata.
+    Two semaphores count the free and the used slots. The ring has a single consumer, and producers in a
+    single process: threads of that process share it through a lock.
+    The ring may be given to another process when starting it.
+    """
+
+    def __init__(self, slots=256, slot_size=PACKET_BUFFER_SIZE, context=multiprocessing):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._stride = _slot_header.size + slot_size
+        self._memory = context.RawArray(ctypes.c_char, slots * self._stride)
+        self._free = context.Semaphore(slots)
+        self._used = context.Semaphore(0)
+        self._head = 0
+        self._tail = 0
+        self._view = memoryview(self._memory).cast("B")
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_view"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._view = memoryview(self._memory).cast("B")
+        self._lock = threading.Lock()
+
+    def put(self, raw_packet, meta, handle=0, block=True):
+        """
+        Copies a packet into the next free slot, waiting for one if block is true.
+        Return False if the ring is full and block is false. Raise ValueError if the packet is too big.
+        """
+        length = len(raw_packet)
+        if length > self.slot_size:
+            raise ValueError("Packet of {} bytes does not fit a slot of {}".format(length, self.slot_size))
+        with self._lock:
+            # Slots are used in order: the next one must be filled before another producer takes the one after
+            if not self._free.acquire(block):
+                return False
+            offset = self._head * self._stride
+            _slot_header.pack_into(self._view, offset, length, meta.iface[0], meta.iface[1], meta.direction, handle)
+            start = offset + _slot_header.size
+            self._view[start:start + length] = raw_packet
+            self._head = (self._head + 1) % self.slots
+            self._used.release()
+        return True
+
+    def put_end(self, timeout=None):
+        """
+        Marks the end of the packets, waiting at most timeout seconds for a free slot if not None.
+        Return False if there was none.
+        """
+        with self._lock:
+            if not self._free.acquire(True, timeout):
+                return False
+            _slot_header.pack_into(self._view, self._head * self._stride, _END, 0, 0, 0, 0)
+            self._head = (self._head + 1) % self.slots
+            self._used.release()
+        return True
+
+    def get(self, block=True):
+        """
+        Return the next packet as a (raw_packet, meta, handle) tuple, raw_packet being a bytearray, waiting for
+        one if block is true. Return None if the ring is empty and block is false. Raise EOFError at the end mark.
+        """
+        if not self._used.acquire(block):
+            return None
+        offset = self._tail * self._stride
+        length, if_idx, sub_if_idx, direction, handle = _slot_header.unpack_from(self._view, offset)
+        if length != _END:
+            start = offset + _slot_header.size
+            raw_packet = bytearray(self._view[start:start + length])
+        self._tail = (self._tail + 1) % self.slots
+        self._free.release()
+        if length == _END:
+            raise EOFError("End of the ring")
+        return raw_packet, CapturedMetadata((if_idx, sub_if_idx), direction), handle
+
+
+def _results(result):
+    if result is None:
+        return []
+    if isinstance(result, (CapturedPacket, tuple)):
+        return [result]
+    return result
+
+
+def _work(inputs, outputs, callback, raw, counters, on_error):
+    """
+    The main loop of a worker process. counters holds the packets processed, dropped and the errors.
+    """
+    while True:
+        try:
+            raw_packet, meta, handle = inputs.get()
+        except EOFError:
+            break
+        packet = (raw_packet, meta) if raw else parse_packet(raw_packet, meta)
+        try:
+            results = _results(callback(packet))
+            for result in results:
+                if isinstance(result, CapturedPacket):
+                    if not result.refresh_checksums():
+                        result.update_checksums()
+                    outputs.put(result.raw_view(), result.meta, handle)
+                else:
+                    outputs.put(result[0], result[1], handle)
+        except Exception as error:
+            counters[2] += 1
+            if on_error is not None:
+                try:
+                    on_error(packet, error)
+                except Exception:
+                    logger.exception("on_error failed to handle %r", error)
+            continue
+        counters[0] += 1
+        if not results:
+            counters[1] += 1
+    outputs.put_end()
+
+
+class ProcessPipeline(object):
+    """
+    Processes the packets diverted to handles (an Handle or a list of them) with callback, on worker processes.
+
+    callback(packet) is called as for pydivert.pipeline.Pipeline: it gets an high level packet, or a
+    (raw_packet, meta) pair if raw is true, and returns what to reinject (None, a packet or a list of packets).
+    If it raises, the packet is dropped and on_error(packet, error) is called in the worker process.
+    Errors of DivertRecv() are passed to on_error in this process, with a None packet, and the receivers keep going
+    until the pipeline is stopped, backing off as the ones of a Pipeline. Errors raised by on_error are logged.
+
+    Each worker has two rings of ring_slots packets of at most bufsize bytes. When the ring to a worker is full,
+    the receiver waits, leaving packets queued in the driver. context is the multiprocessing module or context
+    used to create processes and shared memory.
+    """
+
+    def __init__(self, handles, callback, workers=None, ring_slots=256, batch_size=BATCH_SIZE, batch_timeout=0,
+                 raw=False, bufsize=PACKET_BUFFER_SIZE, on_error=None, context=multiprocessing):
+        self.handles = list(handles) if isinstance(handles, (tuple, list)) else [handles]
+        self.callback = callback
+        self.workers = workers or context.cpu_count()
+        self.ring_slots = ring_slots
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.raw = raw
+        self.bufsize = bufsize
+        self.on_error = on_error
+        self.context = context
+        self._inputs = []
+        self._outputs = []
+        self._counters = []
+        self._processes = []
+        self._receivers = []
+        self._senders = []
+        self._send_counters = []
+        self._received = []
+        self._recv_errors = []
+        self._running = False
+        self._stopping = threading.Event()
+
+    def start(self):
+        """
+        Opens the handles, unless already opened, starts the worker processes and the threads receiving and
+        sending packets
+        """
+        if self._running:
+            return self
+        self._running = True
+        self._stopping.clear()
+        for handle in self.handles:
+            if not handle.is_opened:
+                handle.open()
+        context = self.context
+        self._inputs = [SharedRing(self.ring_slots, self.bufsize, context) for _ in range(self.workers)]
+        self._outputs = [SharedRing(self.ring_slots, self.bufsize, context) for _ in range(self.workers)]
+        self._counters = [context.RawArray(ctypes.c_uint64, 3) for _ in range(self.workers)]
+        self._processes = [context.Process(target=_work, name="pydivert-worker-%d" % index,
+                                           args=(inputs, outputs, self.callback, self.raw, counters,
+                                                 self.on_error))
+                           for index, (inputs, outputs, counters) in
+                           enumerate(zip(self._inputs, self._outputs, self._counters))]
+        for process in self._processes:
+            process.daemon = True
+            process.start()
+        self._received = [0] * len(self.handles)
+        self._recv_errors = [0] * len(self.handles)
+        self._send_counters = [[0, 0] for _ in range(self.workers)]
+        self._senders = [self._thread(self._send, "pydivert-send-%d" % index, index)
+                         for index in range(self.workers)]
+        self._receivers = [self._thread(self._receive, "pydivert-recv-%d" % index, index)
+                           for index in range(len(self.handles))]
+        return self
+
+    def _thread(self, target, name, argument):
+        thread = threading.Thread(target=target, name=name, args=(argument,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @property
+    def counters(self):
+        """
+        Return the number of packets received, processed by the callback, sent, dropped by the callback and
+        of errors
+        """
+        processed, dropped, errors = 0, 0, 0
+        for counters in self._counters:
+            processed += counters[0]
+            dropped += counters[1]
+            errors += counters[2]
+        return {"received": sum(self._received), "processed": processed,
+                "sent": sum(sent for sent, failed in self._send_counters), "dropped": dropped,
+                "errors": errors + sum(failed for sent, failed in self._send_counters) + sum(self._recv_errors)}
+
+    def _receive(self, index):
+        handle, inputs, workers = self.handles[index], self._inputs, self.workers
+        backoff = 0
+        while self._running:
+            try:
+                records = handle.recv_many(self.batch_size, self.bufsize, self.batch_timeout)
+            except Exception as error:
+                if not self._running or not handle.is_opened:
+                    # The handle has been closed
+                    break
+                self._recv_errors[index] += 1
+                if self.on_error is not None:
+                    try:
+                        self.on_error(None, error)
+                    except Exception:
+                        logger.exception("on_error failed to handle %r", error)
+                backoff = min(backoff * 2 or ERROR_BACKOFF, MAX_ERROR_BACKOFF)
+                self._stopping.wait(backoff)
+                continue
+            backoff = 0
+            self._received[index] += len(records)
+            for raw_packet, meta in records:
+                inputs[flow_hash(raw_packet) % workers].put(raw_packet, meta, index)
+
+    def _send(self, index):
+        outputs, counters, handles = self._outputs[index], self._send_counters[index], self.handles
+        ended = False
+        while not ended:
+            batch = []
+            try:
+                batch.append(outputs.get())
+                while len(batch) < self.batch_size:
+                    item = outputs.get(False)
+                    if item is None:
+                        break
+                    batch.append(item)
+            except EOFError:
+                ended = True
+            # Packets of the same handle are sent in a batch, keeping their order
+            while batch:
+                handle = batch[0][2]
+                packets = []
+                while batch and batch[0][2] == handle:
+                    raw_packet, meta, _ = batch.pop(0)
+                    packets.append((raw_packet, meta))
+                try:
+                    results = handles[handle].send_many(packets)
+                except Exception as error:
+                    results = [error] * len(packets)
+                for result in results:
+                    counters[1 if isinstance(result, Exception) else 0] += 1
+
+    def stop(self):
+        """
+        Closes the handles, which stops the receivers, and waits for the workers to process the packets
+        already received. Packets processed after the handles have been closed can't be reinjected.
+        Workers which died are not waited for: the packets left in their rings are dropped.
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._stopping.set()
+        for handle in self.handles:
+            if handle.is_opened:
+                handle.close()
+        for thread in self._receivers:
+            thread.join(0.1)
+            while thread.is_alive():
+                # The receiver may be waiting for room in the ring of a dead worker: empty it
+                for inputs, process in zip(self._inputs, self._processes):
+                    while not process.is_alive() and inputs.get(False) is not None:
+                        pass
+                thread.join(0.1)
+        for inputs, process in zip(self._inputs, self._processes):
+            while process.is_alive() and not inputs.put_end(0.1):
+                pass
+        for thread, outputs, process in zip(self._senders, self._outputs, self._processes):
+            ended = False
+            thread.join(0.1)
+            while thread.is_alive():
+                if not ended and process.exitcode not in (None, 0):
+                    # The worker died without marking the end of its results
+                    ended = outputs.put_end(0.1)
+                thread.join(0.1)
+        for process in self._processes:
+            process.join()
+        self._receivers, self._senders, self._processes = [], [], []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+TCP stream reassembly over diverted packets.
+
+A StreamReassembler is fed TCP packets and hands over the bytes of each direction of a connection in order,
+once and only once, whatever the order the segments arrive in:
+
+    def on_data(stream, data):
+        if stream.from_client and stream.position == len(data):
+            ...  # the first bytes sent by the client
+
+    reassembler = StreamReassembler(on_data)
+    while True:
+        for packet in handle.receive_many():
+            reassembler.feed(packet)
+            handle.send(packet)
+
+Data received in order is never copied nor concatenated: it is handed over as memoryviews over the buffers of
+the packets. Only the payload of the segments received ahead of the missing ones is copied, so that holding them
+doesn't keep whole packet buffers alive. These are bounded for each stream (max_buffer) and overall (max_memory):
+beyond, segments are dropped and the gap left is never filled.
+"""
+import bisect
+import struct
+import time
+
+from pydivert.flows import FlowTable, TCP_SYN, TCP_FIN, TCP_RST, _endpoints
+
+__author__ = 'fabio'
+
+_byte = struct.Struct("!B")
+_word = struct.Struct("!H")
+# Sequence number, acknowledgement number, data offset and flags
+_tcp = struct.Struct("!IIBB")
+
+_SEQ_MASK = 0xFFFFFFFF
+
+
+def _distance(seq, reference):
+    """
+    Return the signed distance between two sequence numbers, taking wrapping into account
+    """
+    return ((seq - reference + 0x80000000) & _SEQ_MASK) - 0x80000000
+
+
+class Stream(object):
+    """
+    One direction of a TCP connection. position is the number of bytes handed over so far. Once closed, either
+    complete (the FIN has been reached) or not (reset, expired or evicted), no more data is handed over.
+    data is free for the application to use, e.g. to hold the state of a parser.
+    """
+    __slots__ = ("flow", "from_client", "next_seq", "position", "positions", "segments", "buffered", "fin",
+                 "closed", "complete", "data")
+
+    def __init__(self, flow, from_client):
+        self.flow = flow
+        self.from_client = from_client
+        # The sequence number of the byte at position
+        self.next_seq = None
+        self.position = 0
+        # The segments received out of order and their positions, sorted
+        self.positions = []
+        self.segments = []
+        self.buffered = 0
+        # The position of the FIN, once seen
+        self.fin = None
+        self.closed = False
+        self.complete = False
+        self.data = None
+
+    def __repr__(self):
+        return "Stream({} --> {}, position={}, buffered={})".format(
+            *((self.flow.client, self.flow.server) if self.from_client else (self.flow.server, self.flow.client)) +
+            (self.position, self.buffered))
+
+
+class StreamReassembler(object):
+    """
+    Reassembles the TCP streams of the packets given to feed().
+
+    on_data(stream, data) is called with each new chunk of a stream, in order, and on_close(stream) once a stream
+    is closed. Connections are tracked by a FlowTable (flows), built with max_flows, timeouts and clock: the streams
+    of a flow are kept in flow.data. Streams of expired or evicted flows are closed.
+
+    At most max_buffer bytes are held out of order for each stream and max_memory overall.
+    """
+
+    def __init__(self, on_data=None, on_close=None, max_buffer=256 * 1024, max_memory=64 * 1024 * 1024,
+                 max_flows=100000, timeouts=None, clock=time.time):
+        self.on_data = on_data
+        self.on_close = on_close
+        self.max_buffer = max_buffer
+        self.max_memory = max_memory
+        self.flows = FlowTable(max_flows, timeouts, clock=clock, on_expire=self._expired)
+        self.buffered = 0
+        # Bytes handed over, bytes received again, segments dropped for lack of room
+        self.counters = {"delivered": 0, "duplicate": 0, "dropped": 0}
+
+    def feed(self, packet, now=None):
+        """
+        Accounts a packet (a CapturedPacket or a raw packet) to its stream. Return the list of (stream, data)
+        handed over thanks to it, possibly empty.
+
+        Data handed over right away refers to the packet buffer: it must not be used once the raw packet is reused,
+        e.g. the views returned by Handle.recv_many(). Packets which are not TCP are ignored.
+        """
+        raw = packet.raw_view() if hasattr(packet, "raw_view") else packet
+        endpoints = _endpoints(raw)
+        if endpoints is None or endpoints[0] != 6 or not endpoints[2] | endpoints[4]:
+            return []
+        protocol, src_addr, src_port, dst_addr, dst_port, transport = endpoints
+        length = len(raw)
+        if length < transport + 20:
+            return []
+        seq, _, offset, flags = _tcp.unpack_from(raw, transport + 4)
+        start = transport + (offset >> 4) * 4
+        if _byte.unpack_from(raw)[0] >> 4 == 4:
+            end = _word.unpack_from(raw, 2)[0]
+        else:
+            end = _word.unpack_from(raw, 4)[0] + 40
+        # A zero length is left by segmentation offload
+        end = min(end, length) if end else length
+
+        flow = self.flows.update(raw, now)
+        streams = flow.data
+        if streams is None:
+            streams = flow.data = [None, None]
+        ready = []
+        if flags & TCP_RST:
+            for stream in streams:
+                if stream is not None and not stream.closed:
+                    self._close(stream)
+            return ready
+
+        from_client = src_port == flow.client_port and src_addr == flow.client_addr
+        stream = streams[0 if from_client else 1]
+        if stream is None:
+            stream = streams[0 if from_client else 1] = Stream(flow, from_client)
+        elif stream.closed:
+            return ready
+        if flags & TCP_SYN:
+            seq = (seq + 1) & _SEQ_MASK
+            if not stream.position and not stream.positions:
+                stream.next_seq = seq
+        elif stream.next_seq is None:
+            # Picked up in the middle
+            stream.next_seq = seq
+
+        position = stream.position + _distance(seq, stream.next_seq)
+        if flags & TCP_FIN:
+            stream.fin = position + max(end - start, 0)
+        if end > start:
+            self._add(stream, position, memoryview(raw)[start:end], ready)
+        if stream.fin is not None and stream.position >= stream.fin:
+            stream.complete = True
+            self._close(stream)
+        return ready
+
+    def _add(self, stream, position, data, ready):
+        size = len(data)
+        if position + size <= stream.position:
+            self.counters["duplicate"] += size
+        elif position <= stream.position:
+            overlap = stream.position - position
+            self.counters["duplicate"] += overlap
+            self._deliver(stream, data[overlap:], ready)
+            self._drain(stream, ready)
+        elif stream.buffered + size > self.max_buffer or self.buffered + size > self.max_memory:
+            self.counters["dropped"] += 1
+        else:
+            index = bisect.bisect_right(stream.positions, position)
+            stream.positions.insert(index, position)
+            # A copy of the payload only: a view would keep the whole packet buffer alive
+            stream.segments.insert(index, memoryview(data.tobytes()))
+            stream.buffered += size
+            self.buffered += size
+
+    def _drain(self, stream, ready):
+        """
+        Hands over the segments received out of order that the stream has reached
+        """
+        positions, segments = stream.positions, stream.segments
+        while positions and positions[0] <= stream.position:
+            position, data = positions.pop(0), segments.pop(0)
+            stream.buffered -= len(data)
+            self.buffered -= len(data)
+            if position + len(data) <= stream.position:
+                self.counters["duplicate"] += len(data)
+            else:
+                self.counters["duplicate"] += stream.position - position
+                self._deliver(stream, data[stream.position - position:], ready)
+
+    def _deliver(self, stream, data, ready):
+        stream.position += len(data)
+        stream.next_seq = (stream.next_seq + len(data)) & _SEQ_MASK
+        self.counters["delivered"] += len(data)
+        ready.append((stream, data))
+        if self.on_data is not None:
+            self.on_data(stream, data)
+
+    def _close(self, stream):
+        stream.closed = True
+        self.buffered -= stream.buffered
+        stream.buffered = 0
+        stream.positions, stream.segments = [], []
+        if self.on_close is not None:
+            self.on_close(stream)
+
+    def _expired(self, flow):
+        for stream in flow.data or ():
+            if stream is not None and not stream.closed:
+                self._close(stream)
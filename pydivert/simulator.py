@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+An in-memory WinDivert, to run the whole recv/modify/send pipeline where the driver is not available.
+
+SimulatedLibrary exposes the same functions as WinDivert.dll, called the same way through ctypes
+arguments, so it can be plugged in place of the DLL:
+
+    driver = WinDivert(library=SimulatedLibrary())
+
+Packets enter the simulated network stack with inject() and are diverted to the matching handles,
+honoring priorities (lower values first) and the SNIFF/DROP flags. Packets no handle diverted, or
+reinjected with DivertSend(), past the last handle are delivered: they are collected in the
+delivered queue.
+"""
+from collections import deque
+import ctypes
+import socket
+import struct
+import threading
+import time
+
+from pydivert import checksum
+from pydivert.filters import compile_filter
+from pydivert.enum import Layer, Flag, Param, Direction, PARAM_BOUNDS
+from pydivert.models import CapturedMetadata
+from pydivert.winutils import string_to_packed
+
+__author__ = 'fabio'
+
+INVALID_HANDLE_VALUE = -1
+
+ERROR_INVALID_HANDLE = 6
+ERROR_NOT_SUPPORTED = 50
+ERROR_INVALID_PARAMETER = 87
+ERROR_INSUFFICIENT_BUFFER = 122
+ERROR_NO_DATA = 232
+ERROR_OPERATION_ABORTED = 995
+
+PRIORITY_MIN = -1000
+PRIORITY_MAX = 1000
+
+_params = PARAM_BOUNDS
+
+
+def _deref(arg):
+    """
+    Return the object referenced by a ctypes.byref() argument, or the argument itself
+    """
+    return getattr(arg, "_obj", arg)
+
+
+class SimulatedHandle(object):
+    """
+    The state of a handle opened on the simulated driver
+    """
+
+    def __init__(self, value, predicate, layer, priority, flags):
+        self.value = value
+        self.predicate = predicate
+        self.layer = layer
+        self.priority = priority
+        self.flags = flags
+        self.queue = deque()
+        self.params = dict((name, default) for name, (low, default, high) in _params.items())
+        self.closed = False
+
+    def __lt__(self, other):
+        return (self.priority, self.value) < (other.priority, other.value)
+
+
+class SimulatedLibrary(object):
+    """
+    A stand-in for WinDivert.dll keeping diverted packets in memory.
+
+    compile_filter turns the filter strings given to DivertOpen() into predicates(raw_packet, meta),
+    raising ValueError for invalid ones. By default filters are evaluated by pydivert.filters.
+
+    recv_timeout is how long (in seconds) DivertRecv() waits for a packet before failing with ERROR_NO_DATA.
+    By default it blocks until a packet arrives or the handle is closed, like the driver does.
+    clock is the time source used to expire queued packets older than the QUEUE_TIME parameter.
+    """
+
+    def __init__(self, compile_filter=compile_filter, recv_timeout=None, clock=time.time):
+        self.compile_filter = compile_filter
+        self.recv_timeout = recv_timeout
+        self.clock = clock
+        self.delivered = deque()
+        self.counters = dict.fromkeys(("injected", "diverted", "sniffed", "dropped", "expired", "delivered"), 0)
+        self._handles = {}
+        self._ordered = []
+        self._next_value = 1
+        self._condition = threading.Condition()
+        self._errors = threading.local()
+
+    def GetLastError(self):
+        """
+        The error code of the last call made by the current thread
+        """
+        return getattr(self._errors, "code", 0)
+
+    def _result(self, value, code=0):
+        self._errors.code = code
+        return value
+
+    def inject(self, raw_packet, direction=Direction.OUTBOUND, iface=(1, 0), layer=Layer.NETWORK):
+        """
+        Make a packet enter the simulated network stack, as if it came from an application (outbound)
+        or from the wire (inbound)
+        """
+        with self._condition:
+            self.counters["injected"] += 1
+            self._route(bytes(raw_packet), CapturedMetadata(tuple(iface), direction), layer, None)
+
+    def _route(self, raw_packet, meta, layer, after):
+        """
+        Divert the packet to the first matching handle after the given one in priority order, or deliver it.
+        Must be called holding the lock.
+        """
+        for handle in self._ordered:
+            if handle.layer != layer or (after is not None and handle.priority <= after.priority):
+                continue
+            if not handle.predicate(raw_packet, meta):
+                continue
+            if handle.flags & Flag.DROP:
+                self.counters["dropped"] += 1
+                return
+            if len(handle.queue) >= handle.params[Param.QUEUE_LEN]:
+                # The queue is full: the driver drops the packet, or just the copy of a sniffing handle
+                self.counters["dropped"] += 1
+                if handle.flags & Flag.SNIFF:
+                    continue
+                return
+            handle.queue.append((raw_packet, meta, self.clock()))
+            self._condition.notify_all()
+            if handle.flags & Flag.SNIFF:
+                self.counters["sniffed"] += 1
+                continue
+            self.counters["diverted"] += 1
+            return
+        self.counters["delivered"] += 1
+        self.delivered.append((raw_packet, meta))
+
+    def _get_handle(self, value):
+        handle = self._handles.get(value)
+        if handle is None or handle.closed:
+            return None
+        return handle
+
+    def DivertOpen(self, filter, layer, priority, flags):
+        if isinstance(filter, bytes):
+            filter = filter.decode("UTF-8")
+        if layer not in (Layer.NETWORK, Layer.NETWORK_FORWARD) or not PRIORITY_MIN <= priority <= PRIORITY_MAX \
+                or flags & ~(Flag.SNIFF | Flag.DROP):
+            return self._result(INVALID_HANDLE_VALUE, ERROR_INVALID_PARAMETER)
+        try:
+            predicate = self.compile_filter(filter)
+        except ValueError:
+            return self._result(INVALID_HANDLE_VALUE, ERROR_INVALID_PARAMETER)
+        with self._condition:
+            value = self._next_value
+            self._next_value += 1
+            handle = SimulatedHandle(value, predicate, layer, priority, flags)
+            self._handles[value] = handle
+            self._ordered = sorted(self._ordered + [handle])
+        return self._result(value)
+
+    def DivertClose(self, handle):
+        with self._condition:
+            handle = self._get_handle(handle)
+            if handle is None:
+                return self._result(0, ERROR_INVALID_HANDLE)
+            handle.closed = True
+            handle.queue.clear()
+            self._ordered.remove(handle)
+            del self._handles[handle.value]
+            self._condition.notify_all()
+        return self._result(1)
+
+    def _next_packet(self, handle):
+        """
+        Pop the next queued packet not older than QUEUE_TIME, None if there's none
+        """
+        max_age = handle.params[Param.QUEUE_TIME] / 1000.0
+        now = self.clock()
+        while handle.queue:
+            raw_packet, meta, timestamp = handle.queue.popleft()
+            if now - timestamp <= max_age:
+                return raw_packet, meta
+            self.counters["expired"] += 1
+        return None
+
+    def DivertRecv(self, handle, packet, packet_len, address, recv_len):
+        return self.DivertRecvTimeout(handle, packet, packet_len, address, recv_len, self.recv_timeout)
+
+    def DivertRecvTimeout(self, handle, packet, packet_len, address, recv_len, timeout):
+        """
+        DivertRecv() waiting at most timeout seconds (forever if None) before failing with ERROR_NO_DATA
+        """
+        with self._condition:
+            handle = self._get_handle(handle)
+            if handle is None:
+                return self._result(0, ERROR_INVALID_HANDLE)
+            deadline = self.clock() + timeout if timeout is not None else None
+            item = self._next_packet(handle)
+            while item is None:
+                if handle.closed:
+                    return self._result(0, ERROR_OPERATION_ABORTED)
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - self.clock()
+                    if timeout <= 0:
+                        return self._result(0, ERROR_NO_DATA)
+                self._condition.wait(timeout)
+                item = self._next_packet(handle)
+        raw_packet, meta = item
+        length = min(len(raw_packet), packet_len)
+        ctypes.memmove(packet, raw_packet, length)
+        if address is not None:
+            address = _deref(address)
+            address.IfIdx, address.SubIfIdx = meta.iface
+            address.Direction = meta.direction
+        if recv_len is not None:
+            _deref(recv_len).value = length
+        if length < len(raw_packet):
+            return self._result(0, ERROR_INSUFFICIENT_BUFFER)
+        return self._result(1)
+
+    def DivertSend(self, handle, packet, packet_len, address, send_len):
+        with self._condition:
+            handle = self._get_handle(handle)
+            if handle is None:
+                return self._result(0, ERROR_INVALID_HANDLE)
+            address = _deref(address)
+            meta = CapturedMetadata((address.IfIdx, address.SubIfIdx), address.Direction)
+            # Reinjected packets may be diverted again by lower priority handles only
+            self._route(ctypes.string_at(packet, packet_len), meta, handle.layer, handle)
+        if send_len is not None:
+            _deref(send_len).value = packet_len
+        return self._result(1)
+
+    def DivertGetParam(self, handle, param, value):
+        handle = self._get_handle(handle)
+        if handle is None:
+            return self._result(0, ERROR_INVALID_HANDLE)
+        if param not in handle.params:
+            return self._result(0, ERROR_INVALID_PARAMETER)
+        _deref(value).value = handle.params[param]
+        return self._result(1)
+
+    def DivertSetParam(self, handle, param, value):
+        handle = self._get_handle(handle)
+        if handle is None:
+            return self._result(0, ERROR_INVALID_HANDLE)
+        if param not in _params or not _params[param][0] <= value <= _params[param][2]:
+            return self._result(0, ERROR_INVALID_PARAMETER)
+        handle.params[param] = value
+        return self._result(1)
+
+    def DivertHelperCalcChecksums(self, packet, packet_len, flags):
+        view = memoryview(_deref(packet))[:packet_len]
+        if view.readonly:
+            # Nowhere to write the checksums to
+            view = bytearray(view)
+        return self._result(checksum.update_checksums(view, flags))
+
+    def DivertHelperParsePacket(self, *args):
+        # Packets are parsed by pydivert.parser
+        return self._result(0, ERROR_NOT_SUPPORTED)
+
+    def DivertHelperParseIPv4Address(self, address, value):
+        try:
+            packed = string_to_packed(socket.AF_INET, address.decode("UTF-8"))
+        except (socket.error, ValueError, UnicodeDecodeError):
+            return self._result(0, ERROR_INVALID_PARAMETER)
+        if value is not None:
+            _deref(value).value = struct.unpack("!I", packed)[0]
+        return self._result(1)
+
+    def DivertHelperParseIPv6Address(self, address, value):
+        try:
+            packed = string_to_packed(socket.AF_INET6, address.decode("UTF-8"))
+        except (socket.error, ValueError, UnicodeDecodeError):
+            return self._result(0, ERROR_INVALID_PARAMETER)
+        if value is not None:
+            _deref(value)[:] = struct.unpack("<8H", packed)
+        return self._result(1)
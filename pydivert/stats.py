@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runtime statistics of handles.
+
+Statistics are disabled by default: handles then only check that their stats attribute is None on
+the hot paths. Once enabled with Handle.enable_stats(), handles count packets and errors and record
+how long the driver calls and the packet processing take:
+
+    stats = handle.enable_stats()
+    ...
+    stats.snapshot()["counters"]["received"]
+
+A Reporter periodically passes the snapshots of some handles to an exporter, any callable taking a
+name and a snapshot (e.g. log_exporter).
+"""
+import bisect
+import logging
+import threading
+import time
+
+__author__ = 'fabio'
+
+# The best clock available for measuring durations
+clock = time.perf_counter
+
+COUNTERS = ("received", "sent", "dropped", "recv_errors", "send_errors", "errors")
+
+# recv_wait: time spent in DivertRecv, parse: parsing a packet, callback: processing it in a Pipeline,
+# checksum: updating its checksums before sending, send: time spent in DivertSend
+TIMINGS = ("recv_wait", "parse", "callback", "checksum", "send")
+
+# Upper bounds (in seconds) of the histogram buckets: 1us to about 8s, doubling each time
+BUCKETS = tuple(1e-6 * 2 ** exponent for exponent in range(24))
+
+
+class Histogram(object):
+    """
+    A latency histogram with fixed exponential buckets, see BUCKETS.
+    The last bucket holds the values beyond the last bound.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value, count=1):
+        """
+        Records count values (in seconds), e.g. the mean duration of each packet of a batch
+        """
+        self.buckets[bisect.bisect_left(self.bounds, value)] += count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Return the upper bound of the bucket holding the given percentile, None if nothing has been recorded
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        """
+        Return a dictionary with the count, mean, max and main percentiles (in seconds) and the buckets
+        """
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "buckets": list(self.buckets)}
+
+
+class HandleStats(object):
+    """
+    The counters and timings of an handle, see COUNTERS and TIMINGS, and gauges: values set by other
+    components, e.g. the queue parameters chosen by pydivert.tuning.
+    Updates take a lock, so that several threads may share the handle.
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.timings = dict((name, Histogram()) for name in TIMINGS)
+        self.gauges = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def record(self, name, value, count=1):
+        """
+        Records the duration of count operations, value being the duration of each one
+        """
+        with self._lock:
+            self.timings[name].record(value, count)
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.timings = dict((name, Histogram()) for name in TIMINGS)
+            self.gauges = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        """
+        Return a dictionary with a copy of the counters, the gauges, the timings and the time since they are
+        collected
+        """
+        with self._lock:
+            return {"uptime": time.time() - self.started,
+                    "counters": dict(self.counters),
+                    "gauges": dict(self.gauges),
+                    "timings": dict((name, histogram.snapshot()) for name, histogram in self.timings.items())}
+
+
+def log_exporter(logger=None, level=logging.INFO):
+    """
+    Return an exporter logging the counters, the gauges and the mean/p99 timings
+    """
+    logger = logger or logging.getLogger("pydivert.stats")
+
+    def export(name, snapshot):
+        timings = " ".join("{}={:.1f}/{:.1f}us".format(timing, values["mean"] * 1e6, values["p99"] * 1e6)
+                           for timing, values in sorted(snapshot["timings"].items()) if values["count"])
+        counters = " ".join("{}={}".format(counter, value) for counter, value in
+                            sorted(list(snapshot["counters"].items()) + list(snapshot["gauges"].items())))
+        logger.log(level, "%s: %s %s", name, counters, timings)
+
+    return export
+
+
+class Reporter(object):
+    """
+    Exports the statistics of some handles every interval seconds from a background thread.
+    handles maps the names to export the handles with, to the handles themselves.
+    """
+
+    def __init__(self, handles, exporter, interval=60.0):
+        self.handles = handles
+        self.exporter = exporter
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def export(self):
+        """
+        Exports the statistics now
+        """
+        for name, handle in self.handles.items():
+            if handle.stats is not None:
+                self.exporter(name, handle.stats.snapshot())
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.export()
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="pydivert-stats")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the thread, exporting the statistics a last time
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
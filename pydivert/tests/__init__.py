@@ -15,7 +15,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 #SocketServer has been renamed in python3 to socketserver
+from collections import deque
+import ctypes
 import socket
+import struct
+
 
 try:
     from socketserver import ThreadingMixIn, TCPServer, UDPServer, BaseRequestHandler
@@ -114,4 +118,155 @@ def random_free_port(family=socket.AF_INET, type=socket.SOCK_STREAM):
         s.bind(("", 0))
         return s.getsockname()[1]
     finally:
-        s.close()
\ No newline at end of file
+        s.close()
+
+
+def ipv4_tcp_packet(src_addr="10.0.0.1", dst_addr="10.0.0.2", src_port=1234, dst_port=80,
+                    payload=b"", flags=0x18, tcp_options=b"", ip_options=b"", ttl=64, ip_id=1, frag_off=0x4000):
+    """
+    Build a raw IPv4/TCP packet. Checksums are left to zero.
+    """
+    tcp_len = 20 + len(tcp_options)
+    tcp = struct.pack("!HHIIBBHHH", src_port, dst_port, 1, 0, (tcp_len // 4) << 4, flags, 8192, 0, 0)
+    ip_len = 20 + len(ip_options)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x40 | (ip_len // 4), 0, ip_len + tcp_len + len(payload), ip_id,
+                     frag_off, ttl, 6, 0, socket.inet_aton(src_addr), socket.inet_aton(dst_addr))
+    return ip + ip_options + tcp + tcp_options + payload
+
+
+def ipv4_udp_packet(src_addr="10.0.0.1", dst_addr="10.0.0.2", src_port=1234, dst_port=53, payload=b"", ttl=64):
+    """
+    Build a raw IPv4/UDP packet. Checksums are left to zero.
+    """
+    udp = struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 28 + len(payload), 1, 0, ttl, 17, 0,
+                     socket.inet_aton(src_addr), socket.inet_aton(dst_addr))
+    return ip + udp + payload
+
+
+def ipv4_icmp_packet(src_addr="10.0.0.1", dst_addr="10.0.0.2", icmp_type=8, payload=b""):
+    """
+    Build a raw IPv4/ICMP packet. Checksums are left to zero.
+    """
+    icmp = struct.pack("!BBHI", icmp_type, 0, 0, 0x00010001)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 28 + len(payload), 1, 0, 64, 1, 0,
+                     socket.inet_aton(src_addr), socket.inet_aton(dst_addr))
+    return ip + icmp + payload
+
+
+def ipv6_packet(next_hdr, transport, src_addr="fe80::1", dst_addr="fe80::2", payload=b"", hop_limit=64):
+    """
+    Build a raw IPv6 packet carrying the given (already packed) upper layer header.
+    """
+    ip = struct.pack("!IHBB16s16s", 0x60000000, len(transport) + len(payload), next_hdr, hop_limit,
+                     socket.inet_pton(socket.AF_INET6, src_addr), socket.inet_pton(socket.AF_INET6, dst_addr))
+    return ip + transport + payload
+
+
+def ipv6_tcp_packet(src_addr="fe80::1", dst_addr="fe80::2", src_port=1234, dst_port=80, payload=b"", flags=0x18):
+    """
+    Build a raw IPv6/TCP packet. Checksums are left to zero.
+    """
+    tcp = struct.pack("!HHIIBBHHH", src_port, dst_port, 1, 0, 5 << 4, flags, 8192, 0, 0)
+    return ipv6_packet(6, tcp, src_addr, dst_addr, payload)
+
+
+def ipv6_udp_packet(src_addr="fe80::1", dst_addr="fe80::2", src_port=1234, dst_port=53, payload=b""):
+    """
+    Build a raw IPv6/UDP packet. Checksums are left to zero.
+    """
+    udp = struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0)
+    return ipv6_packet(17, udp, src_addr, dst_addr, payload)
+
+
+def internet_checksum(data):
+    """
+    Straightforward RFC 1071 checksum, used as a reference
+    """
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def with_checksums(raw):
+    """
+    Return a copy of an IPv4/IPv6 TCP/UDP/ICMP packet with all the checksums computed from scratch
+    """
+    raw = bytearray(raw)
+    if raw[0] >> 4 == 4:
+        ip_len = (raw[0] & 0x0F) * 4
+        raw[10:12] = b"\x00\x00"
+        raw[10:12] = struct.pack("!H", internet_checksum(bytes(raw[:ip_len])))
+        protocol = raw[9]
+        pseudo = bytes(raw[12:20]) + struct.pack("!BBH", 0, protocol, len(raw) - ip_len)
+    else:
+        ip_len = 40
+        protocol = raw[6]
+        pseudo = bytes(raw[8:40]) + struct.pack("!IxxxB", len(raw) - ip_len, protocol)
+    offset = {6: 16, 17: 6, 1: 2, 58: 2}[protocol]
+    raw[ip_len + offset:ip_len + offset + 2] = b"\x00\x00"
+    segment = bytes(raw[ip_len:])
+    checksum = internet_checksum(segment if protocol == 1 else pseudo + segment)
+    if protocol == 17 and not checksum:
+        checksum = 0xFFFF
+    raw[ip_len + offset:ip_len + offset + 2] = struct.pack("!H", checksum)
+    return bytes(raw)
+
+
+class FakeDivertLibrary(object):
+    """
+    Minimal stand-in for WinDivert.dll replaying queued packets, to test handles without the driver.
+    Queued items are (raw_packet, (IfIdx, SubIfIdx), direction) triples.
+    """
+
+    def __init__(self, packets=()):
+        self.queue = deque(packets)
+        self.sent = []
+        self.checksummed = []
+        self.recv_calls = 0
+        self.fail_sends = 0
+        self.last_error = 0
+
+    def GetLastError(self):
+        return self.last_error
+
+    def DivertOpen(self, filter, layer, priority, flags):
+        return 1
+
+    def DivertClose(self, handle):
+        return 1
+
+    def DivertRecv(self, handle, packet, packet_len, address, recv_len):
+        self.recv_calls += 1
+        if not self.queue:
+            # ERROR_NO_DATA
+            self.last_error = 232
+            return 0
+        raw, iface, direction = self.queue.popleft()
+        ctypes.memmove(packet, raw, len(raw))
+        address._obj.IfIdx, address._obj.SubIfIdx = iface
+        address._obj.Direction = direction
+        recv_len._obj.value = len(raw)
+        return 1
+
+    def DivertRecvTimeout(self, handle, packet, packet_len, address, recv_len, timeout):
+        return self.DivertRecv(handle, packet, packet_len, address, recv_len)
+
+    def DivertSend(self, handle, packet, packet_len, address, send_len):
+        if self.fail_sends:
+            self.fail_sends -= 1
+            # ERROR_INVALID_PARAMETER
+            self.last_error = 87
+            return 0
+        self.sent.append((ctypes.string_at(packet, packet_len),
+                          (address._obj.IfIdx, address._obj.SubIfIdx),
+                          address._obj.Direction))
+        send_len._obj.value = packet_len
+        return 1
+
+    def DivertHelperCalcChecksums(self, packet, packet_len, flags):
+        self.checksummed.append(ctypes.string_at(packet, packet_len))
+        return 0
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import unittest
+
+from pydivert.aio import AsyncHandle
+from pydivert.enum import Direction
+from pydivert.simulator import SimulatedLibrary
+from pydivert.parser import parse_packet
+from pydivert.tests import ipv4_udp_packet
+from pydivert.windivert import WinDivert, Handle
+
+__author__ = 'fabio'
+
+
+class AsyncHandleTestCase(unittest.TestCase):
+    """
+    Tests the asyncio interface against the simulated driver
+    """
+
+    def setUp(self):
+        self.library = SimulatedLibrary()
+        self.handle = Handle(WinDivert(library=self.library), filter="udp")
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 5))
+
+    def test_iterate_and_send(self):
+        """
+        Tests receiving with async for, modifying and reinjecting packets
+        """
+        async def proxy():
+            async with AsyncHandle(self.handle, batch_size=4) as handle:
+                for port in range(1, 11):
+                    self.library.inject(ipv4_udp_packet(dst_port=port))
+                ports = []
+                async for packet in handle:
+                    ports.append(packet.dst_port)
+                    packet.dst_port += 1000
+                    await handle.send(packet)
+                    if len(ports) == 10:
+                        break
+                await handle.drain()
+                return ports
+
+        self.assertEqual(self.run_async(proxy()), list(range(1, 11)))
+        self.assertEqual([parse_packet(raw).dst_port for raw, meta in self.library.delivered],
+                         list(range(1001, 1011)))
+
+    def test_raw(self):
+        """
+        Tests receiving raw packets
+        """
+        async def receive():
+            async with AsyncHandle(self.handle, raw=True) as handle:
+                self.library.inject(ipv4_udp_packet(), Direction.INBOUND, (4, 0))
+                return await handle.recv()
+
+        raw, meta = self.run_async(receive())
+        self.assertEqual(raw, ipv4_udp_packet())
+        self.assertEqual(meta.iface, (4, 0))
+        self.assertTrue(meta.is_inbound())
+
+    def test_backpressure(self):
+        """
+        Tests packets are left to the driver while the application does not consume them
+        """
+        async def receive():
+            async with AsyncHandle(self.handle, max_pending=4, batch_size=2) as handle:
+                for port in range(1, 21):
+                    self.library.inject(ipv4_udp_packet(dst_port=port))
+                await asyncio.sleep(0.1)
+                queued = len(self.library._handles[self.handle._handle].queue)
+                packets = [await handle.recv() for _ in range(20)]
+                return queued, [packet.dst_port for packet in packets]
+
+        queued, ports = self.run_async(receive())
+        # At most max_pending + 2 batches have been taken from the driver
+        self.assertGreaterEqual(queued, 20 - 8)
+        self.assertEqual(ports, list(range(1, 21)))
+
+    def test_close(self):
+        """
+        Tests closing the handle ends the iteration
+        """
+        async def consume(handle, ports):
+            async for packet in handle:
+                ports.append(packet.dst_port)
+
+        async def run():
+            handle = await AsyncHandle(self.handle).open()
+            ports = []
+            task = asyncio.ensure_future(consume(handle, ports))
+            self.library.inject(ipv4_udp_packet(dst_port=53))
+            await asyncio.sleep(0.05)
+            await handle.close()
+            await task
+            with self.assertRaises(EOFError):
+                await handle.recv()
+            return ports
+
+        self.assertEqual(self.run_async(run()), [53])
+        self.assertFalse(self.handle.is_opened)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+
+from pydivert.enum import Direction
+from pydivert.models import CapturedMetadata
+from pydivert.parser import parse_packet
+from pydivert.simulator import SimulatedLibrary
+from pydivert.tests import FakeDivertLibrary, ipv4_tcp_packet, ipv4_udp_packet
+from pydivert.windivert import Handle, WinDivert
+
+__author__ = 'fabio'
+
+
+class BatchReceiveTestCase(unittest.TestCase):
+    """
+    Tests receiving packets in batches against a fake driver library
+    """
+
+    def setUp(self):
+        self.packets = [(ipv4_tcp_packet(dst_port=port, payload=b"data"), (port, 0), Direction.OUTBOUND)
+                        for port in range(1000, 1010)]
+        self.lib = FakeDivertLibrary(self.packets)
+        self.handle = Handle(WinDivert(library=self.lib)).open()
+
+    def test_recv_many(self):
+        """
+        Tests draining packets into (raw_packet, meta) records
+        """
+        records = self.handle.recv_many(4)
+        self.assertEqual(len(records), 4)
+        for (raw, meta), (expected, iface, direction) in zip(records, self.packets):
+            self.assertEqual(bytes(raw), expected)
+            self.assertEqual(meta.iface, iface)
+            self.assertTrue(meta.is_outbound())
+
+    def test_recv_many_partial(self):
+        """
+        Tests a batch is returned as soon as the driver has no more packets
+        """
+        self.assertEqual(len(self.handle.recv_many(8)), 8)
+        self.assertEqual(len(self.handle.recv_many(8)), 2)
+        self.assertRaises(OSError, self.handle.recv_many, 8)
+
+    def test_buffers_reused(self):
+        """
+        Tests the receive buffers are allocated once and reused
+        """
+        first = self.handle.recv_many(2)
+        ring = self.handle._local.ring
+        self.handle.recv_many(2)
+        # The previous batch is still valid while the next one is received
+        self.assertEqual(bytes(first[0][0]), self.packets[0][0])
+        self.handle.recv_many(2)
+        self.assertIs(ring, self.handle._local.ring)
+        self.assertIs(first[0][0].obj, self.handle._local.ring._buffers[0])
+
+    def test_timeout(self):
+        """
+        Tests packets already received are handed over when the timeout expires, even if the driver blocks
+        """
+        library = SimulatedLibrary()
+        with Handle(WinDivert(library=library)) as handle:
+            library.inject(ipv4_udp_packet())
+            start = time.time()
+            self.assertEqual(len(handle.recv_many(8, timeout=0.01)), 1)
+            library.inject(ipv4_udp_packet())
+            self.assertEqual(len(handle.recv_many(8)), 1)
+            self.assertLess(time.time() - start, 1)
+
+    def test_unbounded_wait(self):
+        """
+        Tests the batch is closed after the first packet if the library can't bound the wait for the next ones
+        """
+        self.handle.driver._recv_timeout = None
+        self.assertEqual(len(self.handle.recv_many(8, timeout=1)), 1)
+
+    def test_receive_many(self):
+        """
+        Tests receiving a batch of parsed packets
+        """
+        self.lib.queue.append((ipv4_udp_packet(dst_port=53), (1, 0), Direction.INBOUND))
+        packets = self.handle.receive_many(20)
+        self.assertEqual([packet.dst_port for packet in packets], list(range(1000, 1010)) + [53])
+        self.assertTrue(packets[-1].meta.is_inbound())
+        self.assertEqual(packets[0].payload, b"data")
+
+
+
+class BatchSendTestCase(unittest.TestCase):
+    """
+    Tests sending packets in batches against a fake driver library
+    """
+
+    def setUp(self):
+        self.lib = FakeDivertLibrary()
+        self.handle = Handle(WinDivert(library=self.lib)).open()
+
+    def test_send_many(self):
+        """
+        Tests sending a mix of high level packets and (raw_packet, meta) pairs
+        """
+        meta = CapturedMetadata((5, 1), Direction.INBOUND)
+        packet = parse_packet(ipv4_tcp_packet(payload=b"data"), CapturedMetadata((3, 0), Direction.OUTBOUND))
+        packet.dst_port = 8080
+        rewritten = parse_packet(ipv4_tcp_packet(payload=b"data"), CapturedMetadata((3, 0), Direction.OUTBOUND))
+        rewritten.payload = b"DATA"
+        raw = ipv4_udp_packet(payload=b"query")
+        results = self.handle.send_many([packet, rewritten, (raw, meta), [raw, meta]])
+        self.assertEqual(results, [len(packet.raw), len(rewritten.raw), len(raw), len(raw)])
+        self.assertEqual(self.lib.sent[0], (bytes(packet.raw), (3, 0), Direction.OUTBOUND))
+        self.assertEqual(self.lib.sent[2], (raw, (5, 1), Direction.INBOUND))
+        # Only high level packets with a new payload get their checksums recalculated from scratch
+        self.assertEqual(self.lib.checksummed, [bytes(rewritten.raw)])
+
+    def test_send_dirty_tracking(self):
+        """
+        Tests send() passes unmodified packets as they are, and never parses a packet again
+        """
+        meta = CapturedMetadata((3, 0), Direction.OUTBOUND)
+        packet = parse_packet(ipv4_tcp_packet(payload=b"data"), meta)
+        self.assertFalse(packet.dirty)
+        self.handle.driver.parse_packet = None
+        self.handle.send(packet)
+        self.assertEqual(self.lib.sent[-1][0], ipv4_tcp_packet(payload=b"data"))
+
+        packet.payload = b"DATA!"
+        self.assertTrue(packet.dirty)
+        self.handle.send(packet)
+        self.assertEqual(self.lib.checksummed, [bytes(packet.raw)])
+        self.assertFalse(packet.dirty)
+        packet.dst_port = 8080
+        self.assertTrue(packet.dirty)
+        self.handle.send(packet)
+        self.assertFalse(packet.dirty)
+        self.assertEqual(len(self.lib.checksummed), 1)
+        self.assertEqual(len(self.lib.sent), 3)
+
+    def test_send_raw_payload_edit(self):
+        """
+        Tests payloads edited in place are sent with their checksums recalculated, by send() and send_many()
+        """
+        meta = CapturedMetadata((3, 0), Direction.OUTBOUND)
+        packet = parse_packet(ipv4_tcp_packet(payload=b"data"), meta)
+        self.assertRaises(TypeError, packet.raw_view().__setitem__, slice(-4, None), b"DATA")
+        packet.writable_raw()[-4:] = b"DATA"
+        self.assertTrue(packet.dirty)
+        self.handle.send(packet)
+        self.assertEqual(self.lib.checksummed, [ipv4_tcp_packet(payload=b"DATA")])
+        self.assertFalse(packet.dirty)
+
+        packet.writable_raw()[-4:] = b"Data"
+        self.handle.send_many([packet])
+        self.assertEqual(self.lib.checksummed[-1], ipv4_tcp_packet(payload=b"Data"))
+        self.assertEqual(self.lib.sent[-1][0], ipv4_tcp_packet(payload=b"Data"))
+
+    def test_send_many_failure(self):
+        """
+        Tests a failed send is reported without stopping the batch
+        """
+        meta = CapturedMetadata((1, 0), Direction.OUTBOUND)
+        self.lib.fail_sends = 1
+        results = self.handle.send_many([(ipv4_udp_packet(), meta), (ipv4_udp_packet(), meta)])
+        self.assertIsInstance(results[0], OSError)
+        self.assertEqual(results[1], 28)
+        self.assertEqual(len(self.lib.sent), 1)
+
+    def test_send_many_wrong_args(self):
+        """
+        Tests send_many with something that is not a packet
+        """
+        self.assertRaises(ValueError, self.handle.send_many, ["test"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from binascii import unhexlify
+import os
+import struct
+import unittest
+
+from pydivert import checksum
+from pydivert.enum import HelperOption
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv4_icmp_packet, ipv6_tcp_packet, ipv6_udp_packet, \
+    ipv6_packet, with_checksums
+from pydivert.tests import internet_checksum as reference_checksum
+
+__author__ = 'fabio'
+
+
+class ChecksumTestCase(unittest.TestCase):
+    """
+    Tests the pure python checksum engine
+    """
+
+    def test_ipv4_header_vector(self):
+        """
+        Tests the IPv4 header checksum against a known value
+        """
+        header = bytearray(unhexlify("450000730000400040110000c0a80001c0a800c7"))
+        self.assertEqual(checksum.internet_checksum(header), 0xb861)
+
+    def test_ones_complement_sum(self):
+        """
+        Tests summing words in bulk, odd lengths and the all-zero corner cases
+        """
+        for data in (b"", b"\x00\x00", b"\xff\xff", b"\x01", b"\xff\xff\x00\x01", os.urandom(1501),
+                     os.urandom(4096)):
+            self.assertEqual(checksum.internet_checksum(data), reference_checksum(data))
+
+    def test_numpy_path(self):
+        """
+        Tests large buffers give the same result whatever the summing strategy
+        """
+        data = os.urandom(checksum.NUMPY_THRESHOLD * 2 + 1)
+        self.assertEqual(checksum.internet_checksum(data), reference_checksum(data))
+
+    def test_calc_checksums(self):
+        """
+        Tests checksums of every supported protocol match the reference implementation
+        """
+        for raw in (ipv4_tcp_packet(payload=b"Hello World!", tcp_options=b"\x01\x01\x01\x01"),
+                    ipv4_udp_packet(payload=b"odd"),
+                    ipv4_icmp_packet(payload=b"ping"),
+                    ipv6_tcp_packet(payload=b"data"),
+                    ipv6_udp_packet(payload=b"query"),
+                    ipv6_packet(58, struct.pack("!BBHI", 128, 0, 0, 1), payload=b"ping")):
+            self.assertEqual(bytes(checksum.calc_checksums(raw)), with_checksums(raw))
+
+    def test_update_in_place(self):
+        """
+        Tests checksums are written into the given buffer
+        """
+        buffer = bytearray(ipv4_tcp_packet(payload=b"data"))
+        self.assertEqual(checksum.update_checksums(buffer), 2)
+        self.assertEqual(bytes(buffer), with_checksums(bytes(buffer)))
+
+    def test_flags(self):
+        """
+        Tests HelperOption flags disable individual checksums
+        """
+        raw = ipv4_tcp_packet(payload=b"data")
+        buffer = bytearray(raw)
+        self.assertEqual(checksum.update_checksums(buffer, HelperOption.NO_TCP_CHECKSUM), 1)
+        self.assertEqual(buffer[36:38], raw[36:38])
+        self.assertNotEqual(buffer[10:12], raw[10:12])
+        buffer = bytearray(raw)
+        self.assertEqual(checksum.update_checksums(buffer, HelperOption.NO_IP_CHECKSUM), 1)
+        self.assertEqual(buffer[10:12], raw[10:12])
+        buffer = bytearray(ipv4_udp_packet())
+        self.assertEqual(checksum.update_checksums(buffer, HelperOption.NO_IP_CHECKSUM |
+                                                   HelperOption.NO_UDP_CHECKSUM), 0)
+
+    def test_fragment(self):
+        """
+        Tests the transport checksum of a fragment is left untouched
+        """
+        buffer = bytearray(ipv4_tcp_packet(frag_off=0x2000, payload=b"data"))
+        self.assertEqual(checksum.update_checksums(buffer), 1)
+        self.assertEqual(buffer[36:38], b"\x00\x00")
+
+    def test_update_many(self):
+        """
+        Tests the batch entry point
+        """
+        buffers = [bytearray(ipv4_udp_packet(dst_port=port, payload=b"query")) for port in range(100)]
+        self.assertEqual(checksum.update_checksums_many(buffers), [2] * 100)
+        for buffer in buffers:
+            self.assertEqual(bytes(buffer), with_checksums(bytes(buffer)))
+
+    def test_not_a_packet(self):
+        """
+        Tests nothing is done on unknown data
+        """
+        self.assertEqual(checksum.update_checksums(bytearray(b"\x00" * 40)), 0)
+        self.assertEqual(checksum.update_checksums(bytearray(b"\x45")), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
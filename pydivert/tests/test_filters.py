@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from pydivert.enum import Direction
+from pydivert.filters import Filter, FilterSyntaxError, parse
+from pydivert.models import CapturedMetadata
+from pydivert.parser import parse_packet
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv6_tcp_packet, ipv4_icmp_packet
+from pydivert.windivert import Handle, WinDivert
+from pydivert.simulator import SimulatedLibrary
+
+__author__ = 'fabio'
+
+
+class FilterParserTestCase(unittest.TestCase):
+    """
+    Tests parsing the filter language
+    """
+
+    def test_parse(self):
+        """
+        Tests the tree built for a filter
+        """
+        self.assertEqual(parse("true"), ("const", True))
+        self.assertEqual(parse("tcp.DstPort == 80"), ("test", "tcp.dstport", "==", 80))
+        self.assertEqual(parse("TCP.DSTPORT = 0x50"), ("test", "tcp.dstport", "==", 80))
+        self.assertEqual(parse("ip.SrcAddr != 10.0.0.1"), ("test", "ip.srcaddr", "!=", 0x0A000001))
+        self.assertEqual(parse("ipv6.DstAddr == ::1"), ("test", "ipv6.dstaddr", "==", 1))
+        self.assertEqual(parse("not tcp"), ("not", ("test", "tcp", "!=", 0)))
+
+    def test_precedence(self):
+        """
+        Tests and binds tighter than or, and parenthesis
+        """
+        a, b, c = [("test", "tcp.dstport", "==", port) for port in (1, 2, 3)]
+        self.assertEqual(parse("tcp.DstPort == 1 or tcp.DstPort == 2 and tcp.DstPort == 3"),
+                         ("or", (a, ("and", (b, c)))))
+        self.assertEqual(parse("(tcp.DstPort == 1 || tcp.DstPort == 2) && tcp.DstPort == 3"),
+                         ("and", (("or", (a, b)), c)))
+        self.assertEqual(parse("!(tcp.DstPort == 1)"), ("not", a))
+
+    def test_syntax_errors(self):
+        """
+        Tests invalid filters are rejected with the position of the error
+        """
+        for text, position in (("", 0),
+                               ("tcp.DstPrt == 80", 0),
+                               ("tcp.DstPort == ", 14),
+                               ("tcp.DstPort == 80 and", 21),
+                               ("(tcp", 4),
+                               ("tcp.DstPort == 80 #", 18),
+                               ("tcp udp", 4),
+                               ("ip.SrcAddr == 10.0.0.256", 14)):
+            try:
+                parse(text)
+            except FilterSyntaxError as error:
+                self.assertEqual(error.position, position, text)
+            else:
+                self.fail("No error for {!r}".format(text))
+
+    def test_rejected_before_open(self):
+        """
+        Tests an handle asked to validate its filter refuses to open with an invalid one
+        """
+        library = SimulatedLibrary()
+        handle = Handle(WinDivert(library=library), filter="tcp.DstPort ==")
+        self.assertRaises(FilterSyntaxError, handle.open, validate=True)
+        self.assertRaises(ValueError, handle.open, validate=True)
+        self.assertIsNone(handle._handle)
+
+    def test_passed_through_by_default(self):
+        """
+        Tests the filter is handed over to the driver as is unless asked to validate it, e.g. one using fields of a
+        newer driver
+        """
+        parsed = []
+        library = SimulatedLibrary(compile_filter=lambda text: parsed.append(text) or (lambda raw, meta: True))
+        with Handle(WinDivert(library=library), filter="tcp.NewField == 80") as handle:
+            self.assertTrue(handle.is_opened)
+        self.assertEqual(parsed, ["tcp.NewField == 80"])
+
+
+class FilterEvaluationTestCase(unittest.TestCase):
+    """
+    Tests evaluating filters against packets
+    """
+
+    def assertMatches(self, text, raw, meta=None, expected=True):
+        compiled = Filter(text)
+        self.assertEqual(compiled.match(raw, meta), expected, text)
+        self.assertEqual(compiled(parse_packet(raw, meta)), expected, text)
+
+    def test_fields(self):
+        """
+        Tests header fields are read from the packet
+        """
+        raw = ipv4_tcp_packet(src_addr="192.168.1.1", dst_port=443, payload=b"data", flags=0x12, ttl=3)
+        self.assertMatches("ip and tcp and not udp", raw)
+        self.assertMatches("tcp.DstPort == 443 and tcp.SrcPort >= 1024", raw)
+        self.assertMatches("ip.SrcAddr == 192.168.1.1 and ip.TTL < 4 and ip.DF", raw)
+        self.assertMatches("tcp.Syn and tcp.Ack and not tcp.Fin", raw)
+        self.assertMatches("tcp.PayloadLength == 4 and ip.Length == 44", raw)
+        self.assertMatches("tcp.HdrLength == 5 and ip.HdrLength == 5 and ip.Protocol == 6", raw)
+        self.assertMatches("udp.DstPort == 53", ipv4_udp_packet(dst_port=53))
+        self.assertMatches("icmp.Type == 8", ipv4_icmp_packet(icmp_type=8))
+        raw = ipv6_tcp_packet(dst_addr="2607:f0d0:1002:51::4", dst_port=80)
+        self.assertMatches("ipv6.DstAddr == 2607:f0d0:1002:51::4 and ipv6.NextHdr == 6 and tcp.DstPort == 80", raw)
+
+    def test_missing_layer(self):
+        """
+        Tests that tests on fields of missing layers are false
+        """
+        raw = ipv4_udp_packet(dst_port=80)
+        self.assertMatches("tcp.DstPort == 80", raw, expected=False)
+        self.assertMatches("tcp.DstPort != 80", raw, expected=False)
+        self.assertMatches("not tcp.DstPort == 80", raw)
+        self.assertMatches("ipv6.HopLimit > 0 or udp.DstPort == 80", raw)
+
+    def test_meta(self):
+        """
+        Tests direction and interface fields
+        """
+        raw = ipv4_udp_packet()
+        meta = CapturedMetadata((7, 2), Direction.INBOUND)
+        self.assertMatches("inbound and not outbound and ifIdx == 7 and subIfIdx == 2", raw, meta)
+        self.assertMatches("inbound", raw, expected=False)
+
+    def test_select(self):
+        """
+        Tests selecting matching packets out of a sequence
+        """
+        packets = [(ipv4_tcp_packet(dst_port=port), None) for port in (80, 443, 8080)]
+        selected = list(Filter("tcp.DstPort > 100").select(packets))
+        self.assertEqual(selected, packets[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
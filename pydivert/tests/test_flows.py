@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from pydivert.enum import TcpState
+from pydivert.flows import FlowTable, flow_key, address_to_string, TCP_SYN, TCP_ACK, TCP_FIN, TCP_RST
+from pydivert.parser import parse_packet
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv4_icmp_packet, ipv6_tcp_packet
+
+__author__ = 'fabio'
+
+CLIENT = dict(src_addr="10.0.0.1", dst_addr="10.0.0.2", src_port=40000, dst_port=80)
+SERVER = dict(src_addr="10.0.0.2", dst_addr="10.0.0.1", src_port=80, dst_port=40000)
+
+
+class FlowTableTestCase(unittest.TestCase):
+    """
+    Tests tracking flows over raw packets
+    """
+
+    def test_flow_key(self):
+        """
+        Tests flow keys are integers, the same for both directions of a flow
+        """
+        key = flow_key(ipv4_tcp_packet(**CLIENT))
+        self.assertEqual(key, flow_key(ipv4_tcp_packet(**SERVER)))
+        protocol, addr, port, other_addr, other_port = key
+        self.assertEqual((protocol, port, other_port), (6, 40000, 80))
+        self.assertEqual((address_to_string(addr), address_to_string(other_addr)), ("10.0.0.1", "10.0.0.2"))
+        self.assertNotEqual(key, flow_key(ipv4_udp_packet(**CLIENT)))
+
+        key = flow_key(ipv6_tcp_packet(src_addr="fe80::2", dst_addr="fe80::1", src_port=80, dst_port=40000))
+        self.assertEqual(address_to_string(key[1]), "fe80::1")
+        self.assertEqual(key[2], 40000)
+        self.assertEqual(flow_key(ipv4_icmp_packet())[2:5:2], (0, 0))
+        self.assertIsNone(flow_key(b"\x00" * 20))
+
+    def test_tcp_states(self):
+        """
+        Tests following a TCP connection from the handshake to the close, and the reuse of its endpoints
+        """
+        table = FlowTable()
+        flow = table.update(ipv4_tcp_packet(flags=TCP_SYN, **CLIENT), now=0)
+        self.assertEqual(flow.state, TcpState.SYN_SENT)
+        self.assertEqual((flow.client, flow.server), (("10.0.0.1", 40000), ("10.0.0.2", 80)))
+        steps = [(SERVER, TCP_SYN | TCP_ACK, TcpState.SYN_RECEIVED),
+                 (CLIENT, TCP_ACK, TcpState.ESTABLISHED),
+                 (SERVER, TCP_ACK, TcpState.ESTABLISHED),
+                 (CLIENT, TCP_FIN | TCP_ACK, TcpState.FIN_WAIT),
+                 (SERVER, TCP_FIN | TCP_ACK, TcpState.TIME_WAIT)]
+        for endpoints, flags, state in steps:
+            self.assertIs(table.update(ipv4_tcp_packet(flags=flags, payload=b"x", **endpoints), now=1), flow)
+            self.assertEqual(flow.state, state)
+        self.assertEqual((flow.client_packets, flow.server_packets), (3, 3))
+        self.assertEqual((flow.client_bytes, flow.server_bytes), (40 + 2 * 41, 3 * 41))
+
+        # A new SYN starts a new connection
+        renewed = table.update(ipv4_tcp_packet(flags=TCP_SYN, **CLIENT), now=2)
+        self.assertIsNot(renewed, flow)
+        self.assertEqual((renewed.state, renewed.packets, len(table)), (TcpState.SYN_SENT, 1, 1))
+        table.update(parse_packet(ipv4_tcp_packet(flags=TCP_RST, **SERVER)), now=3)
+        self.assertEqual(renewed.state, TcpState.CLOSED)
+
+        # Picked up in the middle, or from the reply to the SYN
+        self.assertEqual(table.update(ipv4_tcp_packet(src_port=1), now=0).state, TcpState.ESTABLISHED)
+        flow = table.update(ipv4_tcp_packet(src_port=2, flags=TCP_SYN | TCP_ACK), now=0)
+        self.assertEqual((flow.state, flow.client_port, flow.server_packets), (TcpState.SYN_RECEIVED, 80, 1))
+
+    def test_idle_timeouts(self):
+        """
+        Tests flows expire once idle for the timeout of their state
+        """
+        expired = []
+        table = FlowTable(timeouts={None: 30, TcpState.ESTABLISHED: 100}, on_expire=expired.append)
+        udp = table.update(ipv4_udp_packet(**CLIENT), now=0)
+        tcp = table.update(ipv4_tcp_packet(**CLIENT), now=0)
+        closing = table.update(ipv4_tcp_packet(src_port=1), now=0)
+        table.update(ipv4_udp_packet(**SERVER), now=20)
+        table.update(ipv4_tcp_packet(src_port=1, flags=TCP_RST), now=20)
+
+        self.assertEqual(table.expire(now=40), [closing])
+        self.assertEqual(table.expire(now=60), [udp])
+        self.assertEqual(table.update(ipv4_tcp_packet(**SERVER), now=90), tcp)
+        self.assertEqual(table.expire(now=150), [])
+        self.assertEqual(table.expire(now=200), [tcp])
+        self.assertEqual(expired, [closing, udp, tcp])
+        self.assertEqual((len(table), table.counters["expired"]), (0, 3))
+
+        # Expired flows are also found on update
+        table.update(ipv4_udp_packet(**CLIENT), now=300)
+        table.update(ipv4_udp_packet(src_port=1), now=400)
+        self.assertEqual(len(table), 1)
+
+    def test_lru_eviction(self):
+        """
+        Tests the least recently seen flows are evicted beyond max_flows, keeping the wheel bounded
+        """
+        evicted = []
+        table = FlowTable(max_flows=3, on_expire=evicted.append)
+        flows = [table.update(ipv4_udp_packet(src_port=port), now=0) for port in (1, 2, 3)]
+        table.update(ipv4_udp_packet(src_port=1), now=1)
+        table.update(ipv4_udp_packet(src_port=4), now=2)
+        self.assertEqual(evicted, [flows[1]])
+        self.assertEqual([flow.client_port for flow in table], [3, 1, 4])
+
+        for port in range(5, 5000):
+            table.update(ipv4_udp_packet(src_port=port), now=10)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.counters["evicted"], 4996)
+        self.assertLess(sum(len(flows) for flows in table._wheel.values()), 3 + 1024 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import struct
+import unittest
+
+from pydivert.checksum import update_checksums
+from pydivert.flows import flow_key
+from pydivert.fragments import Defragmenter, fragment, fragment_packet
+from pydivert.models import CapturedMetadata, DivertIpv6Header
+from pydivert.parser import parse_packet
+from pydivert.tests import ipv4_tcp_packet, ipv6_packet, ipv6_udp_packet, internet_checksum, with_checksums
+
+__author__ = 'fabio'
+
+# Record route (not copied) and a copied option with 2 bytes of data
+IP_OPTIONS = b"\x07\x07\x04\x00\x00\x00\x00" + b"\x01" + b"\x88\x04\x12\x34"
+
+
+class FragmentsTestCase(unittest.TestCase):
+    """
+    Tests splitting packets into fragments and reassembling them
+    """
+
+    def test_ipv4_round_trip(self):
+        """
+        Tests an IPv4 packet beyond the MTU is split with valid headers, then reassembled whatever the order
+        """
+        raw = with_checksums(ipv4_tcp_packet(payload=b"x" * 3000, ip_options=IP_OPTIONS))
+        fragments = fragment(raw, mtu=1500)
+        self.assertEqual([len(piece) for piece in fragments], [1496, 1496, 108])
+        for piece in fragments:
+            header_len = (piece[0] & 0x0F) * 4
+            self.assertEqual(internet_checksum(bytes(piece[:header_len])), 0)
+            self.assertEqual(struct.unpack_from("!H", piece, 2)[0], len(piece))
+        # Only the copied option is repeated, the DF flag is cleared
+        self.assertEqual(bytes(fragments[1][20:24]), b"\x88\x04\x12\x34")
+        self.assertEqual([struct.unpack_from("!H", piece, 6)[0] for piece in fragments], [0x2000, 0x20B7, 0x016F])
+        self.assertEqual(fragment(raw, mtu=len(raw)), [raw])
+        self.assertEqual(flow_key(fragments[1])[2:5:2], (0, 0))
+
+        defragmenter = Defragmenter()
+        self.assertIsNone(defragmenter.feed(fragments[2], now=0))
+        self.assertIsNone(defragmenter.feed(fragments[0], now=0))
+        self.assertEqual((len(defragmenter), defragmenter.buffered), (1, 1464 + 84))
+        packet = defragmenter.feed(parse_packet(fragments[1], CapturedMetadata((1, 0), 0)), now=0)
+        self.assertEqual(packet.meta.iface, (1, 0))
+        self.assertEqual(packet.payload, b"x" * 3000)
+        self.assertEqual(packet.ipv4_hdr.FragOff0, 0)
+        self.assertEqual(bytes(packet.raw), bytes(with_checksums(raw[:6] + b"\x00\x00" + raw[8:])))
+        self.assertEqual((len(defragmenter), defragmenter.buffered), (0, 0))
+        self.assertEqual(defragmenter.feed(raw), raw)
+
+    def test_ipv6_round_trip(self):
+        """
+        Tests IPv6 packets get a fragment header after their unfragmentable part, and lose it once reassembled
+        """
+        udp = struct.pack("!HHHH", 1234, 53, 8 + 2000, 0)
+        hop_by_hop = b"\x11\x00" + b"\x01\x04\x00\x00\x00\x00"
+        raw = with_checksums(ipv6_udp_packet(payload=b"y" * 2000))
+        extended = bytearray(ipv6_packet(0, hop_by_hop + udp, payload=b"y" * 2000))
+        extended[48 + 6:48 + 8] = raw[40 + 6:40 + 8]
+
+        fragments = fragment(bytes(extended), mtu=1280)
+        self.assertEqual([len(piece) for piece in fragments], [1280, 48 + 8 + 2008 - 1224])
+        for piece in fragments:
+            self.assertEqual((piece[6], piece[40]), (0, 44))
+            self.assertEqual(struct.unpack_from("!H", piece, 4)[0], len(piece) - 40)
+        packet = parse_packet(fragments[0])
+        self.assertEqual(packet.src_port, 1234)
+        self.assertEqual(len(packet.ipv6_hdr.opts), 16)
+        self.assertIsNone(parse_packet(fragments[1]).udp_hdr)
+        self.assertEqual(update_checksums(bytearray(fragments[0])), 0)
+
+        defragmenter = Defragmenter()
+        self.assertIsNone(defragmenter.feed(fragments[1], now=0))
+        self.assertEqual(defragmenter.feed(fragments[0], now=0), extended)
+        self.assertEqual(defragmenter.counters["reassembled"], 1)
+
+    def test_extension_headers(self):
+        """
+        Tests the upper layer is found past IPv6 extension headers, which are kept as the IPv6 header options
+        """
+        hop_by_hop = b"\x3C\x00" + b"\x01\x04\x00\x00\x00\x00"
+        destination = b"\x11\x01" + b"\x01\x0C" + b"\x00" * 12
+        raw = with_checksums(ipv6_udp_packet(src_port=5353, payload=b"data"))
+        raw = ipv6_packet(0, hop_by_hop + destination + raw[40:], payload=b"")
+        packet = parse_packet(raw)
+        self.assertIsInstance(packet.ipv6_hdr.hdr, DivertIpv6Header)
+        self.assertEqual(packet.src_port, 5353)
+        self.assertEqual(packet.payload, b"data")
+        self.assertEqual(flow_key(raw)[0], 17)
+
+        # Checksums ignore the extension headers
+        checksum = raw[40 + 24 + 6:40 + 24 + 8]
+        buffer = bytearray(raw)
+        buffer[40 + 24 + 6:40 + 24 + 8] = b"\x00\x00"
+        update_checksums(buffer)
+        self.assertEqual(bytes(buffer[40 + 24 + 6:40 + 24 + 8]), checksum)
+        packet.src_port = 5354
+        self.assertTrue(packet.refresh_checksums())
+        expected = bytearray(packet.raw)
+        update_checksums(expected)
+        self.assertEqual(bytes(packet.raw), bytes(expected))
+
+    def test_bounds(self):
+        """
+        Tests incomplete datagrams are dropped on timeout and beyond the bounds, as are overlapping fragments
+        """
+        fragments = [fragment(with_checksums(ipv4_tcp_packet(payload=b"z" * 2000, ip_id=ip_id)), 1000)
+                     for ip_id in range(1, 5)]
+        defragmenter = Defragmenter(max_datagrams=2, timeout=10)
+        defragmenter.feed(fragments[0][0], now=0)
+        defragmenter.feed(fragments[1][0], now=5)
+        self.assertEqual(defragmenter.expire(now=12), 1)
+        defragmenter.feed(fragments[2][0], now=12)
+        defragmenter.feed(fragments[3][0], now=12)
+        self.assertEqual(len(defragmenter), 2)
+        self.assertEqual(defragmenter.counters["evicted"], 1)
+        self.assertIsNone(defragmenter.feed(fragments[3][1], now=12))
+
+        overlapping = bytearray(fragments[2][1])
+        struct.pack_into("!H", overlapping, 6, 0x2000 | 1)
+        self.assertIsNone(defragmenter.feed(overlapping, now=12))
+        self.assertEqual(defragmenter.counters, {"reassembled": 0, "expired": 1, "evicted": 1, "malformed": 1})
+        self.assertEqual(len(defragmenter), 1)
+
+        defragmenter = Defragmenter(max_bytes=1500)
+        for pieces in fragments:
+            defragmenter.feed(pieces[0], now=0)
+        self.assertEqual((len(defragmenter), defragmenter.buffered), (1, 976))
+
+    def test_fragment_packet(self):
+        """
+        Tests modified packets grown beyond the MTU are split, with the checksums of the whole datagram
+        """
+        packet = parse_packet(with_checksums(ipv4_tcp_packet(payload=b"a" * 100)), CapturedMetadata((1, 0), 1))
+        packet.payload = b"b" * 1600
+        pairs = fragment_packet(packet, mtu=576)
+        self.assertEqual(len(pairs), 3)
+        self.assertTrue(all(meta is packet.meta for raw, meta in pairs))
+        defragmenter = Defragmenter()
+        for raw, meta in pairs:
+            result = defragmenter.feed(raw, now=0)
+        self.assertEqual(bytes(result[20:]), bytes(with_checksums(ipv4_tcp_packet(payload=b"b" * 1600))[20:]))
+        raw = with_checksums(ipv4_tcp_packet())
+        [(data, meta)] = fragment_packet(parse_packet(raw), mtu=576)
+        self.assertEqual(bytes(data), raw)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import struct
+import unittest
+
+from pydivert.models import CapturedPacket, CapturedMetadata, HeaderWrapper, DivertTcpHeader, DivertIpHeader
+from pydivert.parser import parse_packet
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv6_udp_packet, ipv6_tcp_packet, ipv4_icmp_packet, \
+    with_checksums
+
+__author__ = 'fabio'
+
+
+class CapturedPacketTestCase(unittest.TestCase):
+    """
+    Tests the buffer backed packet model
+    """
+
+    def test_binary_addresses(self):
+        """
+        Tests reading the addresses as integers and bytes, and the flow key, without formatting them
+        """
+        packet = parse_packet(ipv4_tcp_packet(src_addr="10.0.0.1", dst_addr="192.168.1.2", src_port=1234, dst_port=80))
+        self.assertEqual((packet.src_addr_int, packet.dst_addr_int), (0x0A000001, 0xC0A80102))
+        self.assertEqual((packet.src_addr_bytes, packet.dst_addr_bytes), (b"\x0a\x00\x00\x01", b"\xc0\xa8\x01\x02"))
+        reply = parse_packet(ipv4_tcp_packet(src_addr="192.168.1.2", dst_addr="10.0.0.1", src_port=80, dst_port=1234))
+        self.assertEqual(packet.flow_key, reply.flow_key)
+        self.assertEqual(hash(packet.flow_key), hash(reply.flow_key))
+
+        packet = parse_packet(ipv6_udp_packet(src_addr="fe80::1", dst_addr="2001:db8::2"))
+        self.assertEqual(packet.address_family, socket.AF_INET6)
+        self.assertEqual(packet.src_addr_int, 0xFE80 << 112 | 1)
+        self.assertEqual(len(packet.dst_addr_bytes), 16)
+
+    def test_address_strings_cached(self):
+        """
+        Tests the string form of the addresses is reused until the address changes
+        """
+        packet = parse_packet(ipv4_tcp_packet(src_addr="10.0.0.1"))
+        self.assertIs(packet.src_addr, packet.src_addr)
+        packet.src_addr = "10.0.0.9"
+        self.assertEqual(packet.src_addr, "10.0.0.9")
+        packet.ipv4_hdr.SrcAddr = struct.unpack("<I", socket.inet_aton("10.0.0.7"))[0]
+        self.assertEqual(packet.src_addr, "10.0.0.7")
+
+    def test_lazy_decoding(self):
+        """
+        Tests headers are located and mapped only when needed, and untouched packets need no checksum update
+        """
+        raw = with_checksums(ipv4_tcp_packet(dst_port=80, payload=b"data"))
+        packet = parse_packet(raw)
+        self.assertIsNone(packet._located)
+        self.assertTrue(packet.refresh_checksums())
+        self.assertIsNone(packet._located)
+
+        self.assertEqual(packet.dst_port, 80)
+        self.assertIsNotNone(packet._located)
+        self.assertIsNone(packet._headers)
+        self.assertEqual(packet.tcp_hdr.DstPort, socket.htons(80))
+        self.assertIsNotNone(packet._headers)
+        self.assertEqual(packet.raw, raw)
+
+        # Changes made through the raw bytes can't be tracked
+        packet = parse_packet(raw)
+        packet.writable_raw()[22:24] = struct.pack("!H", 8080)
+        self.assertFalse(packet.refresh_checksums())
+        packet.update_checksums()
+        self.assertEqual(packet.raw, with_checksums(ipv4_tcp_packet(dst_port=8080, payload=b"data")))
+
+    def test_slotted_objects(self):
+        """
+        Tests packets, headers and metadata have no instance dictionary, and header fields are descriptors
+        """
+        packet = parse_packet(ipv4_tcp_packet(), CapturedMetadata((1, 0), 0))
+        for instance in (packet, packet.tcp_hdr, packet.meta):
+            self.assertFalse(hasattr(instance, "__dict__"))
+        self.assertRaises(AttributeError, setattr, packet, "unknown", 1)
+        self.assertIsInstance(packet.tcp_hdr, HeaderWrapper)
+        self.assertIs(type(packet.tcp_hdr), type(HeaderWrapper(DivertTcpHeader())))
+        self.assertEqual((packet.ipv4_hdr.type, packet.tcp_hdr.type), ("ipv4", "tcp"))
+        self.assertIsNone(packet.udp_hdr)
+        packet.tcp_hdr.Window = 1024
+        self.assertEqual(packet.tcp_hdr.hdr.Window, 1024)
+
+    def test_setters_write_wire_bytes(self):
+        """
+        Tests that modifying fields changes the raw packet in place
+        """
+        packet = parse_packet(ipv4_tcp_packet(payload=b"data"))
+        raw = packet.raw_view()
+        packet.dst_port = 8080
+        packet.src_addr = "192.168.1.1"
+        self.assertEqual(struct.unpack("!H", raw[22:24])[0], 8080)
+        self.assertEqual(bytes(raw[12:16]), socket.inet_aton("192.168.1.1"))
+        packet.ipv4_hdr.TTL = 1
+        self.assertEqual(raw[8], 1)
+
+    def test_raw_view(self):
+        """
+        Tests raw_view() does not copy the packet buffer, unlike raw
+        """
+        buffer = bytearray(ipv4_udp_packet(payload=b"query"))
+        packet = parse_packet(buffer)
+        raw = packet.raw
+        self.assertIsInstance(raw, bytes)
+        self.assertIsInstance(packet.raw_view(), memoryview)
+        self.assertTrue(packet.raw_view().readonly)
+        packet.dst_port = 5353
+        self.assertEqual(struct.unpack("!H", buffer[22:24])[0], 5353)
+        self.assertEqual(struct.unpack("!H", packet.raw_view()[22:24])[0], 5353)
+        self.assertEqual(raw, ipv4_udp_packet(payload=b"query"))
+
+    def test_set_payload(self):
+        """
+        Tests replacing the payload with a different size fixes the length fields
+        """
+        packet = parse_packet(ipv4_udp_packet(payload=b"query"))
+        packet.dst_port = 5353
+        packet.payload = b"a longer query"
+        self.assertEqual(packet.payload, b"a longer query")
+        self.assertEqual(packet.dst_port, 5353)
+        self.assertEqual(socket.ntohs(packet.ipv4_hdr.Length), len(packet.raw))
+        self.assertEqual(socket.ntohs(packet.udp_hdr.Length), 8 + len(b"a longer query"))
+
+        packet = parse_packet(ipv6_udp_packet(payload=b"query"))
+        packet.payload = None
+        self.assertEqual(packet.payload, b"")
+        self.assertEqual(socket.ntohs(packet.ipv6_hdr.Length), 8)
+
+    def test_replace_header(self):
+        """
+        Tests assigning a whole header copies it into the packet
+        """
+        packet = parse_packet(ipv4_tcp_packet(payload=b"data"))
+        header = DivertTcpHeader.from_buffer_copy(ipv4_tcp_packet(dst_port=443), 20)
+        packet.tcp_hdr = header
+        self.assertEqual(packet.dst_port, 443)
+        self.assertEqual(struct.unpack("!H", packet.raw[22:24])[0], 443)
+
+    def test_replace_header_mismatch(self):
+        """
+        Tests a header of the wrong type, or missing from the packet, can't be assigned
+        """
+        packet = parse_packet(ipv6_udp_packet(payload=b"data"))
+        raw = bytes(packet.raw)
+        self.assertRaises(TypeError, setattr, packet, "ipv6_hdr", DivertIpHeader.from_buffer_copy(ipv4_tcp_packet()))
+        self.assertRaises(ValueError, setattr, packet, "ipv4_hdr", DivertIpHeader.from_buffer_copy(ipv4_tcp_packet()))
+        self.assertRaises(ValueError, setattr, packet, "tcp_hdr", DivertTcpHeader.from_buffer_copy(ipv4_tcp_packet(), 20))
+        self.assertEqual(bytes(packet.raw), raw)
+        self.assertIsNone(packet.tcp_hdr)
+
+    def test_options(self):
+        """
+        Tests options can be rewritten in place, but can't change length
+        """
+        packet = parse_packet(ipv4_tcp_packet(tcp_options=b"\x01\x01\x01\x01"))
+        packet.tcp_hdr.Options = b"\x01\x01\x01\x00"
+        self.assertEqual(bytes(packet.raw[40:44]), b"\x01\x01\x01\x00")
+        self.assertRaises(ValueError, setattr, packet.tcp_hdr, "Options", b"\x01\x01\x01\x01\x01\x01\x01\x00")
+
+    def test_build_from_headers(self):
+        """
+        Tests building a packet from standalone headers
+        """
+        raw = ipv4_tcp_packet(payload=b"data")
+        packet = CapturedPacket([HeaderWrapper(DivertIpHeader.from_buffer_copy(raw)),
+                                 HeaderWrapper(DivertTcpHeader.from_buffer_copy(raw, 20))],
+                                payload=b"data")
+        self.assertEqual(bytes(packet.raw), raw)
+        packet.dst_port = 8080
+        self.assertEqual(struct.unpack("!H", packet.raw[22:24])[0], 8080)
+
+
+class IncrementalChecksumTestCase(unittest.TestCase):
+    """
+    Tests checksums updated incrementally match the ones recalculated from scratch
+    """
+
+    def assertChecksumsRefreshed(self, packet):
+        self.assertTrue(packet.refresh_checksums())
+        self.assertEqual(bytes(packet.raw), with_checksums(bytes(packet.raw)))
+
+    def test_unmodified(self):
+        """
+        Tests nothing changes if the packet has not been modified
+        """
+        raw = with_checksums(ipv4_tcp_packet(payload=b"data"))
+        packet = parse_packet(raw)
+        self.assertTrue(packet.refresh_checksums())
+        self.assertEqual(bytes(packet.raw), raw)
+
+    def test_ipv4_tcp_nat(self):
+        """
+        Tests rewriting addresses, ports and TTL of an IPv4/TCP packet
+        """
+        packet = parse_packet(with_checksums(ipv4_tcp_packet(payload=b"Hello World!")))
+        packet.src_addr = "192.168.100.1"
+        packet.dst_port = 8080
+        packet.ipv4_hdr.TTL -= 1
+        packet.tcp_hdr.Fin = 1
+        self.assertChecksumsRefreshed(packet)
+        # Changes are applied once
+        packet.src_port = 1
+        self.assertChecksumsRefreshed(packet)
+
+    def test_updated_on_set(self):
+        """
+        Tests checksums are right as soon as fields are set, whatever the way they are set
+        """
+        packet = parse_packet(with_checksums(ipv4_tcp_packet(payload=b"data")))
+        packet.dst_port = 8080
+        self.assertEqual(bytes(packet.raw), with_checksums(bytes(packet.raw)))
+        packet.dst_addr = "10.0.0.3"
+        packet.tcp_hdr.Ack = 1
+        packet.ipv4_hdr.TTL = 3
+        self.assertEqual(bytes(packet.raw), with_checksums(bytes(packet.raw)))
+        self.assertTrue(packet.dirty)
+        self.assertChecksumsRefreshed(packet)
+        self.assertFalse(packet.dirty)
+        # The checksum of a whole header assigned is not the one to update
+        packet.tcp_hdr = DivertTcpHeader.from_buffer_copy(ipv4_tcp_packet(src_port=1, dst_port=2), 20)
+        self.assertFalse(packet.refresh_checksums())
+
+    def test_ipv4_options(self):
+        """
+        Tests rewriting the IPv4 options, which are not covered by the pseudo header
+        """
+        packet = parse_packet(with_checksums(ipv4_tcp_packet(payload=b"data", ip_options=b"\x88\x04\x12\x34")))
+        packet.ipv4_hdr.Options = b"\x88\x04\x56\x78"
+        packet.dst_addr = "10.0.0.3"
+        self.assertChecksumsRefreshed(packet)
+
+    def test_ipv4_udp(self):
+        """
+        Tests rewriting an IPv4/UDP packet
+        """
+        packet = parse_packet(with_checksums(ipv4_udp_packet(payload=b"query")))
+        packet.dst_addr = "8.8.8.8"
+        packet.src_port = 5353
+        self.assertChecksumsRefreshed(packet)
+
+    def test_ipv4_udp_no_checksum(self):
+        """
+        Tests a zero UDP checksum is left alone
+        """
+        packet = parse_packet(ipv4_udp_packet(payload=b"query"))
+        packet.dst_port = 5353
+        self.assertTrue(packet.refresh_checksums())
+        self.assertEqual(packet.udp_hdr.Checksum, 0)
+
+    def test_ipv4_icmp(self):
+        """
+        Tests ICMP checksum does not depend on addresses
+        """
+        packet = parse_packet(with_checksums(ipv4_icmp_packet(payload=b"ping")))
+        packet.dst_addr = "10.1.1.1"
+        packet.icmp_hdr.Type = 0
+        self.assertChecksumsRefreshed(packet)
+
+    def test_ipv6_tcp(self):
+        """
+        Tests rewriting an IPv6/TCP packet
+        """
+        packet = parse_packet(with_checksums(ipv6_tcp_packet(payload=b"data")))
+        packet.dst_addr = "2607:f0d0:1002:51::4"
+        packet.src_port = 4321
+        packet.ipv6_hdr.HopLimit = 1
+        self.assertChecksumsRefreshed(packet)
+
+    def test_full_recalculation_needed(self):
+        """
+        Tests changes to the payload require a full recalculation
+        """
+        raw = with_checksums(ipv4_tcp_packet(payload=b"data"))
+        packet = parse_packet(raw)
+        packet.payload = b"DATA"
+        self.assertFalse(packet.refresh_checksums())
+        self.assertEqual(packet.update_checksums(), 2)
+        self.assertEqual(packet.raw, with_checksums(ipv4_tcp_packet(payload=b"DATA")))
+        self.assertTrue(packet.refresh_checksums())
+        packet = CapturedPacket(parse_packet(raw).headers, payload=b"data")
+        self.assertFalse(packet.refresh_checksums())
+
+    def test_protocol_changed(self):
+        """
+        Tests changing the IPv4 protocol requires a full recalculation, unlike the TTL sharing its word
+        """
+        packet = parse_packet(with_checksums(ipv4_tcp_packet(payload=b"data")))
+        packet.ipv4_hdr.TTL = 1
+        self.assertChecksumsRefreshed(packet)
+        packet.ipv4_hdr.Protocol = 17
+        self.assertFalse(packet.refresh_checksums())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from pydivert.enum import Direction
+from pydivert.filters import Filter, to_string, parse
+from pydivert.models import CapturedMetadata
+from pydivert.optimizer import optimize_filter, Field, any_of, all_of
+from pydivert.simulator import SimulatedLibrary
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv6_tcp_packet
+from pydivert.windivert import WinDivert
+
+__author__ = 'fabio'
+
+
+class FilterOptimizerTestCase(unittest.TestCase):
+    """
+    Tests filters are simplified into equivalent ones
+    """
+
+    def assertOptimized(self, text, expected):
+        self.assertEqual(str(optimize_filter(text)), expected)
+
+    def assertEquivalent(self, text):
+        original, optimized = Filter(text), Filter(str(optimize_filter(text)))
+        for raw in (ipv4_tcp_packet(dst_port=80), ipv4_tcp_packet(dst_port=8080), ipv4_udp_packet(dst_port=80),
+                    ipv6_tcp_packet(dst_port=443)):
+            for meta in (CapturedMetadata((1, 0), Direction.OUTBOUND), CapturedMetadata((2, 0), Direction.INBOUND)):
+                self.assertEqual(original.match(raw, meta), optimized.match(raw, meta), text)
+
+    def test_constants(self):
+        """
+        Tests constants are folded
+        """
+        self.assertOptimized("tcp and true", "tcp")
+        self.assertOptimized("tcp or not false", "true")
+        self.assertOptimized("(udp and false) or tcp.DstPort == 80", "tcp.DstPort == 80")
+        self.assertOptimized("tcp and not tcp", "false")
+
+    def test_negations(self):
+        """
+        Tests negations are pushed down, but not into tests on fields that may be missing
+        """
+        self.assertOptimized("not (inbound or ifIdx == 3)", "outbound and ifIdx != 3")
+        self.assertOptimized("not not tcp.DstPort == 80", "tcp.DstPort == 80")
+        self.assertOptimized("not tcp.DstPort == 80", "not tcp.DstPort == 80")
+        self.assertEquivalent("not (tcp.DstPort == 80 or udp)")
+
+    def test_duplicates(self):
+        """
+        Tests duplicate and absorbed clauses are removed
+        """
+        self.assertOptimized("tcp.Syn or tcp.Syn or (tcp.Syn and ip.TTL < 3)", "tcp.Syn")
+        self.assertOptimized("(tcp or udp) and (tcp or udp)", "tcp or udp")
+
+    def test_port_ranges(self):
+        """
+        Tests comparisons on the same field are merged into ranges
+        """
+        text = " or ".join("tcp.DstPort == {}".format(port) for port in list(range(1000, 1100)) + [80, 443])
+        optimized = optimize_filter(text)
+        self.assertEqual(str(optimized), "tcp.DstPort == 80 or tcp.DstPort == 443 or "
+                                         "(tcp.DstPort >= 1000 and tcp.DstPort <= 1099)")
+        self.assertEqual((optimized.original_tests, optimized.tests), (102, 4))
+        self.assertOptimized("tcp.DstPort > 10 and tcp.DstPort < 20 and tcp.DstPort >= 15", "tcp.DstPort >= 15 and "
+                                                                                            "tcp.DstPort <= 19")
+        self.assertOptimized("tcp.DstPort < 10 or tcp.DstPort >= 10", "tcp.DstPort >= 0")
+        self.assertOptimized("tcp.DstPort < 10 or tcp.DstPort > 10", "tcp.DstPort != 10")
+        self.assertOptimized("tcp.DstPort == 80 and tcp.DstPort == 443", "false")
+        self.assertOptimized("ifIdx < 3 or ifIdx >= 3", "true")
+        self.assertEquivalent("tcp.DstPort < 10 or tcp.DstPort >= 10")
+
+    def test_address_sets(self):
+        """
+        Tests addresses are merged into ranges
+        """
+        text = " or ".join("ip.DstAddr == 10.0.0.{}".format(host) for host in range(256))
+        self.assertOptimized(text, "ip.DstAddr >= 10.0.0.0 and ip.DstAddr <= 10.0.0.255")
+        self.assertOptimized("ipv6.SrcAddr == ::1 or ipv6.SrcAddr == ::2 or ipv6.SrcAddr == ::3",
+                             "ipv6.SrcAddr >= ::1 and ipv6.SrcAddr <= ::3")
+
+    def test_report(self):
+        """
+        Tests the report of the estimated evaluation cost
+        """
+        optimized = optimize_filter("tcp.DstPort == 1 or tcp.DstPort == 2 or tcp.DstPort == 3")
+        self.assertEqual(optimized.report(), "2 tests (3 before), 37 characters (56 before)")
+
+
+class FilterBuilderTestCase(unittest.TestCase):
+    """
+    Tests building filters programmatically
+    """
+
+    def test_build(self):
+        """
+        Tests combining fields into expressions
+        """
+        expression = Field("outbound") & Field("tcp.DstPort").one_of([80, 443]) & ~(Field("ip.DstAddr") == "10.0.0.1")
+        self.assertEqual(str(expression), "outbound and (tcp.DstPort == 80 or tcp.DstPort == 443) and "
+                                          "not ip.DstAddr == 10.0.0.1")
+        self.assertEqual(parse(str(expression)), expression.tree)
+        self.assertEqual(str(Field("udp.SrcPort").between(1000, 2000) | "icmp"),
+                         "(udp.SrcPort >= 1000 and udp.SrcPort <= 2000) or icmp")
+        self.assertEqual(to_string(all_of([]).tree), "true")
+        self.assertEqual(to_string(any_of([]).tree), "false")
+        self.assertRaises(ValueError, Field, "tcp.NoSuchField")
+
+    def test_open_handle(self):
+        """
+        Tests built and optimized filters are accepted by handles
+        """
+        library = SimulatedLibrary(recv_timeout=0)
+        expression = any_of(Field("udp.DstPort") == port for port in range(50, 60))
+        handle = WinDivert(library=library).open_handle(filter=expression.optimize())
+        library.inject(ipv4_udp_packet(dst_port=53))
+        library.inject(ipv4_udp_packet(dst_port=60))
+        self.assertEqual([packet.dst_port for packet in handle.receive_many(4)], [53])
+        handle.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from binascii import hexlify
+import unittest
+
+from pydivert.models import CapturedMetadata
+from pydivert.parser import parse_packet
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, ipv4_icmp_packet, ipv6_tcp_packet, ipv6_udp_packet
+
+__author__ = 'fabio'
+
+
+class ParserTestCase(unittest.TestCase):
+    """
+    Tests the python packet parser against synthetic packets
+    """
+
+    def test_ipv4_tcp(self):
+        """
+        Tests parsing of an IPv4/TCP packet with payload
+        """
+        raw = ipv4_tcp_packet(src_port=4321, dst_port=23, payload=b"Hello World!")
+        packet = parse_packet(raw)
+        self.assertIsNotNone(packet.ipv4_hdr)
+        self.assertIsNotNone(packet.tcp_hdr)
+        self.assertEqual(packet.ipv4_hdr.Version, 4)
+        self.assertEqual(packet.ipv4_hdr.TTL, 64)
+        self.assertEqual(packet.src_addr, "10.0.0.1")
+        self.assertEqual(packet.dst_addr, "10.0.0.2")
+        self.assertEqual(packet.src_port, 4321)
+        self.assertEqual(packet.dst_port, 23)
+        self.assertEqual(packet.tcp_hdr.Psh, 1)
+        self.assertEqual(packet.tcp_hdr.Ack, 1)
+        self.assertEqual(packet.payload, b"Hello World!")
+
+    def test_options(self):
+        """
+        Tests IPv4 and TCP options are sliced out of the buffer
+        """
+        tcp_options = b"\x02\x04\xff\xd7\x01\x03\x03\x08\x01\x01\x04\x02"
+        ip_options = b"\x01\x01\x01\x00"
+        raw = ipv4_tcp_packet(flags=0x02, tcp_options=tcp_options, ip_options=ip_options)
+        packet = parse_packet(raw)
+        self.assertEqual(packet.tcp_hdr.Syn, 1)
+        self.assertEqual(packet.tcp_hdr.Options, tcp_options)
+        self.assertEqual(packet.ipv4_hdr.Options, ip_options)
+        self.assertEqual(packet.payload, b"")
+
+    def test_raw_round_trip(self):
+        """
+        Tests reconstructing the raw packet from a parsed one
+        """
+        for raw in (ipv4_tcp_packet(payload=b"data", tcp_options=b"\x01\x01\x01\x01"),
+                    ipv4_udp_packet(payload=b"query"),
+                    ipv4_icmp_packet(payload=b"ping"),
+                    ipv6_tcp_packet(payload=b"data"),
+                    ipv6_udp_packet(payload=b"query")):
+            self.assertEqual(hexlify(raw), hexlify(parse_packet(raw).raw))
+
+    def test_ipv4_udp(self):
+        """
+        Tests parsing of an IPv4/UDP packet
+        """
+        packet = parse_packet(ipv4_udp_packet(dst_port=53, payload=b"query"))
+        self.assertIsNotNone(packet.udp_hdr)
+        self.assertIsNone(packet.tcp_hdr)
+        self.assertEqual(packet.dst_port, 53)
+        self.assertEqual(packet.payload, b"query")
+
+    def test_ipv4_icmp(self):
+        """
+        Tests parsing of an IPv4/ICMP packet
+        """
+        packet = parse_packet(ipv4_icmp_packet(payload=b"ping"))
+        self.assertEqual(packet.icmp_hdr.Type, 8)
+        self.assertEqual(packet.payload, b"ping")
+
+    def test_ipv6_tcp(self):
+        """
+        Tests parsing of an IPv6/TCP packet
+        """
+        packet = parse_packet(ipv6_tcp_packet(src_addr="::1", dst_addr="2607:f0d0:1002:51::4", dst_port=8080,
+                                              payload=b"data"))
+        self.assertIsNotNone(packet.ipv6_hdr)
+        self.assertIsNone(packet.ipv4_hdr)
+        self.assertEqual(packet.ipv6_hdr.HopLimit, 64)
+        self.assertEqual(packet.src_addr, "::1")
+        self.assertEqual(packet.dst_addr, "2607:f0d0:1002:51::4")
+        self.assertEqual(packet.dst_port, 8080)
+        self.assertEqual(packet.payload, b"data")
+
+    def test_non_first_fragment(self):
+        """
+        Tests that no transport header is decoded for a non-first IPv4 fragment
+        """
+        raw = ipv4_tcp_packet(frag_off=0x0010, payload=b"data")
+        packet = parse_packet(raw)
+        self.assertIsNotNone(packet.ipv4_hdr)
+        self.assertIsNone(packet.tcp_hdr)
+        self.assertEqual(packet.payload, raw[20:])
+
+    def test_truncated_transport(self):
+        """
+        Tests a truncated transport header is considered payload
+        """
+        raw = ipv4_tcp_packet()[:30]
+        packet = parse_packet(raw)
+        self.assertIsNone(packet.tcp_hdr)
+        self.assertEqual(packet.payload, raw[20:])
+
+    def test_meta(self):
+        """
+        Tests meta is stored into the parsed packet
+        """
+        meta = CapturedMetadata((1, 0), 0)
+        packet = parse_packet(ipv4_udp_packet(), meta)
+        self.assertIs(packet.meta, meta)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pydivert.enum import Direction
+from pydivert.models import CapturedMetadata
+from pydivert.parser import parse_packet
+from pydivert.pcap import PcapWriter, PcapngWriter, PcapReader, LINKTYPE_RAW, LINKTYPE_ETHERNET, LINKTYPE_NULL, \
+    PCAP_MAGIC, PCAP_NSEC_MAGIC, SECTION_HEADER_BLOCK, INTERFACE_DESCRIPTION_BLOCK, ENHANCED_PACKET_BLOCK, \
+    EPB_INBOUND, EPB_OUTBOUND
+from pydivert.tests import ipv4_udp_packet, ipv4_tcp_packet, ipv6_tcp_packet
+
+__author__ = 'fabio'
+
+
+def pcapng_blocks(data):
+    """
+    Return the (type, body) of the blocks of a pcapng file
+    """
+    blocks, offset = [], 0
+    while offset < len(data):
+        block_type, length = struct.unpack_from("<II", data, offset)
+        assert struct.unpack_from("<I", data, offset + length - 4)[0] == length
+        blocks.append((block_type, data[offset + 8:offset + length - 4]))
+        offset += length
+    return blocks
+
+
+class PcapWriterTestCase(unittest.TestCase):
+    """
+    Tests writing capture files
+    """
+
+    def setUp(self):
+        self.outbound = CapturedMetadata((3, 0), Direction.OUTBOUND)
+        self.inbound = CapturedMetadata((5, 1), Direction.INBOUND)
+
+    def test_pcap(self):
+        """
+        Tests the pcap header and records
+        """
+        output = io.BytesIO()
+        with PcapWriter(output, snaplen=40) as capture:
+            capture.write(ipv4_udp_packet(), self.outbound, timestamp=1.5)
+            capture.write(parse_packet(ipv4_tcp_packet(payload=b"x" * 20), self.inbound), timestamp=2)
+        data = output.getvalue()
+        self.assertEqual(struct.unpack_from("<IHHiIII", data), (PCAP_MAGIC, 2, 4, 0, 0, 40, LINKTYPE_RAW))
+        self.assertEqual(struct.unpack_from("<IIII", data, 24), (1, 500000, 28, 28))
+        self.assertEqual(data[40:68], ipv4_udp_packet())
+        self.assertEqual(struct.unpack_from("<IIII", data, 68), (2, 0, 40, 60))
+        self.assertEqual(data[84:], ipv4_tcp_packet(payload=b"x" * 20)[:40])
+        self.assertEqual(capture.count, 2)
+
+    def test_pcapng(self):
+        """
+        Tests interfaces and directions are stored in pcapng blocks
+        """
+        output = io.BytesIO()
+        with PcapngWriter(output) as capture:
+            capture.write_many([(ipv4_udp_packet(), self.outbound), (ipv4_tcp_packet(), self.inbound),
+                                (ipv4_udp_packet(dst_port=1), self.outbound)], timestamp=1.25)
+        blocks = pcapng_blocks(output.getvalue())
+        self.assertEqual([block_type for block_type, body in blocks],
+                         [SECTION_HEADER_BLOCK, INTERFACE_DESCRIPTION_BLOCK, ENHANCED_PACKET_BLOCK,
+                          INTERFACE_DESCRIPTION_BLOCK, ENHANCED_PACKET_BLOCK, ENHANCED_PACKET_BLOCK])
+        self.assertEqual(blocks[1][1][:2], struct.pack("<H", LINKTYPE_RAW))
+        self.assertIn(b"3.0", blocks[1][1])
+        self.assertIn(b"5.1", blocks[3][1])
+        for (block_type, body), interface_id, raw, flags in ((blocks[2], 0, ipv4_udp_packet(), EPB_OUTBOUND),
+                                                             (blocks[4], 1, ipv4_tcp_packet(), EPB_INBOUND),
+                                                             (blocks[5], 0, ipv4_udp_packet(dst_port=1),
+                                                              EPB_OUTBOUND)):
+            interface, high, low, captured, length = struct.unpack_from("<IIIII", body)
+            self.assertEqual((interface, high << 32 | low, captured, length), (interface_id, 1250000, len(raw),
+                                                                               len(raw)))
+            padded = (captured + 3) // 4 * 4
+            self.assertEqual(body[20:20 + captured], raw)
+            self.assertEqual(struct.unpack_from("<HHI", body, 20 + padded), (2, 4, flags))
+
+    def test_threaded(self):
+        """
+        Tests records written to a file by the background thread
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "capture.pcap")
+            capture = PcapWriter(path, buffer_size=100, threaded=True)
+            for port in range(1, 101):
+                capture.write(ipv4_udp_packet(dst_port=port), self.outbound)
+            capture.flush()
+            self.assertEqual(os.path.getsize(path), 24 + 100 * (16 + 28))
+            capture.close()
+            self.assertTrue(capture.file.closed)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_threaded_error(self):
+        """
+        Tests an error of the background thread is raised by the following calls instead of blocking them
+        """
+        class FullFile(io.BytesIO):
+            def write(self, data):
+                raise IOError("No space left on device")
+
+        capture = PcapWriter(FullFile(), threaded=True)
+        capture.write(ipv4_udp_packet(), self.outbound)
+        self.assertRaises(IOError, capture.flush)
+        self.assertRaises(IOError, capture.write, ipv4_udp_packet(), self.outbound)
+        self.assertRaises(IOError, capture.close)
+
+
+
+class PcapReaderTestCase(unittest.TestCase):
+    """
+    Tests reading capture files
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.packets = [(ipv4_udp_packet(dst_port=port), CapturedMetadata((port, 0), port % 2)) for port in (1, 2, 3)]
+        self.packets.append((ipv6_tcp_packet(), CapturedMetadata((4, 1), Direction.INBOUND)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, writer):
+        path = os.path.join(self.directory, "capture")
+        with writer(path) as capture:
+            for index, (raw, meta) in enumerate(self.packets):
+                capture.write(raw, meta, timestamp=10 + index / 4.0)
+        return path
+
+    def test_pcapng(self):
+        """
+        Tests reading back a pcapng file, with interfaces and directions
+        """
+        with PcapReader(self.write(PcapngWriter)) as capture:
+            self.assertEqual(capture.format, "pcapng")
+            records = [(raw.tobytes(), meta.iface, meta.direction, timestamp)
+                       for raw, meta, timestamp in capture.records()]
+            packets = list(capture)
+        self.assertEqual(records, [(raw, meta.iface, meta.direction, 10 + index / 4.0)
+                                   for index, (raw, meta) in enumerate(self.packets)])
+        self.assertEqual([packet.dst_port for packet in packets], [1, 2, 3, 80])
+        self.assertTrue(packets[3].meta.is_inbound())
+
+    def test_pcap(self):
+        """
+        Tests reading back a pcap file, giving the packets a default meta
+        """
+        meta = CapturedMetadata((1, 0), Direction.OUTBOUND)
+        with PcapReader(self.write(PcapWriter), meta) as capture:
+            self.assertEqual(capture.format, "pcap")
+            records = [(raw.tobytes(), got_meta, timestamp) for raw, got_meta, timestamp in capture.records()]
+        self.assertEqual(records, [(raw, meta, 10 + index / 4.0) for index, (raw, _) in enumerate(self.packets)])
+
+    def test_link_layers(self):
+        """
+        Tests link layer headers are stripped, in any byte order, and non IP frames skipped
+        """
+        raw = ipv4_tcp_packet()
+        ethernet = b"\xff" * 12 + b"\x81\x00\x00\x01" + b"\x08\x00" + raw
+        arp = b"\xff" * 12 + b"\x08\x06" + b"\x00" * 28
+        for order, magic, linktype, frames in ((">", PCAP_MAGIC, LINKTYPE_ETHERNET, [ethernet, arp]),
+                                               ("<", PCAP_NSEC_MAGIC, LINKTYPE_NULL,
+                                                [struct.pack("<I", 2) + raw, struct.pack("<I", 7) + raw])):
+            data = struct.pack(order + "IHHiIII", magic, 2, 4, 0, 0, 65535, linktype)
+            for frame in frames:
+                data += struct.pack(order + "IIII", 5, 2, len(frame), len(frame)) + frame
+            records = list(PcapReader(io.BytesIO(data)).records())
+            self.assertEqual([(bytes(raw_packet), timestamp) for raw_packet, meta, timestamp in records],
+                             [(raw, 5 + 2 * (1e-9 if magic == PCAP_NSEC_MAGIC else 1e-6))])
+        self.assertRaises(ValueError, PcapReader, io.BytesIO(b"not a capture file at all"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import struct
+import time
+import unittest
+
+from pydivert.enum import Direction
+from pydivert.fragments import fragment
+from pydivert.parser import parse_packet
+from pydivert.pipeline import Pipeline, flow_hash
+from pydivert.simulator import SimulatedLibrary
+from pydivert.tests import ipv4_udp_packet, ipv4_tcp_packet, ipv6_tcp_packet, ipv4_icmp_packet, ipv6_packet
+from pydivert.tests import with_checksums
+from pydivert.windivert import WinDivert, Handle
+
+__author__ = 'fabio'
+
+
+class PipelineTestCase(unittest.TestCase):
+    """
+    Tests processing packets on worker threads with the simulated driver
+    """
+
+    def setUp(self):
+        self.library = SimulatedLibrary()
+        self.driver = WinDivert(library=self.library)
+
+    def wait_for(self, pipeline, key, count):
+        deadline = time.time() + 5
+        while pipeline.counters[key] < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pipeline.counters[key], count)
+
+    def test_reinject_in_flow_order(self):
+        """
+        Tests packets are modified and reinjected keeping the order within each flow
+        """
+        def callback(packet):
+            packet.dst_port += 1000
+            return packet
+
+        pipeline = Pipeline(Handle(self.driver, filter="udp"), callback, workers=4)
+        with pipeline:
+            for sequence in range(20):
+                for src_port in range(1, 9):
+                    self.library.inject(ipv4_udp_packet(src_port=src_port, payload=struct.pack("!I", sequence)))
+            self.wait_for(pipeline, "sent", 160)
+        flows = {}
+        for raw, meta in self.library.delivered:
+            packet = parse_packet(raw)
+            self.assertEqual(packet.dst_port, 1053)
+            flows.setdefault(packet.src_port, []).append(struct.unpack("!I", packet.payload)[0])
+        self.assertEqual(flows, dict((src_port, list(range(20))) for src_port in range(1, 9)))
+        self.assertEqual(pipeline.counters, {"received": 160, "processed": 160, "sent": 160, "dropped": 0,
+                                             "errors": 0})
+
+    def test_drop_and_errors(self):
+        """
+        Tests packets are dropped when the callback returns None or raises
+        """
+        errors = []
+
+        def callback(raw_packet_meta):
+            raw_packet, meta = raw_packet_meta
+            port = struct.unpack_from("!H", raw_packet, 22)[0]
+            if port == 1:
+                return None
+            if port == 2:
+                raise ValueError("Bad packet")
+            return [raw_packet_meta, raw_packet_meta]
+
+        pipeline = Pipeline(Handle(self.driver, filter="udp"), callback, workers=2, raw=True,
+                            on_error=lambda packet, error: errors.append(error))
+        with pipeline:
+            for port in (1, 2, 3):
+                self.library.inject(ipv4_udp_packet(dst_port=port))
+            self.wait_for(pipeline, "sent", 2)
+        self.assertEqual(pipeline.counters["dropped"], 1)
+        self.assertEqual(pipeline.counters["errors"], 1)
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertEqual([raw for raw, meta in self.library.delivered], [ipv4_udp_packet(dst_port=3)] * 2)
+
+    def test_receive_errors(self):
+        """
+        Tests receive errors are reported and don't stop the receivers
+        """
+        errors = []
+        pipeline = Pipeline(Handle(self.driver, filter="udp"), lambda packet: packet, bufsize=100,
+                            on_error=lambda packet, error: errors.append((packet, error)))
+        with pipeline:
+            self.library.inject(ipv4_udp_packet(payload=b"x" * 200))
+            self.library.inject(ipv4_udp_packet(payload=b"data"))
+            self.wait_for(pipeline, "sent", 1)
+        self.assertEqual(pipeline.counters["errors"], 1)
+        self.assertIsNone(errors[0][0])
+        self.assertIsInstance(errors[0][1], Exception)
+        self.assertEqual([raw for raw, meta in self.library.delivered], [ipv4_udp_packet(payload=b"data")])
+
+    def test_persistent_receive_error(self):
+        """
+        Tests receivers back off rather than spin on an error which doesn't go away
+        """
+        def recv_many(*args):
+            raise OSError("Broken handle")
+
+        handle = Handle(self.driver, filter="udp")
+        handle.recv_many = recv_many
+        pipeline = Pipeline(handle, lambda packet: packet)
+        with pipeline:
+            time.sleep(0.3)
+        self.assertGreater(pipeline.counters["errors"], 0)
+        self.assertLess(pipeline.counters["errors"], 20)
+
+    def test_failing_on_error(self):
+        """
+        Tests an error raised by on_error doesn't stop the workers
+        """
+        def callback(packet):
+            if packet.dst_port == 2:
+                raise ValueError("Bad packet")
+            return packet
+
+        def on_error(packet, error):
+            raise RuntimeError("Can't report")
+
+        pipeline = Pipeline(Handle(self.driver, filter="udp"), callback, workers=1, on_error=on_error)
+        with pipeline:
+            for port in (2, 3):
+                self.library.inject(ipv4_udp_packet(dst_port=port))
+            self.wait_for(pipeline, "sent", 1)
+        self.assertEqual(pipeline.counters["errors"], 1)
+        self.assertEqual([raw for raw, meta in self.library.delivered], [ipv4_udp_packet(dst_port=3)])
+
+    def test_several_handles(self):
+        """
+        Tests packets are reinjected on the handle they come from
+        """
+        inbound = Handle(self.driver, filter="inbound", priority=1)
+        outbound = Handle(self.driver, filter="outbound", priority=2)
+        with Pipeline([inbound, outbound], lambda packet: packet, receivers=2) as pipeline:
+            for direction in (Direction.INBOUND, Direction.OUTBOUND) * 5:
+                self.library.inject(ipv4_udp_packet(), direction)
+            self.wait_for(pipeline, "sent", 10)
+        self.assertFalse(inbound.is_opened or outbound.is_opened)
+        self.assertEqual(self.library.counters["diverted"], 10)
+        self.assertEqual(len(self.library.delivered), 10)
+
+    def test_flow_hash(self):
+        """
+        Tests the flow hash does not depend on the direction
+        """
+        request = ipv4_tcp_packet(src_addr="10.0.0.1", dst_addr="10.0.0.2", src_port=1234, dst_port=80)
+        response = ipv4_tcp_packet(src_addr="10.0.0.2", dst_addr="10.0.0.1", src_port=80, dst_port=1234)
+        self.assertEqual(flow_hash(request), flow_hash(response))
+        self.assertEqual(flow_hash(memoryview(bytearray(request))), flow_hash(request))
+        self.assertNotEqual(flow_hash(request), flow_hash(ipv4_tcp_packet(src_port=1235)))
+        self.assertNotEqual(flow_hash(request), flow_hash(ipv4_udp_packet(src_port=1234, dst_port=80)))
+        self.assertEqual(flow_hash(ipv6_tcp_packet(src_addr="::1", dst_addr="::2")),
+                         flow_hash(ipv6_tcp_packet(src_addr="::2", dst_addr="::1", src_port=80, dst_port=1234)))
+        self.assertEqual(flow_hash(ipv4_icmp_packet()), flow_hash(ipv4_icmp_packet(src_addr="10.0.0.2",
+                                                                                   dst_addr="10.0.0.1")))
+        self.assertEqual(flow_hash(b""), 0)
+
+    def test_flow_hash_fragments(self):
+        """
+        Tests all the fragments of a datagram have the same hash, and IPv6 ports are found past extension headers
+        """
+        datagram = with_checksums(ipv4_udp_packet(src_port=1234, dst_port=53, payload=b"x" * 3000))
+        hashes = set(flow_hash(piece) for piece in fragment(datagram, mtu=1500))
+        self.assertEqual(len(hashes), 1)
+        datagram = ipv6_packet(0, b"\x11\x00" + b"\x01\x04\x00\x00\x00\x00" +
+                               struct.pack("!HHHH", 1234, 53, 8 + 3000, 0), payload=b"x" * 3000)
+        self.assertEqual(len(set(flow_hash(piece) for piece in fragment(datagram, mtu=1280))), 1)
+
+        extended = ipv6_packet(0, b"\x11\x00" + b"\x01\x04\x00\x00\x00\x00" + struct.pack("!HHHH", 1234, 53, 8, 0))
+        reply = ipv6_packet(17, struct.pack("!HHHH", 53, 1234, 8, 0), src_addr="fe80::2", dst_addr="fe80::1")
+        other = ipv6_packet(17, struct.pack("!HHHH", 1235, 53, 8, 0))
+        self.assertEqual(flow_hash(extended), flow_hash(reply))
+        self.assertNotEqual(flow_hash(extended), flow_hash(other))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import struct
+import threading
+import time
+import unittest
+
+from pydivert.enum import Direction
+from pydivert.models import CapturedMetadata
+from pydivert.parser import parse_packet
+from pydivert.processes import ProcessPipeline, SharedRing
+from pydivert.simulator import SimulatedLibrary
+from pydivert.tests import ipv4_udp_packet, with_checksums
+from pydivert.windivert import WinDivert, Handle
+
+__author__ = 'fabio'
+
+
+def redirect(packet):
+    packet.dst_port += 1000
+    return packet
+
+
+def filter_raw(raw_packet_meta):
+    port = struct.unpack_from("!H", raw_packet_meta[0], 22)[0]
+    if port == 1:
+        return None
+    if port == 2:
+        raise ValueError("Bad packet")
+    return [raw_packet_meta, raw_packet_meta]
+
+
+def crash(packet):
+    os._exit(1)
+
+
+def failing_on_error(packet, error):
+    raise RuntimeError("Can't report")
+
+
+class SlowMetadata(object):
+    """
+    Metadata letting other threads run while a packet is being put into a ring
+    """
+    direction = Direction.OUTBOUND
+
+    @property
+    def iface(self):
+        time.sleep(0.0001)
+        return 1, 0
+
+
+class SharedRingTestCase(unittest.TestCase):
+    """
+    Tests the shared memory rings
+    """
+
+    def test_put_get(self):
+        """
+        Tests packets and metadata go through the ring in order, wrapping around
+        """
+        ring = SharedRing(slots=2, slot_size=64)
+        meta = CapturedMetadata((3, 1), Direction.INBOUND)
+        for index in range(5):
+            self.assertTrue(ring.put(ipv4_udp_packet(dst_port=index), meta, handle=index))
+            raw_packet, got_meta, handle = ring.get()
+            self.assertEqual(raw_packet, ipv4_udp_packet(dst_port=index))
+            self.assertEqual((got_meta.iface, got_meta.direction, handle), ((3, 1), Direction.INBOUND, index))
+
+    def test_full_and_end(self):
+        """
+        Tests a full ring, an empty one and the end mark
+        """
+        ring = SharedRing(slots=1, slot_size=64)
+        meta = CapturedMetadata((1, 0), Direction.OUTBOUND)
+        self.assertIsNone(ring.get(False))
+        self.assertTrue(ring.put(b"a", meta))
+        self.assertFalse(ring.put(b"b", meta, block=False))
+        self.assertRaises(ValueError, ring.put, b"a" * 65, meta)
+        ring.get()
+        ring.put_end()
+        self.assertRaises(EOFError, ring.get)
+
+    def test_concurrent_producers(self):
+        """
+        Tests threads putting packets at the same time never overwrite each other's slots
+        """
+        ring = SharedRing(slots=300, slot_size=64)
+
+        def produce(handle):
+            for sequence in range(100):
+                ring.put(struct.pack("!I", sequence), SlowMetadata(), handle)
+
+        producers = [threading.Thread(target=produce, args=(handle,)) for handle in (0, 1, 2)]
+        for thread in producers:
+            thread.start()
+        for thread in producers:
+            thread.join()
+        received = dict((handle, []) for handle in (0, 1, 2))
+        for _ in range(300):
+            raw_packet, _, handle = ring.get()
+            received[handle].append(struct.unpack("!I", bytes(raw_packet))[0])
+        self.assertEqual(received, dict((handle, list(range(100))) for handle in (0, 1, 2)))
+        self.assertIsNone(ring.get(False))
+
+class ProcessPipelineTestCase(unittest.TestCase):
+    """
+    Tests processing packets on worker processes with the simulated driver
+    """
+
+    def setUp(self):
+        self.library = SimulatedLibrary()
+        self.driver = WinDivert(library=self.library)
+
+    def wait_for(self, pipeline, key, count):
+        deadline = time.time() + 10
+        while pipeline.counters[key] < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pipeline.counters[key], count)
+
+    def test_reinject_in_flow_order(self):
+        """
+        Tests packets are modified by the workers, with checksums updated, and reinjected in flow order
+        """
+        pipeline = ProcessPipeline(Handle(self.driver, filter="udp"), redirect, workers=3, ring_slots=8)
+        with pipeline:
+            for sequence in range(20):
+                for src_port in range(1, 9):
+                    self.library.inject(with_checksums(ipv4_udp_packet(src_port=src_port,
+                                                                       payload=struct.pack("!I", sequence))))
+            self.wait_for(pipeline, "sent", 160)
+        flows = {}
+        for raw, meta in self.library.delivered:
+            packet = parse_packet(raw)
+            self.assertEqual(raw, with_checksums(raw))
+            self.assertEqual(packet.dst_port, 1053)
+            flows.setdefault(packet.src_port, []).append(struct.unpack("!I", packet.payload)[0])
+        self.assertEqual(flows, dict((src_port, list(range(20))) for src_port in range(1, 9)))
+        self.assertEqual(pipeline.counters, {"received": 160, "processed": 160, "sent": 160, "dropped": 0,
+                                             "errors": 0})
+
+    def test_several_handles(self):
+        """
+        Tests the receivers of several handles share the ring to a worker without losing packets
+        """
+        handles = [Handle(self.driver, filter="udp.DstPort == {}".format(port)) for port in (53, 54)]
+        pipeline = ProcessPipeline(handles, redirect, workers=1, ring_slots=4, batch_size=1)
+        with pipeline:
+            for sequence in range(200):
+                for dst_port in (53, 54):
+                    self.library.inject(with_checksums(ipv4_udp_packet(dst_port=dst_port,
+                                                                       payload=struct.pack("!I", sequence))))
+            self.wait_for(pipeline, "sent", 400)
+        flows = {}
+        for raw, meta in self.library.delivered:
+            packet = parse_packet(raw)
+            flows.setdefault(packet.dst_port, []).append(struct.unpack("!I", packet.payload)[0])
+        self.assertEqual(flows, {1053: list(range(200)), 1054: list(range(200))})
+
+    def test_drop_and_errors(self):
+        """
+        Tests packets are dropped when the callback returns None or raises
+        """
+        pipeline = ProcessPipeline(Handle(self.driver, filter="udp"), filter_raw, workers=2, raw=True)
+        with pipeline:
+            for port in (1, 2, 3):
+                self.library.inject(ipv4_udp_packet(dst_port=port))
+            self.wait_for(pipeline, "sent", 2)
+        counters = pipeline.counters
+        self.assertEqual((counters["processed"], counters["dropped"], counters["errors"]), (2, 1, 1))
+        self.assertEqual([raw for raw, meta in self.library.delivered], [ipv4_udp_packet(dst_port=3)] * 2)
+
+    def test_receive_errors(self):
+        """
+        Tests receive errors are reported and don't stop the receivers
+        """
+        errors = []
+        pipeline = ProcessPipeline(Handle(self.driver, filter="udp"), redirect, workers=1, bufsize=100,
+                                   on_error=lambda packet, error: errors.append((packet, error)))
+        with pipeline:
+            self.library.inject(ipv4_udp_packet(payload=b"x" * 200))
+            self.library.inject(ipv4_udp_packet(payload=b"data"))
+            self.wait_for(pipeline, "sent", 1)
+        self.assertEqual(pipeline.counters["errors"], 1)
+        self.assertIsNone(errors[0][0])
+        self.assertEqual(len(self.library.delivered), 1)
+
+    def test_failing_on_error(self):
+        """
+        Tests an error raised by on_error doesn't stop the worker
+        """
+        pipeline = ProcessPipeline(Handle(self.driver, filter="udp"), filter_raw, workers=1, raw=True,
+                                   on_error=failing_on_error)
+        with pipeline:
+            for port in (2, 3):
+                self.library.inject(ipv4_udp_packet(dst_port=port))
+            self.wait_for(pipeline, "sent", 2)
+        self.assertEqual(pipeline.counters["errors"], 1)
+
+    def test_dead_worker(self):
+        """
+        Tests stopping doesn't wait forever for a worker which died, even with the receiver waiting for room in
+        its ring
+        """
+        pipeline = ProcessPipeline(Handle(self.driver, filter="udp"), crash, workers=1, ring_slots=2, batch_size=1)
+        pipeline.start()
+        for _ in range(10):
+            self.library.inject(ipv4_udp_packet())
+        pipeline._processes[0].join(10)
+        self.assertFalse(pipeline._processes[0].is_alive())
+        stopping = threading.Thread(target=pipeline.stop)
+        stopping.start()
+        stopping.join(10)
+        self.assertFalse(stopping.is_alive())
+        self.assertEqual(len(self.library.delivered), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import struct
+import unittest
+
+from pydivert.flows import TCP_SYN, TCP_ACK, TCP_FIN, TCP_RST
+from pydivert.parser import parse_packet
+from pydivert.reassembly import StreamReassembler
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet
+
+__author__ = 'fabio'
+
+
+def segment(seq, payload=b"", flags=TCP_ACK, reply=False):
+    """
+    Return a TCP segment of the connection 10.0.0.1:40000 --> 10.0.0.2:80, or of its reply
+    """
+    if reply:
+        raw = ipv4_tcp_packet(src_addr="10.0.0.2", dst_addr="10.0.0.1", src_port=80, dst_port=40000,
+                              payload=payload, flags=flags)
+    else:
+        raw = ipv4_tcp_packet(src_addr="10.0.0.1", dst_addr="10.0.0.2", src_port=40000, dst_port=80,
+                              payload=payload, flags=flags)
+    raw = bytearray(raw)
+    struct.pack_into("!I", raw, 24, seq & 0xFFFFFFFF)
+    return raw
+
+
+class StreamReassemblerTestCase(unittest.TestCase):
+    """
+    Tests reassembling TCP streams from segments
+    """
+
+    def setUp(self):
+        self.chunks = {True: [], False: []}
+        self.closed = []
+        self.reassembler = StreamReassembler(self.on_data, self.closed.append)
+
+    def on_data(self, stream, data):
+        self.chunks[stream.from_client].append(data)
+
+    def stream(self, from_client=True):
+        return b"".join(chunk.tobytes() for chunk in self.chunks[from_client])
+
+    def test_out_of_order(self):
+        """
+        Tests segments are handed over in order, once, whatever the order they arrive in
+        """
+        feed = self.reassembler.feed
+        feed(segment(99, flags=TCP_SYN), now=0)
+        feed(segment(999, flags=TCP_SYN | TCP_ACK, reply=True), now=0)
+        feed(segment(106, b"world"), now=0)
+        self.assertEqual(self.stream(), b"")
+        self.assertEqual(self.reassembler.buffered, 5)
+        # Overlaps the buffered segment, then a retransmission
+        ready = feed(parse_packet(segment(100, b"hello wo")), now=0)
+        self.assertEqual([data.tobytes() for stream, data in ready], [b"hello wo", b"rld"])
+        feed(segment(100, b"hello"), now=0)
+        feed(segment(1000, b"reply", reply=True), now=0)
+
+        self.assertEqual(self.stream(), b"hello world")
+        self.assertEqual(self.stream(False), b"reply")
+        self.assertEqual(self.reassembler.counters, {"delivered": 16, "duplicate": 7, "dropped": 0})
+        self.assertEqual(self.reassembler.buffered, 0)
+        self.assertEqual(feed(ipv4_udp_packet(), now=0), [])
+
+    def test_zero_copy(self):
+        """
+        Tests data is handed over as views over the packet buffers
+        """
+        raw = segment(1, b"data")
+        self.reassembler.feed(raw, now=0)
+        self.assertIsInstance(self.chunks[True][0], memoryview)
+        raw[-4:] = b"DATA"
+        self.assertEqual(self.stream(), b"DATA")
+
+    def test_held_segments_copied(self):
+        """
+        Tests segments held out of order don't refer to the packet buffers, which may be reused
+        """
+        self.reassembler.feed(segment(0, flags=TCP_SYN), now=0)
+        raw = segment(5, b"late")
+        self.reassembler.feed(raw, now=0)
+        raw[-4:] = b"LATE"
+        self.reassembler.feed(segment(1, b"data"), now=0)
+        self.assertEqual(self.stream(), b"datalate")
+
+    def test_sequence_wrapping(self):
+        """
+        Tests streams go on across the wrapping of the sequence numbers
+        """
+        self.reassembler.feed(segment(0xFFFFFFFE, flags=TCP_SYN), now=0)
+        self.reassembler.feed(segment(2, b"defg"), now=0)
+        self.reassembler.feed(segment(0xFFFFFFFF, b"abc"), now=0)
+        self.reassembler.feed(segment(1, b"cdef"), now=0)
+        self.assertEqual(self.stream(), b"abcdefg")
+
+    def test_close(self):
+        """
+        Tests streams are closed on FIN, once all their data has been handed over, on RST and on expiry
+        """
+        feed = self.reassembler.feed
+        feed(segment(1, b"abc"), now=0)
+        feed(segment(7, b"ghi", flags=TCP_FIN | TCP_ACK), now=0)
+        self.assertEqual(self.closed, [])
+        feed(segment(4, b"def"), now=0)
+        self.assertEqual(len(self.closed), 1)
+        self.assertTrue(self.closed[0].complete)
+        self.assertEqual(feed(segment(10, b"more"), now=0), [])
+        self.assertEqual(self.stream(), b"abcdefghi")
+
+        feed(segment(500, b"x", reply=True), now=0)
+        feed(segment(600, b"y", reply=True), now=0)
+        self.assertEqual(self.reassembler.buffered, 1)
+        feed(segment(10, flags=TCP_RST), now=0)
+        self.assertEqual(len(self.closed), 2)
+        self.assertFalse(self.closed[1].complete)
+        self.assertEqual(self.reassembler.buffered, 0)
+
+        # A new connection, left idle until it expires
+        feed(segment(1, flags=TCP_SYN), now=1)
+        feed(segment(10, b"late"), now=1)
+        self.reassembler.flows.expire(now=1000)
+        self.assertEqual(len(self.closed), 3)
+        self.assertEqual(self.reassembler.buffered, 0)
+
+    def test_port_reuse(self):
+        """
+        Tests the streams of a closed connection are closed once a new one reuses its endpoints
+        """
+        feed = self.reassembler.feed
+        feed(segment(1, flags=TCP_SYN), now=0)
+        feed(segment(10, b"pending"), now=0)
+        feed(segment(17, flags=TCP_FIN | TCP_ACK), now=0)
+        feed(segment(1, flags=TCP_FIN | TCP_ACK, reply=True), now=0)
+        self.assertEqual(len(self.closed), 1)
+        self.assertEqual(self.reassembler.buffered, 7)
+        feed(segment(1000, flags=TCP_SYN), now=1)
+        self.assertEqual(self.reassembler.buffered, 0)
+        self.assertEqual(len(self.closed), 2)
+        self.assertFalse(self.closed[1].complete)
+        feed(segment(1001, b"new"), now=1)
+        self.assertEqual(self.stream(), b"new")
+
+    def test_memory_bounds(self):
+        """
+        Tests segments beyond the bounds of a stream or of the reassembler are dropped
+        """
+        reassembler = StreamReassembler(max_buffer=10, max_memory=15)
+        reassembler.feed(segment(1, flags=TCP_SYN), now=0)
+        reassembler.feed(segment(1, flags=TCP_SYN, reply=True), now=0)
+        for seq in (10, 20, 30):
+            reassembler.feed(segment(seq, b"12345"), now=0)
+        reassembler.feed(segment(10, b"12345", reply=True), now=0)
+        reassembler.feed(segment(20, b"12345", reply=True), now=0)
+        self.assertEqual(reassembler.buffered, 15)
+        self.assertEqual(reassembler.counters["dropped"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+import struct
+import threading
+import unittest
+
+from pydivert.enum import Direction, Flag, Param, Layer
+from pydivert.simulator import SimulatedLibrary
+from pydivert.tests import ipv4_tcp_packet, ipv4_udp_packet, with_checksums
+from pydivert.windivert import WinDivert, Handle
+
+__author__ = 'fabio'
+
+
+class SimulatedDriverTestCase(unittest.TestCase):
+    """
+    Tests the whole recv/modify/send pipeline against the in-memory driver
+    """
+
+    def setUp(self):
+        self.lib = SimulatedLibrary(recv_timeout=0)
+        self.driver = WinDivert(library=self.lib)
+
+    def test_divert_and_reinject(self):
+        """
+        Tests a diverted packet is delivered once sent back, with its checksums fixed
+        """
+        with Handle(self.driver, filter="outbound") as handle:
+            self.lib.inject(ipv4_tcp_packet(payload=b"data"), Direction.OUTBOUND, (3, 1))
+            packet = handle.receive()
+            self.assertEqual(packet.meta.iface, (3, 1))
+            self.assertEqual(len(self.lib.delivered), 0)
+            packet.dst_port = 8080
+            packet.payload = b"DATA"
+            handle.send(packet)
+        raw, meta = self.lib.delivered.popleft()
+        self.assertEqual(raw, with_checksums(ipv4_tcp_packet(dst_port=8080, payload=b"DATA")))
+        self.assertEqual(meta.iface, (3, 1))
+        self.assertTrue(meta.is_outbound())
+
+    def test_filter(self):
+        """
+        Tests only packets matching the filter are diverted
+        """
+        with Handle(self.driver, filter="inbound and udp.DstPort == 5353") as handle:
+            self.lib.inject(ipv4_udp_packet(dst_port=5353), Direction.OUTBOUND)
+            self.lib.inject(ipv4_udp_packet(), Direction.INBOUND)
+            self.lib.inject(ipv4_udp_packet(dst_port=5353), Direction.INBOUND)
+            self.assertEqual(handle.receive().dst_port, 5353)
+            self.assertRaises(OSError, handle.recv)
+        self.assertEqual(len(self.lib.delivered), 2)
+
+    def test_invalid_open(self):
+        """
+        Tests opening handles with wrong arguments fails
+        """
+        self.assertEqual(self.lib.DivertOpen(b"no such filter", Layer.NETWORK, 0, 0), -1)
+        self.assertRaises(OSError, Handle(self.driver, flags=4).open)
+        self.assertRaises(OSError, Handle(self.driver, priority=5000).open)
+        self.assertRaises(OSError, Handle(self.driver, layer=7).open)
+
+    def test_priority(self):
+        """
+        Tests packets go through handles by priority, and reinjected ones skip the higher priorities
+        """
+        low = Handle(self.driver, priority=10).open()
+        high = Handle(self.driver, priority=-10).open()
+        self.lib.inject(ipv4_udp_packet())
+        self.assertRaises(OSError, low.recv)
+        high.send(high.recv())
+        low.send(low.recv())
+        self.assertEqual(len(self.lib.delivered), 1)
+        # A packet sent by the lowest priority handle is not diverted again
+        low.send(self.lib.delivered[0])
+        self.assertRaises(OSError, high.recv)
+        self.assertEqual(len(self.lib.delivered), 2)
+        low.close()
+        high.close()
+
+    def test_sniff_and_drop(self):
+        """
+        Tests sniffing handles get a copy, dropping ones discard packets
+        """
+        sniffer = Handle(self.driver, priority=-1, flags=Flag.SNIFF).open()
+        self.lib.inject(ipv4_udp_packet())
+        self.assertEqual(sniffer.recv()[0], ipv4_udp_packet())
+        self.assertEqual(len(self.lib.delivered), 1)
+        dropper = Handle(self.driver, flags=Flag.DROP).open()
+        self.lib.inject(ipv4_udp_packet())
+        self.assertEqual(len(sniffer.recv_many(4)), 1)
+        self.assertEqual(len(self.lib.delivered), 1)
+        self.assertEqual(self.lib.counters["dropped"], 1)
+        sniffer.close()
+        dropper.close()
+
+    def test_layers(self):
+        """
+        Tests handles see the packets of their layer only
+        """
+        with Handle(self.driver, layer=Layer.NETWORK_FORWARD) as handle:
+            self.lib.inject(ipv4_udp_packet())
+            self.lib.inject(ipv4_udp_packet(dst_port=5353), layer=Layer.NETWORK_FORWARD)
+            self.assertEqual([packet.dst_port for packet in handle.receive_many(4)], [5353])
+
+    def test_queue_len(self):
+        """
+        Tests packets exceeding the queue length are dropped
+        """
+        with Handle(self.driver) as handle:
+            handle.set_param(Param.QUEUE_LEN, 2)
+            self.assertEqual(handle.get_param(Param.QUEUE_LEN), 2)
+            for port in range(5):
+                self.lib.inject(ipv4_udp_packet(dst_port=port))
+            self.assertEqual(len(handle.recv_many(8)), 2)
+            self.assertEqual(self.lib.counters["dropped"], 3)
+
+    def test_sniff_queue_full(self):
+        """
+        Tests a sniffing handle with a full queue drops its copy only
+        """
+        with Handle(self.driver, flags=Flag.SNIFF) as sniffer:
+            sniffer.set_param(Param.QUEUE_LEN, 1)
+            for port in range(3):
+                self.lib.inject(ipv4_udp_packet(dst_port=port))
+            self.assertEqual(len(sniffer.recv_many(8)), 1)
+            self.assertEqual(len(self.lib.delivered), 3)
+            self.assertEqual(self.lib.counters["dropped"], 2)
+
+    def test_queue_time(self):
+        """
+        Tests packets queued for longer than the queue time are dropped
+        """
+        now = [0.0]
+        self.lib.clock = lambda: now[0]
+        with Handle(self.driver) as handle:
+            self.assertEqual(handle.get_param(Param.QUEUE_TIME), 256)
+            self.lib.inject(ipv4_udp_packet())
+            now[0] += 0.3
+            self.lib.inject(ipv4_udp_packet(dst_port=5353))
+            self.assertEqual([packet.dst_port for packet in handle.receive_many(4)], [5353])
+            self.assertEqual(self.lib.counters["expired"], 1)
+
+    def test_blocking_recv(self):
+        """
+        Tests recv waits for packets injected by other threads, and is aborted by close
+        """
+        self.lib.recv_timeout = None
+        handle = Handle(self.driver).open()
+        timer = threading.Timer(0.05, self.lib.inject, [ipv4_udp_packet(dst_port=5353)])
+        timer.start()
+        self.assertEqual(handle.receive().dst_port, 5353)
+        timer = threading.Timer(0.05, handle.close)
+        timer.start()
+        self.assertRaises(OSError, handle.recv)
+
+    def test_helpers(self):
+        """
+        Tests the address parsing and checksum helpers
+        """
+        self.assertEqual(self.driver.parse_ipv4_address("192.168.1.1"), 0xC0A80101)
+        address = "2607:f0d0:1002:0051:0000:0000:0000:0004"
+        self.assertEqual(tuple(self.driver.parse_ipv6_address(address)),
+                         struct.unpack("<HHHHHHHH", socket.inet_pton(socket.AF_INET6, address)))
+        self.assertRaises(OSError, self.driver.parse_ipv4_address, "not an address")
+        raw = ipv4_tcp_packet(payload=b"data")
+        self.assertEqual(bytes(self.driver.calc_checksums(raw)), with_checksums(raw))
+
+
+if __name__ == '__main__':
+    unittest.main()
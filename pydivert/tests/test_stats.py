@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import unittest
+
+from pydivert.pipeline import Pipeline
+from pydivert.simulator import SimulatedLibrary
+from pydivert.stats import Histogram, Reporter
+from pydivert.tests import ipv4_udp_packet
+from pydivert.windivert import WinDivert, Handle
+
+__author__ = 'fabio'
+
+
+class StatsTestCase(unittest.TestCase):
+    """
+    Tests the statistics collected by handles
+    """
+
+    def setUp(self):
+        self.library = SimulatedLibrary(recv_timeout=0)
+        self.handle = Handle(WinDivert(library=self.library), filter="udp").open()
+
+    def tearDown(self):
+        if self.handle.is_opened:
+            self.handle.close()
+
+    def test_histogram(self):
+        """
+        Tests values are counted in exponential buckets
+        """
+        histogram = Histogram()
+        for _ in range(98):
+            histogram.record(3e-6)
+        histogram.record(0.5e-3, 2)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 100)
+        self.assertEqual((snapshot["p50"], snapshot["p90"], snapshot["p99"]), (4e-6, 4e-6, 512e-6))
+        self.assertEqual(snapshot["max"], 0.5e-3)
+        self.assertEqual(sum(snapshot["buckets"]), 100)
+        self.assertIsNone(Histogram().snapshot()["p50"])
+
+    def test_disabled(self):
+        """
+        Tests nothing is collected until enabled
+        """
+        self.library.inject(ipv4_udp_packet())
+        self.handle.send(self.handle.receive())
+        self.assertIsNone(self.handle.stats)
+        stats = self.handle.enable_stats()
+        self.assertIs(self.handle.enable_stats(), stats)
+        self.handle.disable_stats()
+        self.assertIsNone(self.handle.stats)
+
+    def test_counters_and_timings(self):
+        """
+        Tests packets, errors and durations are recorded on receive and send
+        """
+        stats = self.handle.enable_stats()
+        for port in range(1, 6):
+            self.library.inject(ipv4_udp_packet(dst_port=port))
+        packet = self.handle.receive()
+        packet.dst_port = 80
+        self.handle.send(packet)
+        packets = self.handle.receive_many(8)
+        self.handle.send_many(packets)
+        self.assertRaises(OSError, self.handle.receive)
+        self.assertRaises(OSError, self.handle.recv_many, 8)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["counters"], {"received": 5, "sent": 5, "dropped": 0, "recv_errors": 2,
+                                                "send_errors": 0, "errors": 1})
+        timings = snapshot["timings"]
+        self.assertEqual(dict((name, values["count"]) for name, values in timings.items()),
+                         {"recv_wait": 7, "parse": 5, "checksum": 5, "send": 5, "callback": 0})
+        self.assertGreater(timings["parse"]["mean"], 0)
+
+    def test_batch_end(self):
+        """
+        Tests the end of a batch, when the driver has no more packets, is not counted as an error nor a wait
+        """
+        stats = self.handle.enable_stats()
+        for _ in range(2):
+            for port in range(1, 4):
+                self.library.inject(ipv4_udp_packet(dst_port=port))
+            self.assertEqual(len(self.handle.recv_many(8)), 3)
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot["counters"]["received"], snapshot["counters"]["recv_errors"]), (6, 0))
+        self.assertEqual(snapshot["timings"]["recv_wait"]["count"], 6)
+
+    def test_pipeline_and_reporter(self):
+        """
+        Tests callbacks are timed by pipelines, and statistics exported
+        """
+        handle = Handle(WinDivert(library=SimulatedLibrary()), filter="udp")
+        stats = handle.enable_stats()
+        exported = []
+        reporter = Reporter({"udp": handle}, lambda name, snapshot: exported.append((name, snapshot)), 0.01)
+        pipeline = Pipeline(handle, lambda packet: packet if packet.dst_port != 1 else None, workers=1)
+        with reporter, pipeline:
+            for port in (1, 2):
+                handle.driver.get_reference().inject(ipv4_udp_packet(dst_port=port))
+            deadline = time.time() + 5
+            while pipeline.counters["processed"] < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)
+        self.assertEqual(stats.snapshot()["timings"]["callback"]["count"], 2)
+        self.assertEqual(stats.counters["dropped"], 1)
+        self.assertEqual(stats.counters["sent"], 1)
+        self.assertGreater(len(exported), 1)
+        self.assertEqual(exported[-1][0], "udp")
+        self.assertEqual(exported[-1][1]["counters"]["received"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+
+from pydivert.enum import Param
+from pydivert.simulator import SimulatedLibrary
+from pydivert.tuning import QueueTuner
+from pydivert.windivert import WinDivert, Handle
+
+__author__ = 'fabio'
+
+
+class QueueTunerTestCase(unittest.TestCase):
+    """
+    Tests the queue parameters are adjusted to the load
+    """
+
+    def setUp(self):
+        self.handle = Handle(WinDivert(library=SimulatedLibrary())).open()
+        self.tuner = QueueTuner(self.handle)
+        self.stats = self.handle.stats
+
+    def tearDown(self):
+        self.handle.close()
+
+    def load(self, packets, wait):
+        """
+        Records packets received after waiting wait seconds each
+        """
+        self.stats.count("received", packets)
+        self.stats.record("recv_wait", wait, packets)
+
+    def params(self):
+        return self.handle.get_param(Param.QUEUE_LEN), self.handle.get_param(Param.QUEUE_TIME)
+
+    def test_burst(self):
+        """
+        Tests the queue grows while saturated and shrinks back when idle
+        """
+        self.assertEqual(self.params(), (512, 256))
+        self.load(20000, 1e-6)
+        decision = self.tuner.step(1.0)
+        self.assertEqual(decision["reason"], "saturated")
+        # Twice the 20000 packets/s arriving in 512ms, beyond the maximum
+        self.assertEqual(self.params(), (8192, 512))
+        self.load(10000, 1e-6)
+        self.tuner.step(1.0)
+        self.assertEqual(self.params(), (8192, 1024))
+        # Never beyond the driver bounds
+        self.load(10000, 1e-6)
+        self.assertIsNone(self.tuner.step(1.0))
+        # The peak rate halves at each step
+        for reason, expected in (("idle", (5120, 512)), ("idle", (1280, 256)), ("rate", (640, 256)),
+                                 ("rate", (512, 256))):
+            self.load(10, 1e-3)
+            self.assertEqual(self.tuner.step(1.0)["reason"], reason)
+            self.assertEqual(self.params(), expected)
+        self.load(10, 1e-3)
+        self.assertIsNone(self.tuner.step(1.0))
+        self.assertEqual(self.stats.snapshot()["gauges"], {"queue_len": 512, "queue_time": 256})
+        self.assertEqual(len(self.tuner.decisions), 6)
+
+    def test_rate(self):
+        """
+        Tests the queue length follows the rate without changing the time when neither saturated nor idle
+        """
+        self.load(3000, 1e-6)
+        self.load(2000, 1e-3)
+        decision = self.tuner.step(1.0)
+        self.assertEqual(decision["reason"], "rate")
+        self.assertEqual(decision["queue_len"], (512, 2560))
+        self.assertEqual(self.params(), (2560, 256))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import socket
 import unittest
-from pydivert.winutils import addr_to_string, string_to_addr
+from pydivert import winutils
+from pydivert.winutils import addr_to_string, string_to_addr, addrs_to_strings, strings_to_addrs, packed_to_string
 
 __author__ = 'fabio'
 
@@ -75,3 +76,35 @@ class WinInetTestCase(unittest.TestCase):
         self.assertRaises(ValueError, string_to_addr, addr_fam, address)
         addr = string_to_addr(socket.AF_INET6, address)
         self.assertRaises(ValueError, addr_to_string, addr_fam, addr)
+
+    def test_bulk_conversion(self):
+        """
+        Tests converting lists of addresses
+        """
+        addresses = ["10.0.0.1", "192.168.1.1", "10.0.0.1"]
+        addrs = strings_to_addrs(socket.AF_INET, addresses)
+        self.assertEqual(addrs[0], string_to_addr(socket.AF_INET, "10.0.0.1"))
+        self.assertEqual(addrs_to_strings(socket.AF_INET, addrs), addresses)
+        addresses = ["::1", "fe80::1"]
+        self.assertEqual(addrs_to_strings(socket.AF_INET6, strings_to_addrs(socket.AF_INET6, addresses)), addresses)
+
+    def test_cached_conversion(self):
+        """
+        Tests recent conversions are remembered, and errors are not
+        """
+        packed = b"\x0a\x00\x00\x01"
+        self.assertIs(packed_to_string(socket.AF_INET, packed), packed_to_string(socket.AF_INET, packed))
+        self.assertRaises((socket.error, ValueError), string_to_addr, socket.AF_INET, "10.0.0")
+        self.assertRaises((socket.error, ValueError), string_to_addr, socket.AF_INET, "10.0.0")
+
+    @unittest.skipIf(winutils.ipaddress is None, "ipaddress not available")
+    def test_ipaddress_conversion(self):
+        """
+        Tests the conversions based on the ipaddress module agree with the socket ones
+        """
+        for family, address in ((socket.AF_INET, "192.168.1.1"), (socket.AF_INET6, "2607:f0d0:1002:51::4")):
+            packed = winutils._ipaddress_inet_pton(family, address)
+            self.assertEqual(packed, socket.inet_pton(family, address))
+            self.assertEqual(winutils._ipaddress_inet_ntop(family, packed), address)
+        self.assertRaises(socket.error, winutils._ipaddress_inet_pton, socket.AF_INET, "::1")
+        self.assertRaises(socket.error, winutils._ipaddress_inet_ntop, -1, b"")
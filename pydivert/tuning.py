@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Automatic tuning of the driver queue of an handle.
+
+The driver queues the diverted packets until they are received, dropping them when the queue holds
+QUEUE_LEN packets or once they have waited QUEUE_TIME milliseconds. QueueTuner adjusts both from the
+statistics of the handle (see pydivert.stats):
+
+    * when the application is saturated, i.e. almost every DivertRecv() returns at once because
+      packets are waiting, QUEUE_TIME is doubled, up to max_queue_time, to ride out the burst
+    * when the application is mostly idle, QUEUE_TIME is halved back, down to min_queue_time, which
+      bounds the latency of the packets
+    * QUEUE_LEN follows the peak receive rate: it holds headroom times the packets arriving in
+      QUEUE_TIME, so that packets expire rather than being dropped for lack of room
+
+    tuner = QueueTuner(handle).start()
+"""
+import collections
+import logging
+import math
+import threading
+import time
+
+from pydivert.enum import Param, PARAM_BOUNDS
+from pydivert.stats import BUCKETS
+
+__author__ = 'fabio'
+
+logger = logging.getLogger(__name__)
+
+
+class QueueTuner(object):
+    """
+    Adjusts QUEUE_LEN and QUEUE_TIME of an opened handle, enabling its statistics.
+
+    A DivertRecv() returning within busy_wait seconds (rounded down to a bound of the histogram buckets)
+    found a packet waiting: the application is saturated if the share of such calls reaches saturated, idle
+    if it is not above idle. Parameters are adjusted each interval seconds once started, or at each call of
+    step(). The decisions taken are logged, kept in decisions and published as the queue_len and queue_time
+    gauges of the statistics.
+    """
+
+    def __init__(self, handle, min_queue_time=PARAM_BOUNDS[Param.QUEUE_TIME][1],
+                 max_queue_time=PARAM_BOUNDS[Param.QUEUE_TIME][2], min_queue_len=PARAM_BOUNDS[Param.QUEUE_LEN][1],
+                 headroom=2.0, busy_wait=64e-6, saturated=0.9, idle=0.5, interval=1.0, history=100):
+        low, _, high = PARAM_BOUNDS[Param.QUEUE_TIME]
+        self.min_queue_time = max(low, min(min_queue_time, high))
+        self.max_queue_time = max(self.min_queue_time, min(max_queue_time, high))
+        low, _, high = PARAM_BOUNDS[Param.QUEUE_LEN]
+        self.min_queue_len = max(low, min(min_queue_len, high))
+        self.handle = handle
+        self.headroom = headroom
+        self.busy_wait = busy_wait
+        self.saturated = saturated
+        self.idle = idle
+        self.interval = interval
+        self.decisions = collections.deque(maxlen=history)
+        self.peak_rate = 0.0
+        self.stats = handle.enable_stats()
+        self.queue_len = handle.get_param(Param.QUEUE_LEN)
+        self.queue_time = handle.get_param(Param.QUEUE_TIME)
+        self.stats.set("queue_len", self.queue_len)
+        self.stats.set("queue_time", self.queue_time)
+        # Buckets of the recv_wait histogram counting the busy calls
+        self._busy_buckets = len([bound for bound in BUCKETS if bound <= busy_wait])
+        self._last = self._sample()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        snapshot = self.stats.snapshot()
+        return time.time(), snapshot["counters"]["received"], snapshot["timings"]["recv_wait"]["buckets"]
+
+    def step(self, elapsed=None):
+        """
+        Adjusts the parameters from the statistics collected since the previous step, elapsed seconds ago
+        (measured if not given). Return the decision taken, None if the parameters have not changed.
+        """
+        now, received, buckets = self._sample()
+        last_time, last_received, last_buckets = self._last
+        self._last = now, received, buckets
+        if elapsed is None:
+            elapsed = now - last_time
+        received -= last_received
+        waits = [count - last for count, last in zip(buckets, last_buckets)]
+        calls = sum(waits)
+        if elapsed <= 0 or not calls:
+            return None
+        rate = received / float(elapsed)
+        busy = sum(waits[:self._busy_buckets]) / float(calls)
+        # The peak rate decays, so that the queue shrinks back some intervals after a burst
+        self.peak_rate = max(rate, self.peak_rate / 2)
+
+        queue_time, reason = self.queue_time, None
+        if busy >= self.saturated and queue_time < self.max_queue_time:
+            queue_time, reason = min(queue_time * 2, self.max_queue_time), "saturated"
+        elif busy <= self.idle and queue_time > self.min_queue_time:
+            queue_time, reason = max(queue_time // 2, self.min_queue_time), "idle"
+        high = PARAM_BOUNDS[Param.QUEUE_LEN][2]
+        queue_len = int(min(high, max(self.min_queue_len,
+                                      math.ceil(self.peak_rate * queue_time / 1000.0 * self.headroom))))
+        if (queue_len, queue_time) == (self.queue_len, self.queue_time):
+            return None
+        decision = {"time": now, "rate": rate, "busy": busy, "reason": reason or "rate",
+                    "queue_len": (self.queue_len, queue_len), "queue_time": (self.queue_time, queue_time)}
+        self.apply(queue_len, queue_time)
+        self.decisions.append(decision)
+        logger.info("QUEUE_LEN %d -> %d, QUEUE_TIME %d -> %d ms (%s: %.0f packets/s, %.0f%% busy)",
+                    decision["queue_len"][0], queue_len, decision["queue_time"][0], queue_time, decision["reason"],
+                    rate, busy * 100)
+        return decision
+
+    def apply(self, queue_len, queue_time):
+        """
+        Sets the parameters of the handle
+        """
+        if queue_len != self.queue_len:
+            self.handle.set_param(Param.QUEUE_LEN, queue_len)
+            self.queue_len = queue_len
+            self.stats.set("queue_len", queue_len)
+        if queue_time != self.queue_time:
+            self.handle.set_param(Param.QUEUE_TIME, queue_time)
+            self.queue_time = queue_time
+            self.stats.set("queue_time", queue_time)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if not self.handle.is_opened:
+                break
+            self.step()
+
+    def start(self):
+        """
+        Adjusts the parameters every interval seconds from a background thread
+        """
+        self._stopped.clear()
+        self._last = self._sample()
+        self._thread = threading.Thread(target=self._run, name="pydivert-tuner")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
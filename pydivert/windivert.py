@@ -15,28 +15,79 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import ctypes
 import os
-from pydivert.decorators import winerror_on_retcode
+import threading
+from pydivert import parser, filters
+from pydivert.stats import HandleStats, clock
+from pydivert.decorators import winerror_on_retcode, winerror
 from pydivert.enum import Layer
 from pydivert.winutils import get_reg_values
 from pydivert.models import DivertAddress, DivertIpHeader, DivertIpv6Header, DivertIcmpHeader, DivertIcmpv6Header, DivertTcpHeader, DivertUdpHeader, CapturedPacket, CapturedMetadata, HeaderWrapper
 
 __author__ = 'fabio'
 PACKET_BUFFER_SIZE = 1500
+BATCH_SIZE = 64
+
+ERROR_NO_DATA = 232
+ERROR_OPERATION_ABORTED = 995
+ERROR_IO_PENDING = 997
+WAIT_TIMEOUT = 0x102
+
+
+def as_ctypes_buffer(data):
+    """
+    Return data in a form that can be passed to the DLL as a PVOID.
+    Writable buffers (e.g. the view returned by CapturedPacket.writable_raw()) are shared, not copied.
+    """
+    if isinstance(data, bytes):
+        return data
+    try:
+        return (ctypes.c_char * len(data)).from_buffer(data)
+    except TypeError:
+        # Read-only buffer
+        return (ctypes.c_char * len(data)).from_buffer_copy(data)
+
+
+class Overlapped(ctypes.Structure):
+    """
+    Ctypes Structure for OVERLAPPED, used to receive with a timeout through DivertRecvEx.
+    """
+    _fields_ = [("Internal", ctypes.c_void_p),
+                ("InternalHigh", ctypes.c_void_p),
+                ("Offset", ctypes.c_uint32),
+                ("OffsetHigh", ctypes.c_uint32),
+                ("hEvent", ctypes.c_void_p)]
 
 
 class WinDivert(object):
     """
     Python interface for WinDivert.dll library.
+
+    The functions of the DLL may be provided by another library object instead, e.g. the in-memory driver
+    from pydivert.simulator. Such a library must expose the DLL functions and a GetLastError() method.
+    It may also expose DivertRecvTimeout(handle, packet, packet_len, address, recv_len, timeout), a DivertRecv
+    waiting at most timeout seconds, used by Handle.recv_many() to bound the wait for the packets of a batch.
     """
 
-    def __init__(self, dll_path=None, reg_key=r"SYSTEM\CurrentControlSet\Services\WinDivert1.0"):
-        if not dll_path:
-            #We try to load from registry key
-            self.registry = get_reg_values(reg_key)
-            self.driver = self.registry["ImagePath"]
-            dll_path = ("%s.%s" % (os.path.splitext(self.driver)[0], "dll"))[4:]
-        self._lib = ctypes.CDLL(dll_path)
+    def __init__(self, dll_path=None, reg_key=r"SYSTEM\CurrentControlSet\Services\WinDivert1.0",
+                 native_parser=False, library=None):
+        if library is not None:
+            self._lib = library
+            self._get_last_error = library.GetLastError
+            self._recv_timeout = getattr(library, "DivertRecvTimeout", None)
+        else:
+            if not dll_path:
+                #We try to load from registry key
+                self.registry = get_reg_values(reg_key)
+                self.driver = self.registry["ImagePath"]
+                dll_path = ("%s.%s" % (os.path.splitext(self.driver)[0], "dll"))[4:]
+            self._lib = ctypes.CDLL(dll_path)
+            self._get_last_error = ctypes.GetLastError
+            # DivertRecvEx, and overlapped receives, are available since WinDivert 1.1
+            self._recv_timeout = self._overlapped_recv if hasattr(self._lib, "DivertRecvEx") else None
+            self._events = threading.local()
         self.reg_key = reg_key
+        # Packets are parsed in python unless asked to go through DivertHelperParsePacket
+        self.native_parser = native_parser
 
     def open_handle(self, filter="true", layer=Layer.NETWORK, priority=0, flags=0):
         """
@@ -50,13 +101,83 @@ class WinDivert(object):
         """
         return self._lib
 
-    @winerror_on_retcode
+    def get_last_error(self):
+        """
+        Return the error code of the last library call made by the current thread
+        """
+        return self._get_last_error()
+
+    def recv_timeout(self, handle, packet, packet_len, address, recv_len, timeout):
+        """
+        Receives a packet like DivertRecv, address and recv_len being passed as ctypes objects, but waiting at most
+        timeout seconds for it. Return whether a packet has been received, None if the library can't bound the wait:
+        then nothing has been received.
+        """
+        if self._recv_timeout is None:
+            return None
+        return self._recv_timeout(handle, packet, packet_len, ctypes.byref(address), ctypes.byref(recv_len), timeout)
+
+    def _overlapped_recv(self, handle, packet, packet_len, address, recv_len, timeout):
+        """
+        DivertRecv with a timeout, built on an overlapped DivertRecvEx:
+        BOOL DivertRecvEx(
+            __in HANDLE handle,
+            __out PVOID pPacket,
+            __in UINT packetLen,
+            __in UINT64 flags,
+            __out_opt PDIVERT_ADDRESS pAddr,
+            __out_opt UINT *recvLen,
+            __inout_opt LPOVERLAPPED lpOverlapped
+        );
+        """
+        kernel32 = ctypes.windll.kernel32
+        event = getattr(self._events, "event", None)
+        if event is None:
+            # A manual reset event per thread, reset by the driver when each request starts
+            event = self._events.event = kernel32.CreateEventW(None, True, False, None)
+        overlapped = Overlapped(hEvent=event)
+        if self._lib.DivertRecvEx(handle, packet, packet_len, 0, address, recv_len, ctypes.byref(overlapped)):
+            return True
+        if ctypes.GetLastError() != ERROR_IO_PENDING:
+            return False
+        if kernel32.WaitForSingleObject(event, int(timeout * 1000)) == WAIT_TIMEOUT:
+            kernel32.CancelIoEx(handle, ctypes.byref(overlapped))
+        # Wait for the request to settle: it may have completed while being cancelled
+        transferred = ctypes.c_uint32(0)
+        if not kernel32.GetOverlappedResult(handle, ctypes.byref(overlapped), ctypes.byref(transferred), True):
+            return False
+        recv_len._obj.value = transferred.value
+        return True
+
     def parse_packet(self, *args):
         """
         Parses a raw packet into a higher level object.
         Args could be a tuple or two different values. In each case the first one is the raw data and the second
         is the meta about the direction and interface to use.
 
+        By default the packet is decoded by the python parser (see pydivert.parser), which avoids a foreign call
+        per packet. If the driver has been built with native_parser=True, DivertHelperParsePacket is used instead.
+        """
+        if len(args) == 1:
+            # Raw packets may be any buffer (bytes, bytearray, memoryview...), pairs are sequences
+            if isinstance(args[0], (tuple, list)):
+                raw_packet, meta = args[0]
+            else:
+                raw_packet, meta = args[0], None
+        elif len(args) == 2:
+            raw_packet, meta = args[0], args[1]
+        else:
+            raise ValueError("Wrong number of arguments passed to parse_packet")
+
+        if self.native_parser:
+            return self.native_parse_packet(raw_packet, meta)
+        return parser.parse_packet(raw_packet, meta)
+
+    @winerror_on_retcode
+    def native_parse_packet(self, raw_packet, meta=None):
+        """
+        Parses a raw packet into a higher level object using the DLL helper.
+
         The function remapped is DivertHelperParsePacket:
         Parses a raw packet (e.g. from DivertRecv()) into the various packet headers
         and/or payloads that may or may not be present.
@@ -74,17 +195,6 @@ class WinDivert(object):
             __out_opt UINT *pDataLen
         );
         """
-        if len(args) == 1:
-            #Maybe this is a poor way to check the type, but it should work
-            if hasattr(args[0], "__iter__") and not hasattr(args[0], "strip"):
-                raw_packet, meta = args[0]
-            else:
-                raw_packet, meta = args[0], None
-        elif len(args) == 2:
-            raw_packet, meta = args[0], args[1]
-        else:
-            raise ValueError("Wrong number of arguments passed to parse_packet")
-
         packet_len = len(raw_packet)
         # Consider everything else not part of headers as payload
         # payload = ctypes.c_void_p(0)
@@ -176,17 +286,31 @@ class WinDivert(object):
         );
         """
         packet_len = len(packet)
-        buff = ctypes.create_string_buffer(packet, packet_len)
+        buff = (ctypes.c_char * packet_len).from_buffer_copy(packet)
         self._lib.DivertHelperCalcChecksums(ctypes.byref(buff), packet_len, flags)
         return buff
 
     @winerror_on_retcode
     def update_packet_checksums(self, packet):
         """
-        An utility shortcut method to update the checksums into an higher level packet
+        An utility shortcut method to update the checksums into a copy of an higher level packet.
+        The copy reuses the layout of the packet instead of parsing it again.
         """
         raw = self.calc_checksums(packet.raw)
-        return self.parse_packet(raw, packet.meta)
+        return CapturedPacket.from_buffer(bytearray(raw), packet._layout, packet.meta)
+
+    @winerror_on_retcode
+    def update_checksums(self, packets, flags=0):
+        """
+        (Re)calculates the checksums of several higher level packets at once.
+        Unlike update_packet_checksums(), checksums are written straight into each packet buffer:
+        nothing is copied nor parsed again.
+        """
+        calc_checksums = self._lib.DivertHelperCalcChecksums
+        for packet in packets:
+            raw = packet._buffer
+            calc_checksums(as_ctypes_buffer(raw), len(raw), flags)
+            packet._checksums_updated()
 
     @winerror_on_retcode
     def register(self):
@@ -208,6 +332,30 @@ class WinDivert(object):
         return "%s" % self._lib
 
 
+class PacketRing(object):
+    """
+    A ring of receive buffers allocated once and reused by Handle.recv_many().
+    Each slot owns a bytearray, the ctypes view over it passed to DivertRecv and a DivertAddress.
+    """
+
+    def __init__(self, size, bufsize=PACKET_BUFFER_SIZE):
+        self.size = size
+        self.bufsize = bufsize
+        self._buffers = [bytearray(bufsize) for _ in range(size)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        self._packets = [(ctypes.c_char * bufsize).from_buffer(buffer) for buffer in self._buffers]
+        self._addresses = [DivertAddress() for _ in range(size)]
+        self._cursor = 0
+
+    def next_slot(self):
+        """
+        Return the (ctypes buffer, memoryview, address) of the next slot, wrapping around the ring
+        """
+        index = self._cursor
+        self._cursor = (index + 1) % self.size
+        return self._packets[index], self._views[index], self._addresses[index]
+
+
 class Handle(object):
     """
     An handle object got from a WinDivert DLL.
@@ -221,17 +369,46 @@ class Handle(object):
             self.driver = driver
         self._lib = self.driver.get_reference()
         self._handle = None
+        if not hasattr(filter, "encode"):
+            # A filter built with pydivert.optimizer
+            filter = str(filter)
         self._filter = filter.encode("UTF-8")
         self._layer = layer
         self._priority = priority
         self._flags = flags
+        # Receive rings are per thread, so that several threads may receive from the same handle
+        self._local = threading.local()
+        # Statistics are disabled until enable_stats() is called
+        self.stats = None
+
+    def enable_stats(self):
+        """
+        Starts collecting statistics (see pydivert.stats) and return them
+        """
+        if self.stats is None:
+            self.stats = HandleStats()
+        return self.stats
+
+    def disable_stats(self):
+        """
+        Stops collecting statistics
+        """
+        self.stats = None
+
+    def get_last_error(self):
+        """
+        Return the error code of the last driver call made by the current thread
+        """
+        return self.driver.get_last_error()
 
     @winerror_on_retcode
-    def open(self):
+    def open(self, validate=False):
         """
         Opens a WinDivert handle for the given filter.
         Unless otherwise specified by flags, any packet that matches the filter will be diverted to the handle.
         Diverted packets can be read by the application with receive().
+        The filter is handed over to the driver as is: with validate, it is first parsed by pydivert.filters and
+        rejected with a FilterSyntaxError, pointing at the error, if it doesn't understand it.
 
         The remapped function is DivertOpen:
         HANDLE DivertOpen(
@@ -241,6 +418,8 @@ class Handle(object):
             __in UINT64 flags
         );
         """
+        if validate:
+            filters.parse(self._filter)
         self._handle = self._lib.DivertOpen(self._filter, self._layer, self._priority, self._flags)
         return self
 
@@ -264,7 +443,15 @@ class Handle(object):
         packet = ctypes.create_string_buffer(bufsize)
         address = DivertAddress()
         recv_len = ctypes.c_int(0)
-        self._lib.DivertRecv(self._handle, packet, bufsize, ctypes.byref(address), ctypes.byref(recv_len))
+        stats = self.stats
+        if stats is None:
+            self._lib.DivertRecv(self._handle, packet, bufsize, ctypes.byref(address), ctypes.byref(recv_len))
+        else:
+            start = clock()
+            received = self._lib.DivertRecv(self._handle, packet, bufsize, ctypes.byref(address),
+                                            ctypes.byref(recv_len))
+            stats.record("recv_wait", clock() - start)
+            stats.count("received" if received else "recv_errors")
         return packet[:recv_len.value], CapturedMetadata((address.IfIdx, address.SubIfIdx), address.Direction)
 
     @winerror_on_retcode
@@ -275,7 +462,75 @@ class Handle(object):
         The received packet is guaranteed to match the filter.
         This is the low level way to access the driver.
         """
-        return self.driver.parse_packet(self.recv(bufsize))
+        stats = self.stats
+        if stats is None:
+            return self.driver.parse_packet(self.recv(bufsize))
+        record = self.recv(bufsize)
+        start = clock()
+        packet = self.driver.parse_packet(record)
+        stats.record("parse", clock() - start)
+        return packet
+
+    def recv_many(self, count=BATCH_SIZE, bufsize=PACKET_BUFFER_SIZE, timeout=None):
+        """
+        Receives up to count diverted packets in a single call.
+        The return value is a list of (raw_packet, meta) pairs, like the ones returned by recv(), where
+        raw_packet is a memoryview over a preallocated buffer: no memory is allocated for the packet data.
+
+        The buffers belong to a ring of 2 * count slots owned by the handle, so the views returned by a call
+        stay valid during the following one and are then overwritten. Copy them (or parse them, since parsing
+        copies the packet) if you need to keep packets around. Each thread receiving from the handle has its own ring.
+
+        The first packet is waited for as DivertRecv() does. Then the batch is closed as soon as no more packets
+        are queued or, if timeout (in seconds) is given, as soon as it expires: packets already received are never
+        held longer. If the library can't bound the wait (WinDivert 1.0 has no overlapped receives), the batch is
+        closed right after the first packet.
+        """
+        ring = getattr(self._local, "ring", None)
+        if ring is None or ring.size < 2 * count or ring.bufsize < bufsize:
+            ring = self._local.ring = PacketRing(2 * count, bufsize)
+        recv, recv_timeout, stats = self._lib.DivertRecv, self.driver.recv_timeout, self.stats
+        recv_len = ctypes.c_uint(0)
+        deadline = clock() + (timeout or 0)
+        records = []
+        while len(records) < count:
+            packet, view, address = ring.next_slot()
+            start = clock()
+            if records:
+                received = recv_timeout(self._handle, packet, ring.bufsize, address, recv_len,
+                                        max(deadline - start, 0))
+                if received is None:
+                    break
+                if not received and self.get_last_error() in (ERROR_NO_DATA, ERROR_OPERATION_ABORTED):
+                    # No more packets before the deadline: the batch is over, nothing went wrong
+                    break
+            else:
+                received = recv(self._handle, packet, ring.bufsize, ctypes.byref(address), ctypes.byref(recv_len))
+            if stats is not None:
+                stats.record("recv_wait", clock() - start)
+                stats.count("received" if received else "recv_errors")
+            if not received:
+                if records:
+                    # Hand over what has been already taken from the driver queue
+                    break
+                raise winerror(self.get_last_error())
+            records.append((view[:recv_len.value],
+                            CapturedMetadata((address.IfIdx, address.SubIfIdx), address.Direction)))
+        return records
+
+    def receive_many(self, count=BATCH_SIZE, bufsize=PACKET_BUFFER_SIZE, timeout=None):
+        """
+        Receives up to count diverted packets in a single call, see recv_many().
+        The return value is a list of high level packets, each one owning a copy of its data.
+        """
+        parse_packet, stats = self.driver.parse_packet, self.stats
+        if stats is None:
+            return [parse_packet(record) for record in self.recv_many(count, bufsize, timeout)]
+        records = self.recv_many(count, bufsize, timeout)
+        start = clock()
+        packets = [parse_packet(record) for record in records]
+        stats.record("parse", (clock() - start) / len(packets), len(packets))
+        return packets
 
     @winerror_on_retcode
     def send(self, *args):
@@ -283,7 +538,8 @@ class Handle(object):
         Injects a packet into the network stack.
         Args could be a tuple or two different values, or an high level packet. In each case the raw data and the meta
         about the direction and interface to use are required.
-        If the packet is an highlevel packet, recalculates the checksum before sending.
+        If the packet is an highlevel packet, its checksums are recalculated before sending unless they have been
+        kept up to date as header fields were set (see CapturedPacket.refresh_checksums).
         The return value is the number of bytes actually sent.
 
         The injected packet may be one received from receive(), or a modified version, or a completely new packet.
@@ -299,12 +555,19 @@ class Handle(object):
         );
         """
         if len(args) == 1:
-            #Maybe this is a poor way to check the type, but it should work
-            if hasattr(args[0], "__iter__") and not hasattr(args[0], "strip"):
+            # Raw packets may be any buffer (bytes, bytearray, memoryview...), pairs are sequences
+            if isinstance(args[0], (tuple, list)):
                 data, dest = args[0]
             elif isinstance(args[0], CapturedPacket):
-                packet = self.driver.update_packet_checksums(args[0])
-                data, dest = packet.raw, packet.meta
+                packet = args[0]
+                start = clock() if self.stats is not None else None
+                # Nothing to do if the packet is unmodified, otherwise only the changed words are considered
+                # unless the payload changed: checksums are then recalculated in place
+                if not packet.refresh_checksums():
+                    self.driver.update_checksums([packet])
+                if start is not None:
+                    self.stats.record("checksum", clock() - start)
+                data, dest = packet._buffer, packet.meta
             else:
                 raise ValueError("Not a CapturedPacket or sequence (data, meta): {}".format(args))
         elif len(args) == 2:
@@ -318,9 +581,68 @@ class Handle(object):
         address.Direction = dest.direction
         send_len = ctypes.c_int(0)
 
-        self._lib.DivertSend(self._handle, data, len(data), ctypes.byref(address), ctypes.byref(send_len))
+        stats = self.stats
+        if stats is None:
+            self._lib.DivertSend(self._handle, as_ctypes_buffer(data), len(data), ctypes.byref(address),
+                                 ctypes.byref(send_len))
+        else:
+            start = clock()
+            sent = self._lib.DivertSend(self._handle, as_ctypes_buffer(data), len(data), ctypes.byref(address),
+                                        ctypes.byref(send_len))
+            stats.record("send", clock() - start)
+            stats.count("sent" if sent else "send_errors")
         return send_len
 
+    def send_many(self, packets):
+        """
+        Injects several packets into the network stack.
+        Packets may be high level packets or (raw_packet, meta) pairs, possibly mixed. The checksums of the high
+        level packets are updated before sending, incrementally when possible, otherwise recalculated in place all at
+        once (see WinDivert.update_checksums).
+
+        The return value is a list with a result for each packet, in order: the number of bytes actually sent or,
+        if DivertSend() failed for that packet, the WindowsError describing the failure. A failure does not stop
+        the remaining packets from being sent.
+        """
+        stats = self.stats
+        if stats is not None:
+            start = clock()
+        items, captured = [], []
+        for packet in packets:
+            if isinstance(packet, CapturedPacket):
+                if not packet.refresh_checksums():
+                    captured.append(packet)
+                items.append((packet._buffer, packet.meta))
+            elif isinstance(packet, (tuple, list)):
+                items.append(packet)
+            else:
+                raise ValueError("Not a CapturedPacket or sequence (data, meta): {}".format(packet))
+        if captured:
+            self.driver.update_checksums(captured)
+        if stats is not None and items:
+            stats.record("checksum", (clock() - start) / len(items), len(items))
+            start = clock()
+
+        # The same address structure is reused for each packet
+        address, send_len = DivertAddress(), ctypes.c_uint(0)
+        address_ref, send_len_ref = ctypes.byref(address), ctypes.byref(send_len)
+        send = self._lib.DivertSend
+        results = []
+        for data, dest in items:
+            address.IfIdx, address.SubIfIdx = dest.iface
+            address.Direction = dest.direction
+            if send(self._handle, as_ctypes_buffer(data), len(data), address_ref, send_len_ref):
+                results.append(send_len.value)
+            else:
+                results.append(winerror(self.get_last_error()))
+        if stats is not None and items:
+            stats.record("send", (clock() - start) / len(items), len(items))
+            failed = sum(1 for result in results if isinstance(result, Exception))
+            stats.count("sent", len(items) - failed)
+            if failed:
+                stats.count("send_errors", failed)
+        return results
+
     @winerror_on_retcode
     def close(self):
         """
@@ -27,20 +27,41 @@ import errno
 try:
     import winreg
 except ImportError:
-    import _winreg as winreg
+    try:
+        import _winreg as winreg
+    except ImportError:
+        # Not on Windows
+        winreg = None
+
+try:
+    import ipaddress
+except ImportError:
+    ipaddress = None
+
+from functools import lru_cache
 
 __author__ = 'fabio'
 logger = logging.getLogger(__name__)
 
+# How many addresses are remembered by the conversion functions, in each direction
+ADDRESS_CACHE_SIZE = 4096
+
+
+def _cached(function):
+    """
+    Memoize function, keeping the ADDRESS_CACHE_SIZE most recent results
+    """
+    return lru_cache(maxsize=ADDRESS_CACHE_SIZE)(function)
+
 
 def string_to_addr(address_family, value):
     """
     Convert a ip string in dotted form into a packed, binary format
     """
     if address_family == socket.AF_INET:
-        return struct.unpack("<I", inet_pton(socket.AF_INET, value))[0]
+        return struct.unpack("<I", string_to_packed(socket.AF_INET, value))[0]
     elif address_family == socket.AF_INET6:
-        return struct.unpack("<IIII", inet_pton(socket.AF_INET6, value))
+        return struct.unpack("<IIII", string_to_packed(socket.AF_INET6, value))
     else:
         raise ValueError("Unknown address_family: {}".format(address_family))
 
@@ -50,13 +71,27 @@ def addr_to_string(address_family, value):
     Convert a packed, binary format into a ip string in dotted form
     """
     if address_family == socket.AF_INET:
-        return inet_ntop(socket.AF_INET, struct.pack("<I", value))
+        return packed_to_string(socket.AF_INET, struct.pack("<I", value))
     elif address_family == socket.AF_INET6:
-        return inet_ntop(socket.AF_INET6, struct.pack("<IIII", *value))
+        return packed_to_string(socket.AF_INET6, struct.pack("<IIII", *value))
     else:
         raise ValueError("Unknown address_family: {}".format(address_family))
 
 
+def strings_to_addrs(address_family, values):
+    """
+    Convert a list of ip strings, see string_to_addr
+    """
+    return [string_to_addr(address_family, value) for value in values]
+
+
+def addrs_to_strings(address_family, values):
+    """
+    Convert a list of packed addresses, see addr_to_string
+    """
+    return [addr_to_string(address_family, value) for value in values]
+
+
 class sockaddr(ctypes.Structure):
     _fields_ = [("sa_family", ctypes.c_short),
                 ("__pad1", ctypes.c_ushort),
@@ -65,20 +100,16 @@ class sockaddr(ctypes.Structure):
                 ("__pad2", ctypes.c_ulong)]
 
 
-WSAStringToAddressA = ctypes.windll.ws2_32.WSAStringToAddressA
-WSAAddressToStringA = ctypes.windll.ws2_32.WSAAddressToStringA
-
-
-def inet_pton(address_family, ip_string):
+def _wsa_inet_pton(address_family, ip_string):
     addr = sockaddr()
     addr.sa_family = address_family
     addr_size = ctypes.c_int(ctypes.sizeof(addr))
 
-    if WSAStringToAddressA(ip_string.encode("UTF-8"),
-                           address_family,
-                           None,
-                           ctypes.byref(addr),
-                           ctypes.byref(addr_size)) != 0:
+    if ctypes.windll.ws2_32.WSAStringToAddressA(ip_string.encode("UTF-8"),
+                                                address_family,
+                                                None,
+                                                ctypes.byref(addr),
+                                                ctypes.byref(addr_size)) != 0:
         raise socket.error(ctypes.FormatError())
 
     if address_family == socket.AF_INET:
@@ -89,7 +120,7 @@ def inet_pton(address_family, ip_string):
     raise socket.error('unknown address family')
 
 
-def inet_ntop(address_family, packed_ip):
+def _wsa_inet_ntop(address_family, packed_ip):
     addr = sockaddr()
     addr.sa_family = address_family
     addr_size = ctypes.c_int(ctypes.sizeof(addr))
@@ -107,20 +138,73 @@ def inet_ntop(address_family, packed_ip):
     else:
         raise socket.error('unknown address family')
 
-    if WSAAddressToStringA(ctypes.byref(addr),
-                           addr_size,
-                           None,
-                           ip_string,
-                           ctypes.byref(ip_string_size)) != 0:
+    if ctypes.windll.ws2_32.WSAAddressToStringA(ctypes.byref(addr),
+                                                addr_size,
+                                                None,
+                                                ip_string,
+                                                ctypes.byref(ip_string_size)) != 0:
         raise socket.error(ctypes.FormatError())
 
     return (ip_string[:ip_string_size.value - 1]).decode("UTF-8")
 
 
-def get_reg_values(key, root_key=winreg.HKEY_LOCAL_MACHINE):
+def _ipaddress_class(address_family):
+    if address_family == socket.AF_INET:
+        return ipaddress.IPv4Address
+    if address_family == socket.AF_INET6:
+        return ipaddress.IPv6Address
+    raise socket.error('unknown address family')
+
+
+def _ipaddress_inet_pton(address_family, ip_string):
+    try:
+        return _ipaddress_class(address_family)(u"{}".format(ip_string)).packed
+    except ValueError as error:
+        raise socket.error(str(error))
+
+
+def _ipaddress_inet_ntop(address_family, packed_ip):
+    try:
+        return str(_ipaddress_class(address_family)(bytes(packed_ip)))
+    except ValueError as error:
+        raise socket.error(str(error))
+
+
+# The socket module provides inet_pton and inet_ntop everywhere but on Windows before python 3.4, where the
+# ipaddress module may be available instead. WinSock is the last resort.
+if hasattr(socket, "inet_pton"):
+    inet_pton, inet_ntop = socket.inet_pton, socket.inet_ntop
+elif ipaddress is not None:
+    inet_pton, inet_ntop = _ipaddress_inet_pton, _ipaddress_inet_ntop
+else:
+    inet_pton, inet_ntop = _wsa_inet_pton, _wsa_inet_ntop
+
+
+@_cached
+def string_to_packed(address_family, value):
+    """
+    inet_pton, remembering the most recent conversions
+    """
+    return inet_pton(address_family, value)
+
+
+@_cached
+def packed_to_string(address_family, packed):
+    """
+    inet_ntop, remembering the most recent conversions. packed must be hashable, e.g. bytes.
+    """
+    return inet_ntop(address_family, packed)
+
+
+def get_reg_values(key, root_key=None):
     """
     Given a key name, return a dictionary of its values.
+    The root key defaults to HKEY_LOCAL_MACHINE.
     """
+    if winreg is None:
+        raise OSError(errno.ENOENT, "Windows registry not available on this platform", key)
+    if root_key is None:
+        root_key = winreg.HKEY_LOCAL_MACHINE
     key_handle = None
     count = 0
     result = {}
@@ -132,7 +216,7 @@ def get_reg_values(key, root_key=winreg.HKEY_LOCAL_MACHINE):
             logger.debug("Found {}".format(values))
             count += 1
             result.update({values[0]: values[1]})
-    except WindowsError as error:
+    except OSError as error:
         if error.errno == errno.EINVAL:
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Returning {} values".format(
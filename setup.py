@@ -31,6 +31,7 @@ setup(name='pydivert',
       keywords=['windivert','network','tcp/ip'],
       license="LICENSE",
       packages=find_packages(),
+      python_requires='>=3.5',
       classifiers=[
           'Development Status :: 2 - Pre-Alpha',
           'Environment :: Win32 (MS Windows)',
@@ -42,8 +43,16 @@ setup(name='pydivert',
           'Operating System :: Microsoft :: Windows :: Windows Server 2008',
           'Operating System :: Microsoft :: Windows :: Windows 7',
           'Programming Language :: Python',
-          'Programming Language :: Python :: 2.7',
-          'Programming Language :: Python :: 3.3',
+          'Programming Language :: Python :: 3',
+          'Programming Language :: Python :: 3 :: Only',
+          'Programming Language :: Python :: 3.5',
+          'Programming Language :: Python :: 3.6',
+          'Programming Language :: Python :: 3.7',
+          'Programming Language :: Python :: 3.8',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
+          'Programming Language :: Python :: 3.11',
+          'Programming Language :: Python :: 3.12',
           'Topic :: Software Development :: Libraries :: Python Modules',
           'Topic :: System :: Networking :: Firewalls',
           'Topic :: System :: Networking :: Monitoring',